@@ -0,0 +1,15 @@
+from salty_tickets import database
+
+# the counters are filled in by 107, once order_products.dance_role is there
+sql = """
+CREATE TABLE product_inventory (
+    product_id INT NOT NULL,
+    dance_role VARCHAR(32) NOT NULL DEFAULT '',
+    accepted INT NOT NULL DEFAULT 0,
+    waiting INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (product_id, dance_role),
+    FOREIGN KEY (product_id) REFERENCES products (id)
+);
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
@@ -0,0 +1,31 @@
+from salty_tickets import database
+
+sql = """
+ALTER TABLE order_products ADD dance_role varchar(32) DEFAULT NULL;
+CREATE INDEX ix_order_products_dance_role ON order_products (dance_role);
+UPDATE order_products op SET dance_role =
+    (SELECT field_value FROM order_product_details opd
+        WHERE opd.order_product_id=op.id AND opd.field_name='dance_role' LIMIT 1);
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
+
+# same counts as rebuild_product_inventory, which can't run before 110 adds product_inventory.held
+sql = """
+INSERT INTO product_inventory (product_id, dance_role, accepted, waiting)
+SELECT op.product_id, '',
+    SUM(CASE WHEN op.status='accepted' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN op.status='waiting' THEN 1 ELSE 0 END)
+FROM order_products op JOIN orders o ON o.id=op.order_id
+WHERE o.status='paid'
+GROUP BY op.product_id;
+INSERT INTO product_inventory (product_id, dance_role, accepted, waiting)
+SELECT op.product_id, op.dance_role,
+    SUM(CASE WHEN op.status='accepted' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN op.status='waiting' THEN 1 ELSE 0 END)
+FROM order_products op JOIN orders o ON o.id=op.order_id
+WHERE o.status='paid' AND op.dance_role IN ('leader', 'follower') AND op.status IN ('accepted', 'waiting')
+GROUP BY op.product_id, op.dance_role;
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
@@ -0,0 +1,19 @@
+import json
+
+from salty_tickets import database
+from salty_tickets.models import Product
+
+sql = """
+ALTER TABLE products ADD parameters_json TEXT DEFAULT NULL;
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
+
+# product_parameters is left in place on purpose, as the copy of the values from before this migration.
+# The values are copied as they are, strings
+for product in Product.query.all():
+    parameters = {p.parameter_name: p.parameter_value for p in product.parameters.all()}
+    product.parameters_json = json.dumps(parameters, sort_keys=True)
+    print(product.id, product.name, len(parameters))
+
+database.db_session.commit()
@@ -0,0 +1,7 @@
+from salty_tickets import database
+
+sql = """
+ALTER TABLE events ADD catalog_version INT NOT NULL DEFAULT 0;
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
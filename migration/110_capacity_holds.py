@@ -0,0 +1,21 @@
+from salty_tickets import database
+from salty_tickets.inventory import verify_product_inventory
+
+sql = """
+ALTER TABLE product_inventory ADD held INT NOT NULL DEFAULT 0;
+CREATE TABLE capacity_holds (
+    id INT NOT NULL AUTO_INCREMENT,
+    product_id INT NOT NULL,
+    order_id INT DEFAULT NULL,
+    quantity INT NOT NULL,
+    expires_at DATETIME NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (product_id) REFERENCES products (id),
+    FOREIGN KEY (order_id) REFERENCES orders (id)
+);
+CREATE INDEX ix_capacity_holds_expires_at ON capacity_holds (expires_at);
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
+
+print(verify_product_inventory())
@@ -0,0 +1,7 @@
+from salty_tickets import database
+
+sql = """
+ALTER TABLE payments ADD failure_message TEXT;
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
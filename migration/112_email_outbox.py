@@ -0,0 +1,23 @@
+from salty_tickets import database
+
+sql = """
+CREATE TABLE email_outbox (
+    id INT NOT NULL AUTO_INCREMENT,
+    email_from VARCHAR(255) NOT NULL,
+    email_to VARCHAR(255) NOT NULL,
+    subject VARCHAR(255),
+    body_text TEXT,
+    body_html TEXT,
+    status VARCHAR(10) NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL,
+    created_at DATETIME NOT NULL,
+    sent_at DATETIME,
+    last_error TEXT,
+    PRIMARY KEY (id)
+);
+CREATE INDEX ix_email_outbox_status ON email_outbox (status);
+CREATE INDEX ix_email_outbox_next_attempt_at ON email_outbox (next_attempt_at);
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
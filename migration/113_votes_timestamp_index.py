@@ -0,0 +1,10 @@
+from salty_tickets import database
+
+# the vote tally of a voting session is loaded by vote_timestamp
+sql = """
+CREATE INDEX ix_votes_vote_timestamp ON votes (vote_timestamp);
+"""
+
+database.db_session.execute(sql)
+
+database.db_session.commit()
@@ -0,0 +1,18 @@
+from salty_tickets import database
+from salty_tickets.crowdfunding_totals import rebuild_crowdfunding_totals, verify_crowdfunding_totals
+
+sql = """
+CREATE TABLE crowdfunding_totals (
+    event_id INT NOT NULL,
+    product_id INT NOT NULL DEFAULT 0,
+    amount FLOAT NOT NULL DEFAULT 0,
+    contributors INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (event_id, product_id),
+    FOREIGN KEY (event_id) REFERENCES events (id)
+);
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
+
+rebuild_crowdfunding_totals()
+print(verify_crowdfunding_totals())
@@ -0,0 +1,10 @@
+from salty_tickets import database
+
+# the crowdfunding contributors are paginated by registered_datetime
+sql = """
+CREATE INDEX ix_registrations_registered_datetime ON registrations (registered_datetime);
+"""
+
+database.db_session.execute(sql)
+
+database.db_session.commit()
@@ -0,0 +1,11 @@
+from salty_tickets import database
+from salty_tickets.inventory import verify_product_inventory
+
+# the holds are counted on the dance role rows of product_inventory as well
+sql = """
+ALTER TABLE capacity_holds ADD dance_role VARCHAR(32) NOT NULL DEFAULT '';
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
+
+print(verify_product_inventory())
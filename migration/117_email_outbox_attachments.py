@@ -0,0 +1,16 @@
+from salty_tickets import database
+
+# the ticket mailings go through the outbox with their PDFs
+sql = """
+ALTER TABLE email_outbox ADD provider_message_id VARCHAR(255);
+CREATE TABLE email_outbox_attachments (
+    id INT NOT NULL AUTO_INCREMENT,
+    email_id INT NOT NULL,
+    filename VARCHAR(255) NOT NULL,
+    content MEDIUMBLOB NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (email_id) REFERENCES email_outbox (id)
+);
+"""
+database.db_session.execute(sql)
+database.db_session.commit()
@@ -10,4 +10,9 @@ Bootstrap(app)
 db = SQLAlchemy(app)
 app.secret_key = 'devtest'
 
-from salty_tickets import views
\ No newline at end of file
+from salty_tickets import views
+
+if getattr(config, 'PRECOMPILE_EMAIL_TEMPLATES', True):
+    # the CSS is inlined before the first email is sent, and before the server forks its workers
+    from salty_tickets.email_templates import precompile_email_templates
+    precompile_email_templates(app)
@@ -0,0 +1,35 @@
+from functools import lru_cache
+
+
+def max_bundles(capacities, bundle_size=3):
+    """Maximum number of bundles, each taking one place in bundle_size different slots.
+
+    capacities are the remaining places of the slots. Every bundle uses at most one place of
+    the j largest slots, so for each j < bundle_size the remaining slots must cover the other
+    (bundle_size - j) places of every bundle. The smallest of these bounds is reachable,
+    which is why no search is needed.
+    """
+    capacities = tuple(sorted((max(0, c) for c in capacities), reverse=True))
+    return _max_bundles(capacities, bundle_size)
+
+
+@lru_cache(maxsize=1024)
+def _max_bundles(capacities, bundle_size):
+    if bundle_size <= 0 or len(capacities) < bundle_size:
+        return 0
+    tail = sum(capacities[bundle_size - 1:])
+    available = tail
+    for j in range(bundle_size - 2, -1, -1):
+        tail += capacities[j]
+        available = min(available, tail // (bundle_size - j))
+    return available
+
+
+def full_weekend_available(slot_capacities):
+    """Full weekend passes still available, a pass is three stations in different time slots"""
+    return max_bundles(slot_capacities, 3)
+
+
+def fast_train_available(product_capacities):
+    """Fast train passes still available, a pass includes one place in each of the products"""
+    return max_bundles(product_capacities, len(product_capacities))
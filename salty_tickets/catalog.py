@@ -0,0 +1,101 @@
+import threading
+
+from salty_tickets.database import db_session
+from salty_tickets.models import Event
+from salty_tickets.products import get_product_by_model
+from sqlalchemy.orm import selectinload
+
+
+class CatalogProduct:
+    """Product of the catalog: the product class instance and a detached snapshot of the product row"""
+    def __init__(self, product_model):
+        self.product_id = product_model.id
+        self.product_key = product_model.product_key
+        self.product = get_product_by_model(product_model)
+        self._product_model = product_model
+
+    @property
+    def model(self):
+        # attach the snapshot to the current session without going to the database
+        return db_session.merge(self._product_model, load=False)
+
+    @property
+    def snapshot(self):
+        # the detached product row itself, only its column attributes can be used
+        return self._product_model
+
+
+class EventCatalog:
+    """Immutable snapshot of the event products, shared between requests.
+
+    The snapshot is reused while event.catalog_version stays the same,
+    call invalidate_event_catalog after changing any of the event products.
+    """
+    def __init__(self, event_id, version, products):
+        self.event_id = event_id
+        self.version = version
+        self.products = tuple(products)
+        self._by_id = {p.product_id: p for p in self.products}
+        self._by_key = {p.product_key: p for p in self.products}
+        self._form_classes = {}
+
+    def __iter__(self):
+        return iter(self.products)
+
+    def __len__(self):
+        return len(self.products)
+
+    def get_by_id(self, product_id):
+        return self._by_id.get(product_id)
+
+    def get_by_key(self, product_key):
+        return self._by_key.get(product_key)
+
+    def get_product(self, product_model):
+        catalog_product = self.get_by_id(product_model.id)
+        if catalog_product is None:
+            return get_product_by_model(product_model)
+        return catalog_product.product
+
+    def get_form_class(self, name, create_form_class):
+        # form classes only have the static part of the products, see FormWithProducts.set_products_live_data
+        form_class = self._form_classes.get(name)
+        if form_class is None:
+            form_class = create_form_class(self)
+            self._form_classes[name] = form_class
+        return form_class
+
+    @classmethod
+    def load(cls, event_id):
+        # separate session, so that the snapshot objects don't share state with the request session
+        session = db_session.session_factory()
+        try:
+            event = session.query(Event).options(selectinload(Event.catalog_products)).filter_by(id=event_id).one()
+            version = event.catalog_version or 0
+            products = [CatalogProduct(product_model) for product_model in event.catalog_products]
+        finally:
+            session.close()
+        return cls(event_id, version, products)
+
+    @classmethod
+    def for_event(cls, event):
+        version = event.catalog_version or 0
+        catalog = _catalogs.get(event.id)
+        if catalog is None or catalog.version != version:
+            with _catalogs_lock:
+                catalog = _catalogs.get(event.id)
+                if catalog is None or catalog.version != version:
+                    catalog = cls.load(event.id)
+                    _catalogs[event.id] = catalog
+        return catalog
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def invalidate_event_catalog(event):
+    """Makes all processes reload the event products, takes effect once the session is committed"""
+    event.catalog_version = (event.catalog_version or 0) + 1
+    with _catalogs_lock:
+        _catalogs.pop(event.id, None)
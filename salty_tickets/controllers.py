@@ -10,6 +10,15 @@ from salty_tickets.tokens import email_deserialize, order_product_serialize, ord
     GroupToken
 
 
+def get_waiting_reason(product_type, product_order_products_count):
+    if product_type == 'CouplesOnlyWorkshop':
+        if product_order_products_count == 1:
+            return 'You are put in the waiting list until your partner signs up'
+        else:
+            return 'There are no available places in the workshop'
+    return 'You are put on the waiting list due to the current imbalance in leads and followers'
+
+
 def price_format(func):
     def func_wrap(self):
         return '£{:.2f}'.format(func(self))
@@ -84,6 +93,21 @@ class OrderProductController:
     def product_type(self):
         return self._order_product.product.type
 
+    @property
+    def product_parameters(self):
+        return self._order_product.product.parameters_as_dict
+
+    @property
+    def product_info(self):
+        return self._order_product.product.info
+
+    @property
+    def waiting_reason(self):
+        if self.is_waiting:
+            product_order_products_count = len(
+                [op for op in self._order_product.order.order_products if op.product.id == self._order_product.product.id])
+            return get_waiting_reason(self.product_type, product_order_products_count)
+
     @property
     def token(self):
         return order_product_serialize(self._order_product)
@@ -170,6 +194,14 @@ class GroupController:
         serialiser = GroupToken()
         return serialiser.serialize(self._group)
 
+    @property
+    def name(self):
+        return self._group.name
+
+    @property
+    def member_names(self):
+        return [registration.name for registration in self._group.registrations]
+
 
     # @property
     # def group_members(self):
@@ -188,6 +220,14 @@ class OrderSummaryController:
     def transaction_fee(self):
         return self._payment.transaction_fee
 
+    @property
+    def registration_name(self):
+        return self._order.registration.name
+
+    @property
+    def registration_email(self):
+        return self._order.registration.email
+
     @property
     def total_price(self):
         total_price = self._order.total_price
@@ -274,12 +314,9 @@ class OrderSummaryController:
 
     def get_waiting_reason(self, order_product):
         if order_product.status == ORDER_PRODUCT_STATUS_WAITING:
-            if order_product.product.type == 'CouplesOnlyWorkshop':
-                if len([op for op in self._order.order_products if op.product.id==order_product.product.id]) == 1:
-                    return 'You are put in the waiting list until your partner signs up'
-                else:
-                    return 'There are no available places in the workshop'
-            return 'You are put on the waiting list due to the current imbalance in leads and followers'
+            product_order_products_count = len(
+                [op for op in self._order.order_products if op.product.id == order_product.product.id])
+            return get_waiting_reason(order_product.product.type, product_order_products_count)
 
     @property
     def group(self):
@@ -298,6 +335,18 @@ class PaymentItemController:
     def amount(self):
         return self._payment_item.amount
 
+    @property
+    def has_order_product(self):
+        return self._payment_item.order_product is not None
+
+    @property
+    def order_product_status(self):
+        return self._payment_item.order_product.status.title()
+
+    @property
+    def order_product_price(self):
+        return self._payment_item.order_product.price
+
     @property
     def full_description(self):
         names_list = []
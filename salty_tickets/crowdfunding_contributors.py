@@ -0,0 +1,63 @@
+import datetime
+from collections import namedtuple
+
+from salty_tickets.database import db_session
+from salty_tickets.models import Registration, Order, CrowdfundingRegistrationProperties
+from sqlalchemy import and_, or_
+
+CROWDFUNDING_CONTRIBUTORS_PAGE_SIZE = 30
+CROWDFUNDING_CONTRIBUTORS_MAX_PAGE_SIZE = 100
+CONTRIBUTORS_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+CrowdfundingContributor = namedtuple('CrowdfundingContributor', ['id', 'name', 'anonymous', 'amount', 'comment',
+                                                                 'registered_datetime'])
+CrowdfundingContributorsPage = namedtuple('CrowdfundingContributorsPage', ['contributors', 'next_cursor'])
+
+
+def format_contributors_cursor(contributor):
+    return '{}_{}'.format(contributor.registered_datetime.strftime(CONTRIBUTORS_CURSOR_FORMAT), contributor.id)
+
+
+def parse_contributors_cursor(cursor):
+    """(registered_datetime, id) of the last contributor of the previous page, raises ValueError if invalid"""
+    registered_datetime, registration_id = cursor.rsplit('_', 1)
+    return datetime.datetime.strptime(registered_datetime, CONTRIBUTORS_CURSOR_FORMAT), int(registration_id)
+
+
+def get_contributors_page(event_id, cursor=None, page_size=CROWDFUNDING_CONTRIBUTORS_PAGE_SIZE):
+    """Contributors of the event, the latest first, starting after the cursor.
+
+    The pages are found by (registered_datetime, id) rather than by offset, so every page
+    costs the same and new contributions don't shift the next pages.
+    """
+    query = db_session.query(Registration.id, Registration.name, CrowdfundingRegistrationProperties.anonymous,
+                             Order.total_price, Registration.comment, Registration.registered_datetime).\
+        join(Order, Order.registration_id == Registration.id).\
+        outerjoin(CrowdfundingRegistrationProperties,
+                  CrowdfundingRegistrationProperties.registration_id == Registration.id).\
+        filter(Order.event_id == event_id)
+    if cursor:
+        registered_datetime, registration_id = parse_contributors_cursor(cursor)
+        query = query.filter(or_(
+            Registration.registered_datetime < registered_datetime,
+            and_(Registration.registered_datetime == registered_datetime, Registration.id < registration_id),
+        ))
+    rows = query.order_by(Registration.registered_datetime.desc(), Registration.id.desc()).\
+        limit(page_size + 1).all()
+
+    contributors = []
+    for registration_id, name, anonymous, amount, comment, registered_datetime in rows[:page_size]:
+        # the names of anonymous contributors never leave the database
+        contributors.append(CrowdfundingContributor(registration_id, None if anonymous else name, bool(anonymous),
+                                                    amount, comment, registered_datetime))
+    next_cursor = format_contributors_cursor(contributors[-1]) if len(rows) > page_size else None
+    return CrowdfundingContributorsPage(contributors, next_cursor)
+
+
+def contributor_as_dict(contributor):
+    return {
+        'name': contributor.name,
+        'anonymous': contributor.anonymous,
+        'amount': contributor.amount,
+        'comment': contributor.comment,
+    }
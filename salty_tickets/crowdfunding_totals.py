@@ -0,0 +1,66 @@
+from collections import namedtuple
+
+from salty_tickets.database import db_session
+from salty_tickets.models import Event, Order, OrderProduct, CrowdfundingTotal, ORDER_STATUS_PAID, \
+    EVENT_TYPE_CROWDFUNDING, CROWDFUNDING_TOTAL_ALL_PRODUCTS
+from sqlalchemy import func
+
+CrowdfundingTotalStats = namedtuple('CrowdfundingTotalStats', ['amount', 'contributors'])
+
+_EMPTY_TOTAL = CrowdfundingTotalStats(amount=0, contributors=0)
+
+
+def get_crowdfunding_totals(event_id):
+    """Stored totals of the event, CROWDFUNDING_TOTAL_ALL_PRODUCTS key for the whole event and one per product"""
+    query = db_session.query(CrowdfundingTotal.product_id, CrowdfundingTotal.amount, CrowdfundingTotal.contributors).\
+        filter(CrowdfundingTotal.event_id == event_id)
+    totals = {product_id: CrowdfundingTotalStats(amount, contributors) for product_id, amount, contributors in query}
+    totals.setdefault(CROWDFUNDING_TOTAL_ALL_PRODUCTS, _EMPTY_TOTAL)
+    return totals
+
+
+def count_crowdfunding_totals(event_id):
+    """Recount the totals of the event from the paid orders"""
+    totals = {}
+    event_total = db_session.query(func.sum(Order.total_price), func.count(Order.id)).\
+        filter(Order.event_id == event_id, Order.status == ORDER_STATUS_PAID).one()
+    if event_total[1]:
+        totals[CROWDFUNDING_TOTAL_ALL_PRODUCTS] = CrowdfundingTotalStats(event_total[0], event_total[1])
+    query = db_session.query(OrderProduct.product_id, func.sum(OrderProduct.price), func.count(OrderProduct.id)).\
+        join(Order, OrderProduct.order_id == Order.id).\
+        filter(Order.event_id == event_id, Order.status == ORDER_STATUS_PAID).\
+        group_by(OrderProduct.product_id)
+    for product_id, amount, contributors in query.all():
+        totals[product_id] = CrowdfundingTotalStats(amount, contributors)
+    return totals
+
+
+def _get_crowdfunding_event_ids(event_id=None):
+    if event_id:
+        return [event_id]
+    return [e_id for e_id, in db_session.query(Event.id).filter_by(event_type=EVENT_TYPE_CROWDFUNDING).all()]
+
+
+def rebuild_crowdfunding_totals(event_id=None):
+    for e_id in _get_crowdfunding_event_ids(event_id):
+        CrowdfundingTotal.query.filter_by(event_id=e_id).delete(synchronize_session=False)
+        for product_id, stats in count_crowdfunding_totals(e_id).items():
+            db_session.add(CrowdfundingTotal(event_id=e_id, product_id=product_id,
+                                             amount=stats.amount, contributors=stats.contributors))
+    db_session.commit()
+
+
+def verify_crowdfunding_totals(event_id=None):
+    """Returns a list of (event_id, product_id, stored, actual) for totals which are out of sync"""
+    mismatches = []
+    for e_id in _get_crowdfunding_event_ids(event_id):
+        stored = get_crowdfunding_totals(e_id)
+        actual = count_crowdfunding_totals(e_id)
+        for product_id in set(stored.keys()) | set(actual.keys()):
+            stored_stats = stored.get(product_id, _EMPTY_TOTAL)
+            actual_stats = actual.get(product_id, _EMPTY_TOTAL)
+            # amounts are added up one order at a time, so they may differ in the last digits
+            if stored_stats.contributors != actual_stats.contributors or \
+                    round(stored_stats.amount - actual_stats.amount, 2) != 0:
+                mismatches.append((e_id, product_id, stored_stats, actual_stats))
+    return mismatches
@@ -0,0 +1,164 @@
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from salty_tickets import emails
+from salty_tickets.database import db_session
+from salty_tickets.models import EmailOutbox, EMAIL_STATUS_PENDING, EMAIL_STATUS_SENDING, EMAIL_STATUS_SENT, \
+    EMAIL_STATUS_FAILED
+from sqlalchemy import func
+
+EMAIL_MAX_ATTEMPTS = 6
+EMAIL_RETRY_DELAY = datetime.timedelta(seconds=30)
+EMAIL_MAX_RETRY_DELAY = datetime.timedelta(hours=1)
+# an email which stays in sending longer than this is sent again, e.g. after the sender crashed.
+# Much longer than a request to Mailgun takes, so an email which is still being sent is not claimed again.
+EMAIL_SENDING_TIMEOUT = datetime.timedelta(seconds=emails.MAILGUN_TIMEOUT * 10)
+
+
+class RateLimiter:
+    """Token bucket shared by the sender threads"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_retry_delay(attempts, retry_after=None):
+    if retry_after:
+        return datetime.timedelta(seconds=retry_after)
+    return min(EMAIL_RETRY_DELAY * 2 ** (attempts - 1), EMAIL_MAX_RETRY_DELAY)
+
+
+class EmailOutboxSender:
+    """Sends the emails of the outbox with a pool of threads.
+
+    Several senders can run at the same time, every email is claimed before it is sent.
+    rate is the number of emails per second allowed by the provider.
+    """
+    def __init__(self, workers=4, rate=5, max_attempts=EMAIL_MAX_ATTEMPTS, send=None):
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.max_attempts = max_attempts
+        self.send = send or emails.send_email
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def send_pending(self, limit=100, now=None):
+        """Sends the emails due now, returns the number of emails processed"""
+        now = now or datetime.datetime.utcnow()
+        email_ids = [email_id for email_id, in db_session.query(EmailOutbox.id).
+                     filter(EmailOutbox.status.in_([EMAIL_STATUS_PENDING, EMAIL_STATUS_SENDING])).
+                     filter(EmailOutbox.next_attempt_at <= now).
+                     order_by(EmailOutbox.next_attempt_at, EmailOutbox.id).
+                     limit(limit)]
+        db_session.remove()
+        results = list(self._executor.map(lambda email_id: self._send_one(email_id, now), email_ids))
+        return len([r for r in results if r is not None])
+
+    def run(self, poll_interval=5):
+        while True:
+            processed = self.send_pending()
+            if processed:
+                logging.info('email outbox: %s', get_email_outbox_metrics())
+            else:
+                time.sleep(poll_interval)
+
+    def _send_one(self, email_id, now):
+        try:
+            # waits for the rate limit before the claim, the claim only has to outlast the request
+            self.rate_limiter.acquire()
+            email = claim_email(db_session, email_id, now)
+            if email is None:
+                return None
+            files = [('attachment', (a.filename, a.content)) for a in email.attachments]
+            try:
+                result = self.send(email.email_from, email.email_to, email.subject, email.body_text, email.body_html,
+                                   files=files or None)
+            except Exception as e:
+                return self._record_failure(email, now, str(e), retry=True)
+
+            if 200 <= result.status_code < 300:
+                email.status = EMAIL_STATUS_SENT
+                email.sent_at = datetime.datetime.utcnow()
+                email.provider_message_id = get_provider_message_id(result)
+                email.last_error = None
+                db_session.commit()
+                return email.status
+
+            error = '{} {}'.format(result.status_code, result.text[:1000])
+            # too many requests and provider errors are temporary, other errors are not
+            retry = result.status_code == 429 or result.status_code >= 500
+            retry_after = result.headers.get('Retry-After')
+            retry_after = int(retry_after) if retry_after and retry_after.isdigit() else None
+            return self._record_failure(email, now, error, retry, retry_after)
+        except Exception:
+            logging.exception('Failed to send email %s from the outbox', email_id)
+            db_session.rollback()
+        finally:
+            db_session.remove()
+
+    def _record_failure(self, email, now, error, retry, retry_after=None):
+        email.last_error = error
+        if retry and email.attempts < self.max_attempts:
+            email.status = EMAIL_STATUS_PENDING
+            email.next_attempt_at = now + get_retry_delay(email.attempts, retry_after)
+        else:
+            email.status = EMAIL_STATUS_FAILED
+        db_session.commit()
+        return email.status
+
+
+def get_provider_message_id(result):
+    try:
+        return result.json().get('id')
+    except ValueError:
+        return None
+
+
+def claim_email(session, email_id, now=None):
+    """Marks the email as being sent, returns None if another sender has claimed it first"""
+    now = now or datetime.datetime.utcnow()
+    table = EmailOutbox.__table__
+    result = session.execute(
+        table.update().
+        where(table.c.id == email_id).
+        where(table.c.status.in_([EMAIL_STATUS_PENDING, EMAIL_STATUS_SENDING])).
+        where(table.c.next_attempt_at <= now).
+        values(status=EMAIL_STATUS_SENDING, attempts=table.c.attempts + 1,
+               next_attempt_at=now + EMAIL_SENDING_TIMEOUT)
+    )
+    session.commit()
+    if result.rowcount != 1:
+        return None
+    return session.query(EmailOutbox).get(email_id)
+
+
+def get_email_outbox_metrics(session=None, now=None):
+    if session is None:
+        session = db_session
+    now = now or datetime.datetime.utcnow()
+    metrics = {status: 0 for status in [EMAIL_STATUS_PENDING, EMAIL_STATUS_SENDING, EMAIL_STATUS_SENT,
+                                        EMAIL_STATUS_FAILED]}
+    for status, count in session.query(EmailOutbox.status, func.count(EmailOutbox.id)).group_by(EmailOutbox.status):
+        metrics[status] = count
+    oldest = session.query(func.min(EmailOutbox.created_at)).\
+        filter(EmailOutbox.status.in_([EMAIL_STATUS_PENDING, EMAIL_STATUS_SENDING])).scalar()
+    metrics['queue_depth'] = metrics[EMAIL_STATUS_PENDING] + metrics[EMAIL_STATUS_SENDING]
+    metrics['oldest_queued_seconds'] = int((now - oldest).total_seconds()) if oldest else 0
+    return metrics
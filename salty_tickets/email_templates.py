@@ -0,0 +1,112 @@
+import logging
+import os
+import re
+import threading
+
+from flask import current_app
+from premailer import Premailer
+
+# Jinja tags which stay in the template while the layout is rendered for inlining
+LAYOUT_TAG_RE = re.compile(r'^\{%-?\s*(extends|block|endblock)\b|^\{\{-?\s*super\(\)')
+IMPORT_TAG_RE = re.compile(r'^\{%-?\s*(import|from)\b')
+JINJA_TAG_RE = re.compile(r'\{#.*?#\}|\{%.*?%\}|\{\{.*?\}\}', re.DOTALL)
+PLACEHOLDER_RE = re.compile(r'<!--JINJA_(\d+)_-->|JINJA_(\d+)_')
+STYLESHEET_LINK_RE = re.compile(r'<link href="(static/[^"]+\.css)" rel="stylesheet">')
+
+_compiled_templates = {}
+_compile_lock = threading.Lock()
+
+
+class EmailTemplateError(Exception):
+    pass
+
+
+def protect_jinja_tags(source):
+    """Replaces the Jinja tags of the template with placeholders which survive the CSS inlining.
+
+    Returns the protected source, the list of the replaced tags and the list of the imports.
+    Statements become html comments, expressions become plain text, so both can only be used
+    in the text and in the attribute values.
+    """
+    tags = []
+    imports = []
+    parts = []
+    position = 0
+    for match in JINJA_TAG_RE.finditer(source):
+        tag = match.group(0)
+        parts.append(source[position:match.start()])
+        position = match.end()
+        if tag.startswith('{#'):
+            continue
+        if LAYOUT_TAG_RE.match(tag):
+            parts.append(tag)
+            continue
+        if IMPORT_TAG_RE.match(tag):
+            imports.append(tag)
+            continue
+
+        preceding = ''.join(parts)
+        in_comment = preceding.rfind('<!--') > preceding.rfind('-->')
+        in_tag = not in_comment and preceding.rfind('<') > preceding.rfind('>')
+        if tag.startswith('{%') and in_tag:
+            raise EmailTemplateError('Jinja statement inside an html tag can\'t be precompiled: {}'.format(tag))
+        tags.append(tag)
+        if tag.startswith('{%') and not in_comment:
+            parts.append('<!--JINJA_{}_-->'.format(len(tags) - 1))
+        else:
+            parts.append('JINJA_{}_'.format(len(tags) - 1))
+    parts.append(source[position:])
+    return ''.join(parts), tags, imports
+
+
+def restore_jinja_tags(html, tags):
+    return PLACEHOLDER_RE.sub(lambda m: tags[int(m.group(1) or m.group(2))], html)
+
+
+def inline_css(html, static_root):
+    # local stylesheets are inlined from the static folder, not loaded by Premailer
+    def load_stylesheet(match):
+        with open(os.path.join(static_root, match.group(1)), encoding='utf-8') as f:
+            return '<style>{}</style>'.format(f.read())
+    html = STYLESHEET_LINK_RE.sub(load_stylesheet, html)
+    html = Premailer(html, cssutils_logging_level=logging.CRITICAL).transform()
+    return re.sub(r'<style.*</style>', '', html, flags=re.DOTALL)
+
+
+def compile_email_template(template_name, app=None):
+    """Jinja template of the email with the CSS already inlined.
+
+    The layout is rendered and the CSS is inlined once, so sending an email is just the Jinja render.
+    """
+    app = app or current_app._get_current_object()
+    source, _, _ = app.jinja_loader.get_source(app.jinja_env, template_name)
+    protected_source, tags, imports = protect_jinja_tags(source)
+    layout_html = app.jinja_env.from_string(protected_source).render()
+    inlined_source = restore_jinja_tags(inline_css(layout_html, app.root_path), tags)
+    # templates from strings are not autoescaped by Flask, unlike the .html files
+    return app.jinja_env.from_string('{}{{% autoescape true %}}{}{{% endautoescape %}}'.format(
+        ''.join(imports), inlined_source))
+
+
+def get_email_template(template_name):
+    template = _compiled_templates.get(template_name)
+    if template is None:
+        with _compile_lock:
+            template = _compiled_templates.get(template_name)
+            if template is None:
+                template = compile_email_template(template_name)
+                _compiled_templates[template_name] = template
+    return template
+
+
+def render_email_html(template_name, **context):
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    return get_email_template(template_name).render(context)
+
+
+def precompile_email_templates(app):
+    with app.app_context():
+        for template_name in app.jinja_loader.list_templates():
+            if template_name.startswith('email/') and template_name.endswith('.html'):
+                get_email_template(template_name)
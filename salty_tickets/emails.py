@@ -1,11 +1,17 @@
 # from salty_tickets import app
-import logging
 import requests
 from flask import render_template
 from salty_tickets import config
-from premailer import transform, Premailer
 from salty_tickets.config import EMAIL_FROM
-from salty_tickets.controllers import OrderSummaryController, OrderProductController, PaymentController
+from salty_tickets.controllers import OrderProductController, PaymentController
+from salty_tickets.database import db_session
+from salty_tickets.email_templates import render_email_html
+from salty_tickets.models import EmailOutbox, EmailOutboxAttachment
+from salty_tickets.order_summary import load_order_summary
+
+MAILGUN_MESSAGES_URL = 'https://api.mailgun.net/v3/saltyjitterbugs.co.uk/messages'
+# seconds, the outbox claims an email for much longer than this
+MAILGUN_TIMEOUT = 30
 
 
 def send_email(email_from, email_to, subj, body_text, body_html, files=None):
@@ -18,90 +24,90 @@ def send_email(email_from, email_to, subj, body_text, body_html, files=None):
     }
     if not config.MODE_TESTING:
         email_data['bcc'] = config.EMAIL_DEBUG
-    result = requests.post('https://api.mailgun.net/v3/saltyjitterbugs.co.uk/messages',
+    result = requests.post(MAILGUN_MESSAGES_URL,
                            auth=('api', config.MAILGUN_KEY),
                            data=email_data,
-                           files=files)
+                           files=files,
+                           timeout=MAILGUN_TIMEOUT)
     return result
 
 
-def prepare_email_html(html):
-    pr = Premailer(html, cssutils_logging_level=logging.CRITICAL)
-    html_for_email = pr.transform()
-    import re
-    html_for_email = re.sub(r'<style.*</style>', '', html_for_email, flags=re.DOTALL)
-    # print(html_for_email)
-    return html_for_email
-
+def queue_email(email_from, email_to, subj, body_text, body_html, commit=True, files=None):
+    """Adds the email to the outbox, it is sent by the outbox sender (service/email_outbox.py).
 
-def pdf_attachment_from_url(url, filename):
-    import weasyprint
-    pdf = weasyprint.HTML(url)
-    attachment = ("attachment", (filename, pdf.write_pdf()))
-    return attachment
+    files are the attachments as for send_email, ("attachment", (filename, content)).
+    """
+    email = EmailOutbox(
+        email_from=email_from,
+        email_to=email_to,
+        subject=subj,
+        body_text=body_text,
+        body_html=body_html,
+    )
+    for _, (filename, content) in files or []:
+        email.attachments.append(EmailOutboxAttachment(filename=filename, content=content))
+    db_session.add(email)
+    if commit:
+        db_session.commit()
+    return email
 
 
 def send_registration_confirmation(user_order):
-    order_summary_controller = OrderSummaryController(user_order)
+    order_summary_controller = load_order_summary(user_order.id)
 
-    body_html = render_template('email/registration_confirmation.html', order_summary_controller=order_summary_controller)
-    body_html = prepare_email_html(body_html)
+    body_html = render_email_html('email/registration_confirmation.html', order_summary_controller=order_summary_controller)
 
     body_text = render_template('email/registration_confirmation.txt', order_summary_controller=order_summary_controller)
 
     subj = '{} - Registration'.format(user_order.event.name)
 
-    return send_email(EMAIL_FROM, user_order.registration.email, subj, body_text, body_html)
+    return queue_email(EMAIL_FROM, user_order.registration.email, subj, body_text, body_html)
 
 
-def send_acceptance_from_waiting_list(order_product):
+def send_acceptance_from_waiting_list(order_product, commit=True):
     order_product_controller = OrderProductController(order_product)
 
-    body_html = render_template('email/acceptance_from_waiting_list.html', order_product_controller=order_product_controller)
-    body_html = prepare_email_html(body_html)
+    body_html = render_email_html('email/acceptance_from_waiting_list.html', order_product_controller=order_product_controller)
 
     body_text = render_template('email/acceptance_from_waiting_list.txt', order_product_controller=order_product_controller)
 
     subj = '{} - {} - You are in!'.format(order_product.order.event.name, order_product.product.name)
 
-    send_email(EMAIL_FROM, order_product.registration.email, subj, body_text, body_html)
+    queue_email(EMAIL_FROM, order_product.registration.email, subj, body_text, body_html, commit=commit)
 
 
 def send_acceptance_from_waiting_partner(order_product):
     order_product_controller = OrderProductController(order_product)
 
-    body_html = render_template('email/acceptance_from_waiting_partner.html', order_product_controller=order_product_controller)
-    body_html = prepare_email_html(body_html)
+    body_html = render_email_html('email/acceptance_from_waiting_partner.html', order_product_controller=order_product_controller)
 
     body_text = render_template('email/acceptance_from_waiting_partner.txt', order_product_controller=order_product_controller)
 
     subj = '{} - {} - You are in!'.format(order_product.order.event.name, order_product.product.name)
 
-    send_email(EMAIL_FROM, order_product.registration.email, subj, body_text, body_html)
+    queue_email(EMAIL_FROM, order_product.registration.email, subj, body_text, body_html)
 
 
 def send_cancellation_request_confirmation(order_product):
     order_product_controller = OrderProductController(order_product)
 
-    body_html = render_template('email/cancellation_request_confirmation.html', order_product_controller=order_product_controller)
-    body_html = prepare_email_html(body_html)
+    body_html = render_email_html('email/cancellation_request_confirmation.html', order_product_controller=order_product_controller)
 
     body_text = render_template('email/cancellation_request_confirmation.txt', order_product_controller=order_product_controller)
 
     subj = '{} - {} - cancellation requested!'.format(order_product.order.event.name, order_product.product.name)
 
-    send_email(EMAIL_FROM, order_product.registration.email, subj, body_text, body_html)
+    queue_email(EMAIL_FROM, order_product.registration.email, subj, body_text, body_html)
 
 
 def send_remaining_payment_confirmation(remaining_payment):
     user_order = remaining_payment.order
-    order_summary_controller = OrderSummaryController(user_order, remaining_payment)
+    order_summary_controller = load_order_summary(user_order.id, remaining_payment.id)
 
-    body_html = render_template(
+    body_html = render_email_html(
         'email/remaining_payment_received.html',
         order_summary_controller=order_summary_controller,
     )
-    body_html = prepare_email_html(body_html)
 
     body_text = render_template(
         'email/remaining_payment_received.txt',
@@ -110,4 +116,4 @@ def send_remaining_payment_confirmation(remaining_payment):
 
     subj = '{} - Payment received'.format(user_order.event.name)
 
-    return send_email(EMAIL_FROM, user_order.registration.email, subj, body_text, body_html)
+    return queue_email(EMAIL_FROM, user_order.registration.email, subj, body_text, body_html)
@@ -4,7 +4,8 @@ from wtforms.fields import StringField, DateTimeField, SubmitField, SelectField,
 from wtforms.validators import Email, DataRequired, ValidationError, Optional
 from wtforms import Form as NoCsrfForm
 from salty_tickets.models import Event, Registration, DANCE_ROLE_LEADER, DANCE_ROLE_FOLLOWER
-from salty_tickets.products import get_product_by_model
+from salty_tickets.catalog import EventCatalog
+from salty_tickets.inventory import load_product_inventory
 
 
 class SignupForm(FlaskForm):
@@ -21,6 +22,12 @@ class FormWithProducts:
     def get_product_by_key(self, product_key):
         return getattr(self, product_key)
 
+    def set_products_live_data(self, catalog):
+        load_product_inventory([p.product_id for p in catalog])
+        for catalog_product in catalog:
+            product_form = self.get_product_by_key(catalog_product.product_key).form
+            catalog_product.product.set_form_live_data(product_form, catalog_product.model)
+
 
 def need_partner_check(form, field):
     for key in form.product_keys:
@@ -50,36 +57,32 @@ class CrowdfundingSignupForm(SignupForm, FormWithProducts):
     anonymous = BooleanField(label='Contribute anonymously', default=False)
 
 
-def create_event_form(event):
-    assert (isinstance(event, Event))
-
-    class EventForm(DanceSignupForm):
-        pass
+def _create_products_form(base_form_class, catalog):
+    class EventForm(base_form_class):
+        def __init__(self, *args, **kwargs):
+            super(EventForm, self).__init__(*args, **kwargs)
+            self.set_products_live_data(catalog)
 
     product_keys = []
-    for product_model in event.products:
-        product = get_product_by_model(product_model)
-        product_key = product_model.product_key
-        setattr(EventForm, product_key, FormField(product.get_form(product_model=product_model)))
+    for catalog_product in catalog:
+        product_key = catalog_product.product_key
+        product_form = catalog_product.product.get_form(product_model=catalog_product.model)
+        setattr(EventForm, product_key, FormField(product_form))
         product_keys.append(product_key)
     setattr(EventForm, 'product_keys', product_keys)
     return EventForm
 
 
-def create_crowdfunding_form(event):
+def create_event_form(event):
     assert (isinstance(event, Event))
+    catalog = EventCatalog.for_event(event)
+    return catalog.get_form_class('event_form', lambda c: _create_products_form(DanceSignupForm, c))
 
-    class EventForm(CrowdfundingSignupForm):
-        pass
 
-    product_keys = []
-    for product_model in event.products:
-        product = get_product_by_model(product_model)
-        product_key = product_model.product_key
-        setattr(EventForm, product_key, FormField(product.get_form(product_model=product_model)))
-        product_keys.append(product_key)
-    setattr(EventForm, 'product_keys', product_keys)
-    return EventForm
+def create_crowdfunding_form(event):
+    assert (isinstance(event, Event))
+    catalog = EventCatalog.for_event(event)
+    return catalog.get_form_class('crowdfunding_form', lambda c: _create_products_form(CrowdfundingSignupForm, c))
 
 def get_crowdfunding_registration_from_form(form):
     assert isinstance(form, SignupForm)
@@ -0,0 +1,120 @@
+from collections import namedtuple
+
+from salty_tickets.database import db_session
+from salty_tickets.models import Event, Product, ProductInventory, CapacityHold, INVENTORY_ALL_ROLES, \
+    INVENTORY_SESSION_INFO_KEY
+from salty_tickets.registration_stats import EventRegistrationStats, WorkshopRegStats
+from sqlalchemy import event, func
+
+ProductInventoryStats = namedtuple('ProductInventoryStats', ['accepted', 'waiting', 'held'])
+
+_EMPTY_INVENTORY = ProductInventoryStats(accepted=0, waiting=0, held=0)
+
+
+def get_product_inventory(product_id, dance_role=INVENTORY_ALL_ROLES):
+    loaded = db_session.info.get(INVENTORY_SESSION_INFO_KEY)
+    if loaded is not None and product_id in loaded:
+        return loaded[product_id].get(dance_role, _EMPTY_INVENTORY)
+
+    inventory = ProductInventory.query.get((product_id, dance_role))
+    if inventory is None:
+        return _EMPTY_INVENTORY
+    return ProductInventoryStats(accepted=inventory.accepted, waiting=inventory.waiting, held=inventory.held)
+
+
+def load_product_inventory(product_ids):
+    """Reads the counters of all the products in one query and keeps them on the session"""
+    loaded = db_session.info.setdefault(INVENTORY_SESSION_INFO_KEY, {})
+    product_ids = [p_id for p_id in product_ids if p_id not in loaded]
+    if not product_ids:
+        return
+    for product_id in product_ids:
+        loaded[product_id] = {}
+    query = db_session.query(ProductInventory.product_id, ProductInventory.dance_role,
+                             ProductInventory.accepted, ProductInventory.waiting, ProductInventory.held). \
+        filter(ProductInventory.product_id.in_(product_ids))
+    for product_id, dance_role, accepted, waiting, held in query.all():
+        loaded[product_id][dance_role] = ProductInventoryStats(accepted=accepted, waiting=waiting, held=held)
+
+
+def get_available_quantity(product_model):
+    # places held during checkout are not available either
+    inventory = get_product_inventory(product_model.id)
+    return product_model.max_available - inventory.accepted - inventory.held
+
+
+def count_held(product_ids):
+    """Held places by (product_id, dance_role), INVENTORY_ALL_ROLES with all the holds of the product"""
+    query = db_session.query(CapacityHold.product_id, CapacityHold.dance_role, func.sum(CapacityHold.quantity)). \
+        filter(CapacityHold.product_id.in_(product_ids)). \
+        group_by(CapacityHold.product_id, CapacityHold.dance_role)
+    held = {}
+    for product_id, dance_role, quantity in query.all():
+        for key in {(product_id, INVENTORY_ALL_ROLES), (product_id, dance_role)}:
+            held[key] = held.get(key, 0) + int(quantity)
+    return held
+
+
+def count_inventory(event_id):
+    """Recount the inventory of all products of the event from the order_products rows"""
+    stats = EventRegistrationStats.load(event_id)
+    product_ids = [p_id for p_id, in db_session.query(Product.id).filter_by(event_id=event_id).all()]
+    inventory = {}
+    for product_id in product_ids:
+        inventory[(product_id, INVENTORY_ALL_ROLES)] = stats.product_stats(product_id)
+        for dance_role, role_stats in stats.product_role_stats(product_id).items():
+            if role_stats.accepted or role_stats.waiting:
+                inventory[(product_id, dance_role)] = role_stats
+    return inventory
+
+
+def rebuild_product_inventory(event_id=None):
+    event_ids = [event_id] if event_id else [e_id for e_id, in db_session.query(Event.id).all()]
+    for e_id in event_ids:
+        inventory = count_inventory(e_id)
+        product_ids = {product_id for product_id, _ in inventory.keys()}
+        if product_ids:
+            ProductInventory.query.filter(ProductInventory.product_id.in_(product_ids)). \
+                delete(synchronize_session=False)
+            held = count_held(product_ids)
+            for key in held.keys() - inventory.keys():
+                inventory[key] = WorkshopRegStats(accepted=0, waiting=0)
+        for (product_id, dance_role), stats in inventory.items():
+            db_session.add(ProductInventory(product_id=product_id, dance_role=dance_role,
+                                            accepted=stats.accepted, waiting=stats.waiting,
+                                            held=held.get((product_id, dance_role), 0)))
+    db_session.commit()
+
+
+def verify_product_inventory(event_id=None):
+    """Returns a list of (product_id, dance_role, stored, actual) for counters which are out of sync"""
+    event_ids = [event_id] if event_id else [e_id for e_id, in db_session.query(Event.id).all()]
+    mismatches = []
+    for e_id in event_ids:
+        inventory = count_inventory(e_id)
+        product_ids = {product_id for product_id, _ in inventory.keys()}
+        stored = {}
+        actual = {}
+        if product_ids:
+            held = count_held(product_ids)
+            for key in set(inventory.keys()) | set(held.keys()):
+                stats = inventory.get(key, WorkshopRegStats(accepted=0, waiting=0))
+                actual[key] = ProductInventoryStats(stats.accepted, stats.waiting, held.get(key, 0))
+            for row in ProductInventory.query.filter(ProductInventory.product_id.in_(product_ids)).all():
+                stored[(row.product_id, row.dance_role)] = ProductInventoryStats(row.accepted, row.waiting, row.held)
+        for key in set(actual.keys()) | set(stored.keys()):
+            actual_stats = actual.get(key, _EMPTY_INVENTORY)
+            stored_stats = stored.get(key, _EMPTY_INVENTORY)
+            if actual_stats != stored_stats:
+                mismatches.append((key[0], key[1], stored_stats, actual_stats))
+    return mismatches
+
+
+def _invalidate_session_inventory(session, *args):
+    session.info.pop(INVENTORY_SESSION_INFO_KEY, None)
+
+
+# same lifetime as the registration stats snapshot, ProductInventory.adjust drops it as well
+event.listen(db_session, 'after_flush', _invalidate_session_inventory)
+event.listen(db_session, 'after_bulk_update', lambda update_context: _invalidate_session_inventory(update_context.session))
+event.listen(db_session, 'after_rollback', _invalidate_session_inventory)
@@ -1,14 +1,18 @@
 import datetime
+import json
+from collections import namedtuple
+from types import MappingProxyType
 
 from flask import jsonify
 from salty_tickets import config
 from salty_tickets.database import Base
 # from salty_tickets.products import get_product_by_model
 from salty_tickets.utils import string_to_key
-from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, Boolean, LargeBinary
 from sqlalchemy import Table
 from sqlalchemy import Text
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, object_session
+from sqlalchemy.orm.util import identity_key
 
 __author__ = 'vnkrv'
 
@@ -35,9 +39,21 @@ SIGNUP_GROUP_PARTNERS = 'partners'
 SIGNUP_GROUP_FESTIVAL = 'festival group'
 
 PAYMENT_STATUS_NEW = 'new'
+PAYMENT_STATUS_PROCESSING = 'processing'
 PAYMENT_STATUS_PAID = 'paid'
 PAYMENT_STATUS_FAILED = 'failed'
 
+EMAIL_STATUS_PENDING = 'pending'
+EMAIL_STATUS_SENDING = 'sending'
+EMAIL_STATUS_SENT = 'sent'
+EMAIL_STATUS_FAILED = 'failed'
+
+INVENTORY_ALL_ROLES = ''
+INVENTORY_SESSION_INFO_KEY = 'product_inventory'
+
+EVENT_TYPE_CROWDFUNDING = 'crowdfunding'
+CROWDFUNDING_TOTAL_ALL_PRODUCTS = 0
+
 class Event(Base):
     __tablename__ = 'events'
     id = Column(Integer, primary_key=True)
@@ -47,8 +63,10 @@ class Event(Base):
     event_type = Column(String(25))
     start_date = Column(DateTime, nullable=False)
     active = Column(Boolean, nullable=False, default=True)
+    catalog_version = Column(Integer, nullable=False, default=0)
 
     products = relationship('Product', lazy='dynamic')
+    catalog_products = relationship('Product', order_by='Product.id', viewonly=True)
     orders = relationship('Order', lazy='dynamic')
     registration_groups = relationship('RegistrationGroup', lazy='dynamic')
 
@@ -59,6 +77,25 @@ class Event(Base):
         super(Event, self).__init__(**kwargs)
 
 
+class ProductDefinition(namedtuple('ProductDefinition', ['product_type', 'name', 'info', 'price',
+                                                         'max_available', 'image_url', 'parameters'])):
+    """Immutable snapshot of a product configuration, parameters are a read-only mapping"""
+    __slots__ = ()
+
+    @classmethod
+    def from_model(cls, product_model):
+        parameters = json.loads(product_model.parameters_json) if product_model.parameters_json else {}
+        return cls(
+            product_type=product_model.type,
+            name=product_model.name,
+            info=product_model.info,
+            price=product_model.price,
+            max_available=product_model.max_available,
+            image_url=product_model.image_url,
+            parameters=MappingProxyType(parameters),
+        )
+
+
 class Product(Base):
     __tablename__ = 'products'
     id = Column(Integer, primary_key=True)
@@ -69,7 +106,9 @@ class Product(Base):
     price = Column(Float, default=0, )
     max_available = Column(Integer, default=0)
     image_url = Column(String(255))
+    parameters_json = Column(Text)
 
+    # legacy storage of the parameters, the table is kept as the copy of the values before parameters_json
     parameters = relationship('ProductParameter', lazy='dynamic')
     product_orders = relationship('OrderProduct', lazy='dynamic')
 
@@ -81,17 +120,29 @@ class Product(Base):
         super(Product, self).__init__(**kwargs)
 
     def add_parameters(self, parameters_dict):
-        for k, v in parameters_dict.items():
-            self.parameters.append(ProductParameter(k, v))
+        # JSON values as they are, the others (e.g. dates) as strings
+        parameters = dict(self.parameters_as_dict)
+        parameters.update(parameters_dict)
+        self.parameters_json = json.dumps(parameters, sort_keys=True, default=str)
 
     @property
     def product_key(self):
         return string_to_key(self.name)
 
+    @property
+    def definition(self):
+        # parse the configuration once per loaded row, reparse only if any of the columns has changed
+        state = (self.type, self.name, self.info, self.price, self.max_available, self.image_url,
+                 self.parameters_json)
+        cached = getattr(self, '_definition_cache', None)
+        if cached is None or cached[0] != state:
+            cached = (state, ProductDefinition.from_model(self))
+            self._definition_cache = cached
+        return cached[1]
+
     @property
     def parameters_as_dict(self):
-        details_dict = {d.parameter_name: d.parameter_value for d in self.parameters.all()}
-        return details_dict
+        return self.definition.parameters
 
 
 class ProductParameter(Base):
@@ -113,7 +164,7 @@ class Registration(Base):
     name = Column(String(255), nullable=False)
     email = Column(String(255), nullable=False)
     comment = Column(Text)
-    registered_datetime = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    registered_datetime = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
 
     country = Column(String(255))
     state = Column(String(255))
@@ -150,6 +201,7 @@ class Order(Base):
     event = relationship("Event", uselist=False)
     order_products = relationship('OrderProduct', lazy='dynamic')
     payments = relationship('Payment', lazy='dynamic')
+    capacity_holds = relationship('CapacityHold', lazy='dynamic')
     order_product_registrations = relationship('Registration', secondary='order_products')
 
     # @aggregated('order_products', Column(Float))
@@ -167,6 +219,7 @@ class OrderProduct(Base):
     price = Column(Float, nullable=False)
     status = Column(String(32))
     registration_id = Column(Integer, ForeignKey('registrations.id'))
+    dance_role = Column(String(32), index=True)
 
     details = relationship("OrderProductDetail", lazy='dynamic')
     order = relationship('Order', uselist=False)
@@ -181,22 +234,155 @@ class OrderProduct(Base):
         self.price = price
         if details_dict:
             for key, value in details_dict.items():
-                self.details.append(OrderProductDetail(key, value))
+                if key == 'dance_role':
+                    self.dance_role = value
+                else:
+                    self.details.append(OrderProductDetail(key, value))
         super(OrderProduct, self).__init__(**kwargs)
 
     @property
     def details_as_dict(self):
         details_dict = {d.field_name: d.field_value for d in self.details.all()}
+        if self.dance_role:
+            details_dict['dance_role'] = self.dance_role
         return details_dict
 
     def cancel(self):
-        self.status = ORDER_PRODUCT_STATUS_CANCELLED
+        self.set_status(ORDER_PRODUCT_STATUS_CANCELLED)
 
     def refund(self, amount):
         raise NotImplementedError
 
     def accept(self):
-        self.status = ORDER_PRODUCT_STATUS_ACCEPTED
+        self.set_status(ORDER_PRODUCT_STATUS_ACCEPTED)
+
+    def set_status(self, status):
+        old_status = self.status
+        self.status = status
+        session = object_session(self)
+        if session is not None and self.order is not None and self.order.status == ORDER_STATUS_PAID:
+            ProductInventory.record_status_change(session, self, old_status, status)
+
+
+class ProductInventory(Base):
+    __tablename__ = 'product_inventory'
+    product_id = Column(Integer, ForeignKey('products.id'), primary_key=True)
+    dance_role = Column(String(32), primary_key=True, default=INVENTORY_ALL_ROLES)
+    accepted = Column(Integer, nullable=False, default=0)
+    waiting = Column(Integer, nullable=False, default=0)
+    # places reserved by capacity holds, the holds with a dance role are counted on its row as well
+    held = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def adjust(cls, session, product_id, dance_role=None, accepted=0, waiting=0):
+        # the row with INVENTORY_ALL_ROLES holds the totals for the whole product
+        dance_roles = {INVENTORY_ALL_ROLES, dance_role or INVENTORY_ALL_ROLES}
+        table = cls.__table__
+        for role in dance_roles:
+            result = session.execute(
+                table.update().
+                where(table.c.product_id == product_id).
+                where(table.c.dance_role == role).
+                values(accepted=table.c.accepted + accepted, waiting=table.c.waiting + waiting)
+            )
+            if result.rowcount == 0:
+                session.execute(
+                    table.insert().values(product_id=product_id, dance_role=role, accepted=accepted, waiting=waiting)
+                )
+            instance = session.identity_map.get(identity_key(cls, (product_id, role)))
+            if instance is not None:
+                session.expire(instance)
+        session.info.pop(INVENTORY_SESSION_INFO_KEY, None)
+
+    @classmethod
+    def record_status_change(cls, session, order_product, old_status, new_status):
+        accepted = int(new_status == ORDER_PRODUCT_STATUS_ACCEPTED) - int(old_status == ORDER_PRODUCT_STATUS_ACCEPTED)
+        waiting = int(new_status == ORDER_PRODUCT_STATUS_WAITING) - int(old_status == ORDER_PRODUCT_STATUS_WAITING)
+        if accepted or waiting:
+            product_id = order_product.product_id or order_product.product.id
+            cls.adjust(session, product_id, order_product.dance_role, accepted, waiting)
+
+    @classmethod
+    def record_order_paid(cls, session, user_order):
+        for order_product in user_order.order_products:
+            cls.record_status_change(session, order_product, None, order_product.status)
+
+
+class CrowdfundingTotal(Base):
+    __tablename__ = 'crowdfunding_totals'
+    event_id = Column(Integer, ForeignKey('events.id'), primary_key=True)
+    # the row with CROWDFUNDING_TOTAL_ALL_PRODUCTS holds the totals of the whole event
+    product_id = Column(Integer, primary_key=True, default=CROWDFUNDING_TOTAL_ALL_PRODUCTS)
+    amount = Column(Float, nullable=False, default=0)
+    contributors = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def adjust(cls, session, event_id, product_id, amount, contributors):
+        table = cls.__table__
+        result = session.execute(
+            table.update().
+            where(table.c.event_id == event_id).
+            where(table.c.product_id == product_id).
+            values(amount=table.c.amount + amount, contributors=table.c.contributors + contributors)
+        )
+        if result.rowcount == 0:
+            session.execute(
+                table.insert().values(event_id=event_id, product_id=product_id, amount=amount,
+                                      contributors=contributors)
+            )
+        instance = session.identity_map.get(identity_key(cls, (event_id, product_id)))
+        if instance is not None:
+            session.expire(instance)
+
+    @classmethod
+    def record_order_paid(cls, session, user_order):
+        if user_order.event.event_type != EVENT_TYPE_CROWDFUNDING:
+            return
+        event_id = user_order.event_id or user_order.event.id
+        cls.adjust(session, event_id, CROWDFUNDING_TOTAL_ALL_PRODUCTS, user_order.total_price, 1)
+        for order_product in user_order.order_products:
+            product_id = order_product.product_id or order_product.product.id
+            cls.adjust(session, event_id, product_id, order_product.price, 1)
+
+
+class CapacityHold(Base):
+    __tablename__ = 'capacity_holds'
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=False)
+    order_id = Column(Integer, ForeignKey('orders.id'))
+    dance_role = Column(String(32), nullable=False, default=INVENTORY_ALL_ROLES)
+    quantity = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    order = relationship('Order', uselist=False)
+
+
+class EmailOutbox(Base):
+    __tablename__ = 'email_outbox'
+    id = Column(Integer, primary_key=True)
+    email_from = Column(String(255), nullable=False)
+    email_to = Column(String(255), nullable=False)
+    subject = Column(String(255))
+    body_text = Column(Text)
+    body_html = Column(Text)
+    status = Column(String(10), nullable=False, default=EMAIL_STATUS_PENDING, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    sent_at = Column(DateTime)
+    # id of the message at Mailgun, set once it has accepted the email
+    provider_message_id = Column(String(255))
+    last_error = Column(Text)
+
+    attachments = relationship('EmailOutboxAttachment', order_by='EmailOutboxAttachment.id')
+
+
+class EmailOutboxAttachment(Base):
+    __tablename__ = 'email_outbox_attachments'
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, ForeignKey('email_outbox.id'), nullable=False)
+    filename = Column(String(255), nullable=False)
+    content = Column(LargeBinary(length=2 ** 24), nullable=False)
 
 
 class OrderProductDetail(Base):
@@ -272,6 +458,7 @@ class Payment(Base):
     comment = Column(Text)
     stripe_charge_id = Column(String(50))
     status = Column(String(10), default=PAYMENT_STATUS_NEW)
+    failure_message = Column(Text)
 
     order = relationship('Order', uselist=False)
     payment_items = relationship('PaymentItem', lazy='dynamic')
@@ -307,7 +494,7 @@ class Vote(Base):
     id = Column(Integer, primary_key=True)
     voter_id = Column(String(255))
     vote = Column(String(255))
-    vote_timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    vote_timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
 
 
 class VotingSession(Base):
@@ -1,8 +1,12 @@
 import itertools
 from flask import url_for
+from salty_tickets.availability import full_weekend_available, fast_train_available
 from salty_tickets.controllers import EventController, OrderSummaryController
-from salty_tickets.models import RegistrationGroup, OrderProduct, Order, Product, Registration
+from salty_tickets.database import db_session
+from salty_tickets.models import RegistrationGroup, OrderProduct, Order, Product, Registration, ProductInventory, \
+    INVENTORY_ALL_ROLES
 from salty_tickets.products import WORKSHOP_OPTIONS, FESTIVAL_TICKET, FestivalGroupDiscountProduct
+from salty_tickets.qr_codes import get_qr_code_data_uri
 from salty_tickets.tokens import GroupToken, MtsTicketToken
 
 
@@ -292,19 +296,22 @@ class MtsSignupFormController:
             print(self.selected_stations_count)
             return self.selected_stations_count < 3
 
+    @staticmethod
+    def _stations_inventory(event):
+        return db_session.query(Product.max_available, ProductInventory.accepted, ProductInventory.waiting,
+                                ProductInventory.held). \
+            outerjoin(ProductInventory, (ProductInventory.product_id == Product.id) &
+                      (ProductInventory.dance_role == INVENTORY_ALL_ROLES)). \
+            filter(Product.event_id == event.id, Product.type == 'RegularPartnerWorkshop').all()
+
     def total_stations(self, event):
-        total_blocks = OrderProduct.query.filter(OrderProduct.status.in_(('accepted', 'waiting')))\
-                                   .join(Order, aliased=False).filter_by(status='paid')\
-                                   .join(Product, aliased=False).filter_by(event_id=event.id, type='RegularPartnerWorkshop').count()
+        total_blocks = sum([(accepted or 0) + (waiting or 0)
+                            for _, accepted, waiting, _ in self._stations_inventory(event)])
         return total_blocks
 
     def remaining_stations(self, event):
-        total_remaining = 0
-        for product in Product.query.filter_by(event_id=event.id, type='RegularPartnerWorkshop').all():
-            accepted = OrderProduct.query.filter_by(status='accepted').\
-                        join(Order, aliased=False).filter_by(status='paid').\
-                        join(Product, aliased=False).filter_by(id=product.id).count()
-            total_remaining += max(0, product.max_available - accepted)
+        total_remaining = sum([max(0, max_available - (accepted or 0) - (held or 0))
+                               for max_available, accepted, _, held in self._stations_inventory(event)])
         return total_remaining
 
     def get_fast_train_available(self, weekend_ticket_key):
@@ -316,7 +323,7 @@ class MtsSignupFormController:
             if set(product_form.keywords.split(',')).intersection(includes):
                 if hasattr(product_form, 'available_quantity'):
                     available_items.append(product_form.available_quantity)
-        return min(available_items)
+        return fast_train_available(available_items)
 
     def get_full_weekend_available(self):
         available_slots_dict = {}
@@ -326,17 +333,7 @@ class MtsSignupFormController:
                 key = product_form.workshop_date + ' ' + product_form.workshop_time
                 available_slots_dict[key] = available_slots_dict.get(key, 0) + max(0, product_form.available_quantity)
 
-        available_slots = sorted(available_slots_dict.values())
-
-        available = 0
-        while len(available_slots) >= 3:
-            available += available_slots[-3]
-            available_slots[-1] -= available_slots[-3]
-            available_slots[-2] -= available_slots[-3]
-            available_slots[-3] -= available_slots[-3]
-            available_slots = [x for x in available_slots if x]
-
-        return available
+        return full_weekend_available(available_slots_dict.values())
 
     @staticmethod
     def get_regular_partner_registration(registration):
@@ -362,8 +359,9 @@ class MtsSignupFormController:
 
 
 class MtsTicketController:
-    def __init__(self, registration):
+    def __init__(self, registration, embed_qr_code=False):
         self._registration = registration
+        self._embed_qr_code = embed_qr_code
 
     @classmethod
     def from_ticket_token(cls, ticket_token):
@@ -399,8 +397,10 @@ class MtsTicketController:
 
     @property
     def qr_code_url(self):
-        size=200
-        return f'https://api.qrserver.com/v1/create-qr-code/?size={size}x{size}&data={self.ticket_url}'
+        # embedded for the PDFs, so that rendering them doesn't need any requests
+        if self._embed_qr_code:
+            return get_qr_code_data_uri(self.ticket_url)
+        return url_for('mts_ticket_qr_code', ticket_token=self.token, kind='png')
 
     @property
     def saturday_stations(self):
@@ -460,7 +460,7 @@ class MtsOrderProductController:
 
     @property
     def dance_role(self):
-        return self._order_product.details_as_dict.get('dance_role') or 'N/A'
+        return self._order_product.dance_role or 'N/A'
 
     @property
     def time(self):
@@ -0,0 +1,282 @@
+from collections import namedtuple, defaultdict
+from datetime import datetime, timedelta
+
+from flask import url_for
+from salty_tickets.controllers import get_waiting_reason
+from salty_tickets.database import db_session
+from salty_tickets.forms import RemainingPaymentForm
+from salty_tickets.models import Order, OrderProduct, OrderProductDetail, Payment, PaymentItem, Registration, \
+    SignupGroup, group_order_product_mapping, ORDER_PRODUCT_STATUS_WAITING, PAYMENT_STATUS_PAID, \
+    SIGNUP_GROUP_TYPE_PARTNERS
+from salty_tickets.payments import get_remaining_payment
+from salty_tickets.products import get_product_by_model
+from salty_tickets.tokens import order_serialize, order_product_serialize, GroupToken
+from sqlalchemy.orm import joinedload, aliased
+from sqlalchemy.orm.exc import NoResultFound
+
+PARTNER_PRODUCT_TYPES = ('CouplesOnlyWorkshop', 'RegularPartnerWorkshop')
+
+
+class EventSummary(namedtuple('EventSummary', ['name', 'event_key'])):
+    __slots__ = ()
+
+    @property
+    def registration_url(self):
+        return url_for('register_form', event_key=self.event_key, _external=True)
+
+
+class PaymentItemSummary(namedtuple('PaymentItemSummary', ['amount', 'full_description', 'has_order_product',
+                                                           'order_product_status', 'order_product_price'])):
+    __slots__ = ()
+
+
+class OrderProductSummary(namedtuple('OrderProductSummary', [
+        'id', 'name', 'price', 'status', 'is_waiting', 'waiting_reason', 'product_type', 'product_parameters',
+        'product_info', 'partner_name', 'token_expiry_datetime', 'payment_items', 'total_paid', 'event_key'])):
+    __slots__ = ()
+
+    @property
+    def has_payment_items(self):
+        return len(self.payment_items) > 0
+
+    @property
+    def total_remaining(self):
+        return self.price - self.total_paid
+
+    @property
+    def token(self):
+        return order_product_serialize(self)
+
+    @property
+    def token_expiry(self):
+        return '{:%d-%b-%Y %H:%M}'.format(self.token_expiry_datetime)
+
+    @property
+    def cancel_url(self):
+        return url_for('event_order_product_cancel', event_key=self.event_key, order_product_token=self.token,
+                       _external=True)
+
+    @property
+    def can_add_partner(self):
+        if self.product_type not in PARTNER_PRODUCT_TYPES or self.partner_name:
+            return False
+        return not (self.token_expiry_datetime and datetime.now() > self.token_expiry_datetime)
+
+
+class GroupSummary(namedtuple('GroupSummary', ['id', 'name', 'member_names'])):
+    __slots__ = ()
+
+    has_group = True
+
+    @property
+    def token(self):
+        return GroupToken().serialize(self)
+
+
+class NoGroupSummary(namedtuple('NoGroupSummary', [])):
+    __slots__ = ()
+
+    has_group = False
+
+
+RemainingPaymentSummary = namedtuple('RemainingPaymentSummary', ['transaction_fee', 'total_to_pay'])
+
+# the attributes of OrderProduct read by the products in get_name, with the details loaded for the whole order
+OrderProductNameFields = namedtuple('OrderProductNameFields', ['registration', 'dance_role', 'details_as_dict'])
+
+
+class OrderSummary(namedtuple('OrderSummary', [
+        'id', 'event', 'registration_name', 'registration_email', 'order_datetime', 'total_price', 'total_paid',
+        'total_transaction_fee', 'transaction_fee', 'total_to_pay', 'order_products', 'payment_items',
+        'all_payment_items', 'group'])):
+    """Everything the order summary pages and emails show, read by load_order_summary.
+
+    Has the same attributes as OrderSummaryController.
+    """
+    __slots__ = ()
+
+    @property
+    def total_remaining_amount(self):
+        return self.total_price - self.total_paid
+
+    @property
+    def show_order_summary(self):
+        return len(self.order_products) > 0
+
+    @property
+    def has_waiting_list(self):
+        return any(order_product.is_waiting for order_product in self.order_products)
+
+    @property
+    def remaining_payment(self):
+        payment = get_remaining_payment(self.total_remaining_amount)
+        return RemainingPaymentSummary(payment.transaction_fee, payment.amount + payment.transaction_fee)
+
+    @property
+    def remaining_payment_form(self):
+        return RemainingPaymentForm()
+
+    @property
+    def token(self):
+        return order_serialize(self)
+
+    @property
+    def order_status_url(self):
+        return url_for('event_order_summary', order_token=self.token, _external=True)
+
+    @property
+    def invite_partner_url(self):
+        tokens = [op.token for op in self.order_products if op.can_add_partner]
+        if len(tokens) > 0:
+            return url_for('register_form', event_key=self.event.event_key, tokens=','.join(tokens), _external=True)
+
+
+def _load_order_products(order_id):
+    """Order products with the details of all of them, as a dict by order_product_id"""
+    order_products = OrderProduct.query.filter_by(order_id=order_id).\
+        options(joinedload(OrderProduct.product), joinedload(OrderProduct.registration)).\
+        order_by(OrderProduct.id).all()
+    details = defaultdict(dict)
+    if order_products:
+        query = db_session.query(OrderProductDetail.order_product_id, OrderProductDetail.field_name,
+                                 OrderProductDetail.field_value).\
+            filter(OrderProductDetail.order_product_id.in_([op.id for op in order_products]))
+        for order_product_id, field_name, field_value in query:
+            details[order_product_id][field_name] = field_value
+    return order_products, details
+
+
+def _load_partner_names(order_products):
+    """Names of the partners of the order products which are in a partners group"""
+    partner_product_ids = [op.id for op in order_products if op.product.type in PARTNER_PRODUCT_TYPES]
+    if not partner_product_ids:
+        return {}
+    own_mapping = aliased(group_order_product_mapping)
+    partner_mapping = aliased(group_order_product_mapping)
+    query = db_session.query(own_mapping.c.order_product_id, Registration.name).\
+        join(SignupGroup, SignupGroup.id == own_mapping.c.signup_group_id).\
+        join(partner_mapping, partner_mapping.c.signup_group_id == own_mapping.c.signup_group_id).\
+        join(OrderProduct, OrderProduct.id == partner_mapping.c.order_product_id).\
+        join(Registration, Registration.id == OrderProduct.registration_id).\
+        filter(SignupGroup.type == SIGNUP_GROUP_TYPE_PARTNERS,
+               own_mapping.c.order_product_id.in_(partner_product_ids),
+               partner_mapping.c.order_product_id != own_mapping.c.order_product_id)
+    return dict(query.all())
+
+
+def _get_order_product_name(order_product, details):
+    product = get_product_by_model(order_product.product)
+    if hasattr(product, 'get_name'):
+        details_as_dict = dict(details)
+        if order_product.dance_role:
+            details_as_dict['dance_role'] = order_product.dance_role
+        return product.get_name(OrderProductNameFields(order_product.registration, order_product.dance_role,
+                                                       details_as_dict))
+    else:
+        return order_product.product.name
+
+
+def load_order_summary(order_id, payment_id=None):
+    """Reads the order with its products, payments and groups in a fixed number of queries.
+
+    The summary shows the payment with payment_id, or the first payment of the order.
+    """
+    user_order = Order.query.filter_by(id=order_id).options(
+        joinedload(Order.event),
+        joinedload(Order.registration).joinedload(Registration.registration_group),
+    ).one()
+    order_products, details = _load_order_products(order_id)
+    partner_names = _load_partner_names(order_products)
+
+    payments = Payment.query.filter_by(order_id=order_id).order_by(Payment.id).all()
+    shown_payment = payments[0] if payments else None
+    if payment_id is not None:
+        shown_payment = next((p for p in payments if p.id == payment_id), None)
+        if shown_payment is None:
+            raise NoResultFound('Payment {} is not a payment of the order {}'.format(payment_id, order_id))
+    payment_items = defaultdict(list)
+    if payments:
+        query = PaymentItem.query.filter(PaymentItem.payment_id.in_([p.id for p in payments])).\
+            order_by(PaymentItem.id)
+        for payment_item in query:
+            payment_items[payment_item.payment_id].append(payment_item)
+
+    product_counts = defaultdict(int)
+    for order_product in order_products:
+        product_counts[order_product.product_id] += 1
+
+    event_key = user_order.event.event_key
+    order_product_summaries = {}
+    for order_product in order_products:
+        is_waiting = order_product.status == ORDER_PRODUCT_STATUS_WAITING
+        product_type = order_product.product.type
+        token_expiry = None
+        if product_type == 'RegularPartnerWorkshop' and not is_waiting:
+            token_expiry = user_order.order_datetime + timedelta(days=1)
+        order_product_summaries[order_product.id] = OrderProductSummary(
+            id=order_product.id,
+            name=_get_order_product_name(order_product, details[order_product.id]),
+            price=order_product.price,
+            status=(order_product.status or '').title(),
+            is_waiting=is_waiting,
+            waiting_reason=get_waiting_reason(product_type, product_counts[order_product.product_id])
+            if is_waiting else None,
+            product_type=product_type,
+            product_parameters=order_product.product.parameters_as_dict,
+            product_info=order_product.product.info,
+            partner_name=partner_names.get(order_product.id),
+            token_expiry_datetime=token_expiry,
+            payment_items=[],
+            total_paid=0,
+            event_key=event_key,
+        )
+
+    payment_item_summaries = defaultdict(list)
+    for payment in payments:
+        for payment_item in payment_items[payment.id]:
+            order_product = order_product_summaries.get(payment_item.order_product_id)
+            names = [order_product.name] if order_product else []
+            if payment_item.description:
+                names.append(payment_item.description)
+            payment_item_summary = PaymentItemSummary(
+                amount=payment_item.amount,
+                full_description=' - '.join(names),
+                has_order_product=order_product is not None,
+                order_product_status=order_product.status if order_product else None,
+                order_product_price=order_product.price if order_product else None,
+            )
+            payment_item_summaries[payment.id].append(payment_item_summary)
+            if order_product:
+                order_product.payment_items.append(payment_item_summary)
+    for order_product_id, order_product in order_product_summaries.items():
+        order_product_summaries[order_product_id] = order_product._replace(
+            payment_items=tuple(order_product.payment_items),
+            total_paid=sum([item.amount for item in order_product.payment_items]),
+        )
+
+    registration = user_order.registration
+    registration_group = registration.registration_group if registration else None
+    if registration_group is not None:
+        member_names = [name for name, in db_session.query(Registration.name).
+                        filter_by(registration_group_id=registration_group.id).order_by(Registration.id)]
+        group = GroupSummary(registration_group.id, registration_group.name, member_names)
+    else:
+        group = NoGroupSummary()
+
+    paid_payments = [p for p in payments if p.status == PAYMENT_STATUS_PAID]
+    return OrderSummary(
+        id=user_order.id,
+        event=EventSummary(user_order.event.name, event_key),
+        registration_name=registration.name if registration else None,
+        registration_email=registration.email if registration else None,
+        order_datetime='{:%d-%b-%Y %H:%M}'.format(user_order.order_datetime),
+        total_price=user_order.total_price,
+        total_paid=sum([p.amount for p in paid_payments]),
+        total_transaction_fee=sum([p.transaction_fee for p in paid_payments]),
+        transaction_fee=shown_payment.transaction_fee if shown_payment else 0,
+        total_to_pay=shown_payment.amount + shown_payment.transaction_fee if shown_payment else 0,
+        order_products=tuple(order_product_summaries.values()),
+        payment_items=tuple(payment_item_summaries[shown_payment.id]) if shown_payment else (),
+        all_payment_items=tuple(item for p in payments for item in payment_item_summaries[p.id]),
+        group=group,
+    )
@@ -0,0 +1,106 @@
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, request, has_app_context, has_request_context
+from salty_tickets.database import db_session
+from salty_tickets.models import Payment, PAYMENT_STATUS_NEW, PAYMENT_STATUS_PROCESSING, PAYMENT_STATUS_FAILED
+from salty_tickets.payments import process_payment
+from salty_tickets.reservations import release_order_capacity, renew_order_capacity
+
+PAYMENT_WORKERS = 8
+# longer than a charge with all the stripe retries takes
+PAYMENT_CLAIM_TTL = datetime.timedelta(minutes=10)
+PAYMENT_ERROR_MESSAGE = 'Please contact us if your card has been charged.'
+
+_payment_workers = ThreadPoolExecutor(max_workers=PAYMENT_WORKERS)
+
+
+def submit_payment(payment, stripe_token, stripe_sk=None, on_success=None):
+    """Charges the payment in a background worker, the payment must be committed already.
+
+    on_success(payment) is called in the worker once the order is paid. It runs in a copy of
+    the current request, so it can create the submitted form again.
+    """
+    if has_app_context():
+        app = current_app._get_current_object()
+    else:
+        from salty_tickets import app
+    request_kwargs = {}
+    if has_request_context():
+        request_kwargs = dict(base_url=request.host_url, method=request.method,
+                              data=request.form.to_dict(flat=False))
+    return _payment_workers.submit(_process_payment_task, app, request_kwargs,
+                                   payment.id, stripe_token, stripe_sk, on_success)
+
+
+def claim_payment(session, payment_id):
+    # only the first claim of a new payment succeeds, so a payment submitted twice is charged once
+    table = Payment.__table__
+    result = session.execute(
+        table.update().
+        where(table.c.id == payment_id).
+        where(table.c.status == PAYMENT_STATUS_NEW).
+        values(status=PAYMENT_STATUS_PROCESSING)
+    )
+    if result.rowcount == 1:
+        # the holds must outlive the charge, the places of the expired ones are taken again
+        renew_order_capacity(session.query(Payment).get(payment_id).order, PAYMENT_CLAIM_TTL, session)
+    session.commit()
+    return result.rowcount == 1
+
+
+def fail_payment(session, payment_id, statuses=(PAYMENT_STATUS_PROCESSING,)):
+    """Marks the payment failed and gives back the places held for the order, if it is still in one of statuses"""
+    table = Payment.__table__
+    result = session.execute(
+        table.update().
+        where(table.c.id == payment_id).
+        where(table.c.status.in_(statuses)).
+        values(status=PAYMENT_STATUS_FAILED, failure_message=PAYMENT_ERROR_MESSAGE)
+    )
+    if result.rowcount == 1:
+        release_order_capacity(session.query(Payment).get(payment_id).order, session)
+    session.commit()
+    return result.rowcount == 1
+
+
+def expire_stale_payments(session=None, now=None):
+    """Fails the payments which were never charged, e.g. queued or claimed by a worker which was restarted.
+
+    The stripe token is not stored, so they can't be queued again.
+    """
+    if session is None:
+        session = db_session
+    now = now or datetime.datetime.utcnow()
+    statuses = (PAYMENT_STATUS_NEW, PAYMENT_STATUS_PROCESSING)
+    stale_payment_ids = [payment_id for payment_id, in session.query(Payment.id).filter(
+        Payment.status.in_(statuses), Payment.payment_datetime < now - PAYMENT_CLAIM_TTL)]
+    return len([payment_id for payment_id in stale_payment_ids if fail_payment(session, payment_id, statuses)])
+
+
+def process_payment_by_id(payment_id, stripe_token, stripe_sk=None, on_success=None):
+    """Returns None if the payment has been processed or is being processed already"""
+    if not claim_payment(db_session, payment_id):
+        return None
+    payment = Payment.query.get(payment_id)
+    try:
+        is_success, response = process_payment(payment, stripe_token, stripe_sk)
+    except Exception:
+        # otherwise the payment stays claimed and the processing page waits for it forever
+        db_session.rollback()
+        fail_payment(db_session, payment_id)
+        raise
+    if is_success and on_success is not None:
+        on_success(payment)
+    return is_success
+
+
+def _process_payment_task(app, request_kwargs, payment_id, stripe_token, stripe_sk, on_success):
+    with app.test_request_context(**request_kwargs):
+        try:
+            return process_payment_by_id(payment_id, stripe_token, stripe_sk, on_success)
+        except Exception:
+            logging.exception('Failed to process payment %s', payment_id)
+        finally:
+            db_session.remove()
@@ -1,6 +1,11 @@
 from salty_tickets import config
 from salty_tickets.database import db_session
-from salty_tickets.models import ORDER_STATUS_PAID, PAYMENT_STATUS_PAID, Payment, PaymentItem
+from salty_tickets.models import ORDER_STATUS_PAID, PAYMENT_STATUS_PAID, Payment, PaymentItem, ProductInventory, \
+    PAYMENT_STATUS_FAILED, CrowdfundingTotal
+from salty_tickets.reservations import release_order_capacity
+
+# network errors are retried by the stripe library with the same idempotency key
+STRIPE_MAX_NETWORK_RETRIES = 2
 
 
 def process_payment(payment, stripe_token, stripe_sk=None):
@@ -13,6 +18,11 @@ def process_payment(payment, stripe_token, stripe_sk=None):
     if is_success:
         update_order(payment.order)
         db_session.commit()
+    else:
+        payment.status = PAYMENT_STATUS_FAILED
+        payment.failure_message = str(response)
+        release_order_capacity(payment.order)
+        db_session.commit()
 
     return is_success, response
 
@@ -20,9 +30,11 @@ def process_payment(payment, stripe_token, stripe_sk=None):
 def charge(payment, stripe_token, stripe_sk=None):
     import stripe
     if not stripe_sk:
-        stripe_sk = stripe.api_key = config.STRIPE_SK
-
-    stripe.api_key = stripe_sk
+        stripe_sk = config.STRIPE_SK
+    stripe.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+    # local stand-in for the Stripe API, see service/fake_stripe.py
+    if getattr(config, 'STRIPE_API_BASE', None):
+        stripe.api_base = config.STRIPE_API_BASE
 
     try:
         charge = stripe.Charge.create(
@@ -33,7 +45,10 @@ def charge(payment, stripe_token, stripe_sk=None):
                 payment_id=payment.id,
                 order_id=payment.order.id,
             ),
-            source=stripe_token
+            source=stripe_token,
+            api_key=stripe_sk,
+            # the same payment is never charged twice
+            idempotency_key='payment-{}'.format(payment.id),
         )
         print(charge)
         payment.stripe_charge_id = charge['id']
@@ -44,6 +59,8 @@ def charge(payment, stripe_token, stripe_sk=None):
         # self.stripe_charge = jsonify(ce)
         # self.status = ORDER_STATUS_FAILED
         return False, ce
+    except stripe.StripeError as e:
+        return False, e
 
 def update_payment_total(payment):
     amount = sum([item.amount for item in payment.payment_items if item.amount])
@@ -51,8 +68,12 @@ def update_payment_total(payment):
 
 
 def stripe_amount(payment):
-    if payment.amount > 0:
-        return int((payment.amount + payment.transaction_fee) * 100)
+    return get_stripe_amount(payment.amount, payment.transaction_fee)
+
+
+def get_stripe_amount(amount, fee):
+    if amount > 0:
+        return int((amount + fee) * 100)
     else:
         return 0
 
@@ -62,8 +83,12 @@ def update_order(user_order):
     user_order.payment_due = user_order.total_price - total_paid
 
     has_paid = any([p.status == PAYMENT_STATUS_PAID for p in user_order.payments])
-    if has_paid:
+    if has_paid and user_order.status != ORDER_STATUS_PAID:
         user_order.status = ORDER_STATUS_PAID
+        ProductInventory.record_order_paid(db_session, user_order)
+        CrowdfundingTotal.record_order_paid(db_session, user_order)
+        # held places are accepted now
+        release_order_capacity(user_order)
 
 
 def transaction_fee(price):
@@ -1,53 +1,174 @@
+from salty_tickets.catalog import EventCatalog
+from salty_tickets.controllers import get_waiting_reason
+from salty_tickets.crowdfunding_totals import get_crowdfunding_totals
 from salty_tickets.database import db_session
 from salty_tickets.emails import send_acceptance_from_waiting_list, send_acceptance_from_waiting_partner
+from salty_tickets.inventory import load_product_inventory, get_product_inventory
 from salty_tickets.models import Event, Order, SignupGroup, SIGNUP_GROUP_PARTNERS, \
     Product, Registration, OrderProduct, ORDER_PRODUCT_STATUS_WAITING, \
-    ORDER_STATUS_PAID, Payment, RegistrationGroup, SIGNUP_GROUP_FESTIVAL
+    ORDER_STATUS_PAID, Payment, RegistrationGroup, SIGNUP_GROUP_FESTIVAL, CROWDFUNDING_TOTAL_ALL_PRODUCTS
 from salty_tickets.mts_controllers import MtsSignupFormController
-from salty_tickets.payments import stripe_amount, update_payment_total, transaction_fee
+from salty_tickets.payments import update_payment_total, transaction_fee, get_stripe_amount
 from salty_tickets.products import get_product_by_model, RegularPartnerWorkshop, CouplesOnlyWorkshop, \
-    FestivalGroupDiscountProduct
+    FestivalGroupDiscountProduct, OrderLine
+from salty_tickets.registration_stats import EventRegistrationStats, get_event_waiting_queues
+from salty_tickets.reservations import reserve_order_capacity
 from salty_tickets.tokens import order_product_deserialize, GroupToken
 
 
-def get_order_for_event(event, form, registration=None, partner_registration=None):
-    assert isinstance(event, Event)
+class LineItem:
+    """Selected product line of an order draft, priced but not added to the database session.
+
+    Has the attributes of OrderProduct that the products read in get_name.
+    """
+    __slots__ = ('catalog_product', 'price', 'amount', 'status', 'details', 'registration', 'for_partner')
+
+    def __init__(self, catalog_product, order_line, amount, registration=None, for_partner=False):
+        self.catalog_product = catalog_product
+        self.price = order_line.price
+        self.status = order_line.status
+        self.details = order_line.details
+        self.amount = amount
+        self.registration = registration
+        self.for_partner = for_partner
+
+    @property
+    def product_id(self):
+        return self.catalog_product.product_id
+
+    @property
+    def product_type(self):
+        return type(self.catalog_product.product).__name__
+
+    @property
+    def product_name(self):
+        return self.catalog_product.product.name
+
+    @property
+    def name(self):
+        product = self.catalog_product.product
+        if self.registration is not None and hasattr(product, 'get_name'):
+            return product.get_name(self)
+        return product.name
+
+    @property
+    def dance_role(self):
+        return self.details.get('dance_role')
+
+    @property
+    def details_as_dict(self):
+        return self.details
+
+    @property
+    def is_waiting(self):
+        return self.status == ORDER_PRODUCT_STATUS_WAITING
+
+    @property
+    def order_line(self):
+        return OrderLine(self.price, self.status, self.details)
+
+
+class OrderDraft:
+    """Products selected in the form with their prices and payment amounts.
+
+    Used as it is by the checkout previews, turned into the database rows by create_order_from_draft
+    only when the order is submitted.
+    """
+    __slots__ = ('event', 'catalog', 'line_items')
+
+    def __init__(self, event, catalog):
+        self.event = event
+        self.catalog = catalog
+        self.line_items = []
+
+    def add_order_lines(self, catalog_product, product_form, order_lines, registration=None,
+                        partner_registration=None):
+        product = catalog_product.product
+        needs_partner = len(order_lines) == 1 and bool(product_form.needs_partner())
+        for n, order_line in enumerate(order_lines):
+            for_partner = n > 0 or needs_partner
+            amount = product.get_payment_amount(catalog_product.snapshot, order_line.price, order_line.status)
+            self.line_items.append(LineItem(catalog_product, order_line, amount,
+                                            partner_registration if for_partner else registration, for_partner))
+
+    @property
+    def products_price(self):
+        return sum([item.price for item in self.line_items])
+
+    @property
+    def amount(self):
+        return sum([item.amount for item in self.line_items if item.amount])
+
+    @property
+    def transaction_fee(self):
+        return transaction_fee(self.amount)
+
+    @property
+    def total_to_pay(self):
+        return self.amount + self.transaction_fee
+
+    @property
+    def stripe_amount(self):
+        return get_stripe_amount(self.amount, self.transaction_fee)
+
+    @property
+    def show_order_summary(self):
+        return len(self.line_items) > 0
+
+    def get_waiting_reason(self, line_item):
+        if line_item.is_waiting:
+            product_items_count = len([i for i in self.line_items if i.product_id == line_item.product_id])
+            return get_waiting_reason(line_item.product_type, product_items_count)
+
+
+def create_order_from_draft(order_draft, reserve=False):
+    """Order with its order products and payment, for the submitted order only"""
     user_order = Order()
+    for line_item in order_draft.line_items:
+        catalog_product = line_item.catalog_product
+        order_product = catalog_product.product.create_order_products(catalog_product.model,
+                                                                      [line_item.order_line])[0]
+        order_product.registration = line_item.registration
+        user_order.order_products.append(order_product)
 
-    for product_model in event.products:
-        product = get_product_by_model(product_model)
-        product_form = form.get_product_by_key(product_model.product_key)
-        if product.is_selected(product_form):
-            order_product = product.get_order_product_model(product_model, product_form, form)
-            if type(order_product) is list:
-                order_product[0].registration = registration
-                order_product[1].registration = partner_registration
-                user_order.order_products.append(order_product[0])
-                user_order.order_products.append(order_product[1])
-            else:
-                # registration_model = get_registration_from_form(form)
-                order_product.registration = registration
-
-                if product_form.needs_partner():
-                    # partner_registration_model = get_partner_registration_from_form(form)
-                    order_product.registration = partner_registration
-
-                user_order.order_products.append(order_product)
-
-    products_price = user_order.products_price
+    if reserve:
+        reserve_order_capacity(user_order, order_draft.catalog)
+
+    products_price = order_draft.products_price
     user_order.transaction_fee = transaction_fee(products_price)
-    user_order.total_price = user_order.products_price
+    user_order.total_price = products_price
 
-    add_payment_to_user_order(user_order)
+    add_payment_to_user_order(user_order, order_draft.catalog)
 
     return user_order
 
 
-def add_payment_to_user_order(user_order):
+def get_order_draft(event, form, registration=None, partner_registration=None):
+    assert isinstance(event, Event)
+    catalog = EventCatalog.for_event(event)
+    order_draft = OrderDraft(event, catalog)
+    for catalog_product in catalog:
+        product = catalog_product.product
+        product_form = form.get_product_by_key(catalog_product.product_key)
+        if product.is_selected(product_form):
+            order_lines = product.get_order_lines(catalog_product.snapshot, product_form, form)
+            order_draft.add_order_lines(catalog_product, product_form, order_lines, registration, partner_registration)
+    return order_draft
+
+
+def get_order_for_event(event, form, registration=None, partner_registration=None, reserve=False):
+    order_draft = get_order_draft(event, form, registration, partner_registration)
+    return create_order_from_draft(order_draft, reserve)
+
+
+def add_payment_to_user_order(user_order, catalog=None):
     payment = Payment()
 
     for order_product in user_order.order_products:
-        product = get_product_by_model(order_product.product)
+        if catalog is not None:
+            product = catalog.get_product(order_product.product)
+        else:
+            product = get_product_by_model(order_product.product)
         payment_item = product.get_payment_item(order_product)
         payment.payment_items.append(payment_item)
 
@@ -56,63 +177,72 @@ def add_payment_to_user_order(user_order):
     user_order.payments.append(payment)
 
 
-def get_order_for_crowdfunding_event(event, form, registration=None, partner_registration=None):
+def get_crowdfunding_order_draft(event, form, registration=None):
     assert isinstance(event, Event)
-    user_order = Order()
-
-    for product_model in event.products:
-        product = get_product_by_model(product_model)
-        product_form = form.get_product_by_key(product_model.product_key)
-        price = product.get_total_price(product_model, product_form, form)
+    catalog = EventCatalog.for_event(event)
+    order_draft = OrderDraft(event, catalog)
+    for catalog_product in catalog:
+        product = catalog_product.product
+        product_form = form.get_product_by_key(catalog_product.product_key)
+        price = product.get_total_price(catalog_product.snapshot, product_form, form)
         if price > 0:
-            # registration_model = get_registration_from_form(form)
+            quantity = 1
             if hasattr(product_form, 'add'):
-                print(product_form.add.object_data, type(product_form.add.object_data))
-                print(product_form.add.object_data == None)
-                if product_form.add.data not in ['0', 'None']:
-                    for n in range(int(product_form.add.data)):
-                        order_product = product.get_order_product_model(product_model, product_form, form)
-                        order_product.registration = registration
-                        user_order.order_products.append(order_product)
-            else:
-                order_product = product.get_order_product_model(product_model, product_form, form)
-                order_product.registration = registration
-                user_order.order_products.append(order_product)
-
-    products_price = user_order.products_price
-    user_order.transaction_fee = transaction_fee(products_price)
-    user_order.total_price = user_order.products_price
+                quantity = int(product_form.add.data) if product_form.add.data not in ['0', 'None'] else 0
+            for n in range(quantity):
+                order_lines = product.get_order_lines(catalog_product.snapshot, product_form, form)
+                # contributions have no partners
+                order_draft.add_order_lines(catalog_product, product_form, order_lines, registration, registration)
+    return order_draft
 
-    add_payment_to_user_order(user_order)
 
-    return user_order
+def get_order_for_crowdfunding_event(event, form, registration=None, partner_registration=None):
+    order_draft = get_crowdfunding_order_draft(event, form, registration)
+    return create_order_from_draft(order_draft)
 
 
 def get_total_raised(event):
     assert isinstance(event, Event)
-    orders_query = event.orders.filter_by(status=ORDER_STATUS_PAID)
+    # kept up to date by update_order, see CrowdfundingTotal
+    totals = get_crowdfunding_totals(event.id)
+    event_total = totals.pop(CROWDFUNDING_TOTAL_ALL_PRODUCTS)
     total_stats = {
-        'amount': sum([o.total_price for o in orders_query.all()]),
-        'contributors': orders_query.count()
+        'amount': event_total.amount,
+        'contributors': event_total.contributors,
+        'products': totals,
     }
     return total_stats
 
 
-def get_stripe_properties(event, order, form):
+def get_stripe_properties(event, order_draft, form):
     stripe_props = {}
     stripe_props['email'] = form.email.data
-    stripe_props['amount'] = stripe_amount(order.payments[0])
+    stripe_props['amount'] = order_draft.stripe_amount
     return stripe_props
 
 
 def balance_event_waiting_lists(event_model):
-    for product_model in event_model.products:
-        product = get_product_by_model(product_model)
-        if hasattr(product, 'balance_waiting_list'):
-            results = product.balance_waiting_list(product_model)
-            for order_product in results:
-                send_acceptance_from_waiting_list(order_product)
-            return results
+    """Balances waiting lists of all the event products and queues the acceptance emails in one transaction"""
+    registration_stats = EventRegistrationStats.load(event_model.id)
+    waiting_queues = get_event_waiting_queues(event_model.id)
+    catalog = EventCatalog.for_event(event_model)
+    load_product_inventory(list(waiting_queues.keys()))
+
+    results = []
+    for catalog_product in catalog:
+        product = catalog_product.product
+        if hasattr(product, 'balance_waiting_list') and catalog_product.product_id in waiting_queues:
+            results += product.balance_waiting_list(
+                catalog_product.model,
+                commit=False,
+                reg_stats=registration_stats.product_role_stats(catalog_product.product_id),
+                waiting_queue=waiting_queues[catalog_product.product_id],
+                held=get_product_inventory(catalog_product.product_id).held,
+            )
+    for order_product in results:
+        send_acceptance_from_waiting_list(order_product, commit=False)
+    db_session.commit()
+    return results
 
 
 def create_partners_group(order_product_1, order_product_2):
@@ -125,10 +255,11 @@ def create_partners_group(order_product_1, order_product_2):
 
 
 def process_partner_registrations(user_order, form):
-    for product_model in user_order.event.products:
-        product = get_product_by_model(product_model)
-        product_form = form.get_product_by_key(product_model.product_key)
+    for catalog_product in EventCatalog.for_event(user_order.event):
+        product = catalog_product.product
+        product_form = form.get_product_by_key(catalog_product.product_key)
         if isinstance(product, RegularPartnerWorkshop) and product_form.add.data:
+            product_model = catalog_product.model
             waiting_lists_couple = product.get_waiting_lists(product_model)[1]
             if product_form.partner_token.data:
                 order_product = user_order.order_products.join(Product, aliased=True).filter_by(id=product_model.id).first()
@@ -136,7 +267,7 @@ def process_partner_registrations(user_order, form):
                 group = create_partners_group(order_product, partner_order_product)
                 db_session.add(group)
                 if partner_order_product.status == ORDER_PRODUCT_STATUS_WAITING:
-                    partner_role = partner_order_product.details_as_dict['dance_role']
+                    partner_role = partner_order_product.dance_role
                     if not waiting_lists_couple[partner_role]:
                         partner_order_product.accept()
                         send_acceptance_from_waiting_list(partner_order_product)
@@ -147,6 +278,7 @@ def process_partner_registrations(user_order, form):
                 db_session.add(group)
             db_session.commit()
         elif isinstance(product, CouplesOnlyWorkshop) and product_form.add.data:
+            product_model = catalog_product.model
             if product_form.partner_token.data:
                 order_product = user_order.order_products.join(Product, aliased=True).filter_by(id=product_model.id).first()
                 partner_order_product = order_product_deserialize(product_form.partner_token.data)
@@ -163,10 +295,8 @@ def process_partner_registrations(user_order, form):
             db_session.commit()
 
 
-def mts_get_order_for_event(event, form, registration=None, partner_registration=None):
-    assert isinstance(event, Event)
-    user_order = Order()
-
+def mts_get_order_lines(form, catalog):
+    """Prices and statuses of the selected products, nothing is created in the database session"""
     free_classes_remaining = 0
 
     mts_form_controller = MtsSignupFormController(form)
@@ -176,60 +306,41 @@ def mts_get_order_for_event(event, form, registration=None, partner_registration
         if mts_form_controller.full_pass_selected:
             free_classes_remaining = 3
 
-
-    for product_model in event.products:
-        product = get_product_by_model(product_model)
-        product_form = form.get_product_by_key(product_model.product_key)
+    results = []
+    for catalog_product in catalog:
+        product = catalog_product.product
+        product_form = form.get_product_by_key(catalog_product.product_key)
         if product.is_selected(product_form):
-            order_product = product.get_order_product_model(product_model, product_form, form)
-            if type(order_product) is list:
-
-                if weekend_ticket_key:
-                    product_keywords = product.keywords.split(',')
-                    if weekend_ticket_form.includes and set(weekend_ticket_form.includes.split(',')).intersection(product_keywords):
-                        order_product[0].price = 0
-                        order_product[1].price = 0
-                    elif isinstance(product, RegularPartnerWorkshop):
-                        if free_classes_remaining:
-                            order_product[0].price = 0
-                            order_product[1].price = 0
-                            free_classes_remaining -= 1
-                        elif mts_form_controller.is_special_extra_block_price:
-                            order_product[0].price = product.get_discount_price_by_key('extra_block')
-                            order_product[1].price = product.get_discount_price_by_key('extra_block')
-
-                order_product[0].registration = registration
-                order_product[1].registration = partner_registration
-                user_order.order_products.append(order_product[0])
-                user_order.order_products.append(order_product[1])
-            else:
-                if weekend_ticket_key:
-                    product_keywords = product.keywords.split(',')
-                    if weekend_ticket_form.includes and set(weekend_ticket_form.includes.split(',')).intersection(product_keywords):
-                        order_product.price = 0
-                    elif isinstance(product, RegularPartnerWorkshop):
-                        if free_classes_remaining:
-                            order_product.price = 0
-                            free_classes_remaining -= 1
-                        elif mts_form_controller.is_special_extra_block_price:
-                            order_product.price = product.get_discount_price_by_key('extra_block')
-
-                # registration_model = get_registration_from_form(form)
-                order_product.registration =registration
-
-                if product_form.needs_partner():
-                    # partner_registration_model = get_partner_registration_from_form(form)
-                    order_product.registration = partner_registration
-
-                user_order.order_products.append(order_product)
-
-    products_price = user_order.products_price
-    user_order.transaction_fee = transaction_fee(products_price)
-    user_order.total_price = user_order.products_price
+            order_lines = product.get_order_lines(catalog_product.snapshot, product_form, form)
 
-    add_payment_to_user_order(user_order)
+            if weekend_ticket_key:
+                product_keywords = product.keywords.split(',')
+                if weekend_ticket_form.includes and set(weekend_ticket_form.includes.split(',')).intersection(product_keywords):
+                    order_lines = [line._replace(price=0) for line in order_lines]
+                elif isinstance(product, RegularPartnerWorkshop):
+                    if free_classes_remaining:
+                        order_lines = [line._replace(price=0) for line in order_lines]
+                        free_classes_remaining -= 1
+                    elif mts_form_controller.is_special_extra_block_price:
+                        extra_block_price = product.get_discount_price_by_key('extra_block')
+                        order_lines = [line._replace(price=extra_block_price) for line in order_lines]
 
-    return user_order
+            results.append((catalog_product, product_form, order_lines))
+    return results
+
+
+def mts_get_order_draft(event, form, registration=None, partner_registration=None):
+    catalog = EventCatalog.for_event(event)
+    order_draft = OrderDraft(event, catalog)
+    for catalog_product, product_form, order_lines in mts_get_order_lines(form, catalog):
+        order_draft.add_order_lines(catalog_product, product_form, order_lines, registration, partner_registration)
+    return order_draft
+
+
+def mts_get_order_for_event(event, form, registration=None, partner_registration=None, reserve=False):
+    assert isinstance(event, Event)
+    order_draft = mts_get_order_draft(event, form, registration, partner_registration)
+    return create_order_from_draft(order_draft, reserve)
 
 
 def process_mts_group_registrations(user_order, form):
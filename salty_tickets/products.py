@@ -6,20 +6,32 @@ import math
 from itsdangerous import BadSignature
 from salty_tickets.database import db_session
 from salty_tickets.discounts import discount_users
-from salty_tickets.tokens import order_product_deserialize, order_product_token_expired, GroupToken
+from salty_tickets.inventory import get_product_inventory, get_available_quantity
+from salty_tickets.registration_stats import EventRegistrationStats, WorkshopRegStats, get_waiting_queue
+from salty_tickets.tokens import GroupToken, get_partner_token_info
 from sqlalchemy import asc
-from sqlalchemy.orm import aliased
 from wtforms import Form as NoCsrfForm, TextAreaField
 from wtforms.fields import StringField, DateTimeField, SubmitField, SelectField, BooleanField, FormField, FieldList, \
     HiddenField, IntegerField, FloatField, RadioField, TextField
 from wtforms.validators import Optional, ValidationError
 
-from salty_tickets.models import Product, ProductParameter, OrderProduct, DANCE_ROLE_FOLLOWER, DANCE_ROLE_LEADER, Order, \
+from salty_tickets.models import Product, OrderProduct, DANCE_ROLE_FOLLOWER, DANCE_ROLE_LEADER, Order, \
     ORDER_STATUS_PAID, OrderProductDetail, ORDER_PRODUCT_STATUS_ACCEPTED, ORDER_PRODUCT_STATUS_WAITING, Registration, \
-    SignupGroup, group_order_product_mapping, SIGNUP_GROUP_PARTNERS, PaymentItem, RegistrationGroup
+    SignupGroup, group_order_product_mapping, SIGNUP_GROUP_PARTNERS, PaymentItem, RegistrationGroup, ProductInventory
 import json
 
 
+# registrations with partners hardly change the ratio of the roles
+PARTNER_MAX_RATIO = 10
+
+# price and status of one order product, before the OrderProduct model is created
+OrderLine = namedtuple('OrderLine', ['price', 'status', 'details'])
+
+
+class WaitingListChanged(Exception):
+    """The waiting list was balanced by another transaction while it was being balanced"""
+
+
 def flip_role(dance_role):
     if dance_role == DANCE_ROLE_FOLLOWER:
         return DANCE_ROLE_LEADER
@@ -52,6 +64,14 @@ class BaseProduct:
     def get_form(self):
         raise NotImplementedError()
 
+    def get_form_live_data(self, product_model):
+        # capacity data which changes between requests, it is not part of the form class
+        return {}
+
+    def set_form_live_data(self, product_form, product_model):
+        for name, value in self.get_form_live_data(product_model).items():
+            setattr(product_form, name, value)
+
     @property
     def model(self):
         kwargs = {a: getattr(self, a) for a in self._basic_attrs}
@@ -62,10 +82,9 @@ class BaseProduct:
     @classmethod
     def from_model(cls, db_model):
         assert isinstance(db_model, Product)
-        kwargs = {a: getattr(db_model, a) for a in cls._basic_attrs}
-
-        for p in db_model.parameters:
-            kwargs[p.parameter_name] = p.parameter_value
+        definition = db_model.definition
+        kwargs = {a: getattr(definition, a) for a in cls._basic_attrs}
+        kwargs.update(definition.parameters)
 
         product = cls(**kwargs)
         return product
@@ -88,30 +107,37 @@ class BaseProduct:
         else:
             return total_price
 
-    def get_order_product_model(self, product_model, product_form, form):
+    def get_order_lines(self, product_model, product_form, form):
         price = self.get_total_price(product_model, product_form, form)
-        status =  ORDER_PRODUCT_STATUS_ACCEPTED
-        order_product = OrderProduct(product_model, price, status=status)
-        return order_product
+        return [OrderLine(price, ORDER_PRODUCT_STATUS_ACCEPTED, {})]
+
+    def create_order_products(self, product_model, order_lines):
+        return [OrderProduct(product_model, line.price, line.details, status=line.status) for line in order_lines]
+
+    def get_order_product_model(self, product_model, product_form, form):
+        order_products = self.create_order_products(
+            product_model, self.get_order_lines(product_model, product_form, form))
+        if len(order_products) == 1:
+            return order_products[0]
+        return order_products
+
+    def get_payment_amount(self, product_model, price, status):
+        if status == ORDER_PRODUCT_STATUS_WAITING:
+            return min(price, self.get_waiting_list_price(product_model, price))
+        return price
 
     def get_payment_item(self, order_product):
         payment_item = PaymentItem()
-        if order_product.status == ORDER_PRODUCT_STATUS_WAITING:
-            amount = min(order_product.price,
-                         self.get_waiting_list_price(order_product.product, order_product.price))
-            payment_item.amount = amount
-            if amount:
-                payment_item.description = 'Refundable deposit'
-
-        else:
-            payment_item.amount = order_product.price
+        payment_item.amount = self.get_payment_amount(order_product.product, order_product.price, order_product.status)
+        if order_product.status == ORDER_PRODUCT_STATUS_WAITING and payment_item.amount:
+            payment_item.description = 'Refundable deposit'
         payment_item.order_product = order_product
         return payment_item
 
 
 
 def get_total_paid(product_model):
-    return product_model.product_orders.join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID).count()
+    return EventRegistrationStats.for_event(product_model.event_id).total_paid(product_model.id)
 
 
 class ProductDiscountPricesMixin:
@@ -199,7 +225,6 @@ class ContestProductMixin:
 
 
 WaitingListsStats = namedtuple('WaitingListsStats', ['leads', 'follows', 'couples'])
-WorkshopRegStats = namedtuple('WorkshopRegStats', ['accepted', 'waiting'])
 
 
 class StrictlyContest(ContestProductMixin, BaseProduct):
@@ -221,8 +246,6 @@ class StrictlyContest(ContestProductMixin, BaseProduct):
             contest_prize = self.contest_prize
             contest_location = self.contest_location
             contest_format = self.contest_format
-            available_quantity = self.get_available_quantity(product_model)
-            waiting_lists = self.get_waiting_lists(product_model)
 
             def needs_partner(self):
                 if self.add.data:
@@ -230,6 +253,12 @@ class StrictlyContest(ContestProductMixin, BaseProduct):
 
         return StrictlyContestForm
 
+    def get_form_live_data(self, product_model):
+        return dict(
+            available_quantity=self.get_available_quantity(product_model),
+            waiting_lists=self.get_waiting_lists(product_model),
+        )
+
     def get_total_price(self, product_model, product_form, order_form):
         if product_form.add.data:
             return self.price
@@ -244,27 +273,17 @@ class StrictlyContest(ContestProductMixin, BaseProduct):
             name2 = order_product_model.details_as_dict['partner_name']
             return '{} ({} + {})'.format(self.name, name1, name2)
 
-    def get_order_product_model(self, product_model, product_form, form):
+    def get_order_lines(self, product_model, product_form, form):
         price = self.get_total_price(product_model, product_form, form)
         partner_name = form.partner_name.data
         partner_email = form.partner_email.data
         ws = self.get_waiting_lists(product_model)
         status = ORDER_PRODUCT_STATUS_WAITING if ws else ORDER_PRODUCT_STATUS_ACCEPTED
-        order_product = OrderProduct(product_model, price, status=status,
-                                     details_dict={'partner_name':partner_name, 'partner_email':partner_email})
-        return order_product
+        return [OrderLine(price, status, {'partner_name': partner_name, 'partner_email': partner_email})]
 
     @staticmethod
     def get_registration_stats(product_model):
-        query = OrderProduct.query.filter_by(product_id=product_model.id). \
-            join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID)
-        couples_accepted = len(
-            query.filter_by(status=ORDER_PRODUCT_STATUS_ACCEPTED).all()
-        )
-        couples_waiting = len(
-            query.filter_by(status=ORDER_PRODUCT_STATUS_WAITING).all()
-        )
-        return WorkshopRegStats(couples_accepted, couples_waiting)
+        return EventRegistrationStats.for_event(product_model.event_id).product_stats(product_model.id)
 
     @classmethod
     def get_waiting_lists(cls, product_model):
@@ -278,8 +297,7 @@ class StrictlyContest(ContestProductMixin, BaseProduct):
 
     @classmethod
     def get_available_quantity(cls, product_model):
-        reg_stats = cls.get_registration_stats(product_model)
-        return product_model.max_available - reg_stats.accepted
+        return get_available_quantity(product_model)
 
     @classmethod
     def can_balance_waiting_list_one_couple(cls, product_model):
@@ -298,10 +316,6 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
     allow_first = 0
 
     def get_form(self, product_model=None):
-
-        waiting_lists0 = self.get_waiting_lists(product_model)
-        waiting_lists0[0]['couple'] = waiting_lists0[1][DANCE_ROLE_LEADER] + waiting_lists0[1][DANCE_ROLE_FOLLOWER]
-
         class RegularPartnerWorkshopForm(NoCsrfForm):
             product_name = self.name
             product_id = product_model.id
@@ -326,8 +340,6 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
             workshop_level = self.workshop_level
             workshop_price = self.workshop_price
             workshop_teachers = self.workshop_teachers
-            waiting_lists = waiting_lists0
-            available_quantity = self.get_available_quantity(product_model)
             keywords = self.keywords
 
             def needs_partner(self):
@@ -335,6 +347,14 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
 
         return RegularPartnerWorkshopForm
 
+    def get_form_live_data(self, product_model):
+        waiting_lists = self.get_waiting_lists(product_model)
+        waiting_lists[0]['couple'] = waiting_lists[1][DANCE_ROLE_LEADER] + waiting_lists[1][DANCE_ROLE_FOLLOWER]
+        return dict(
+            waiting_lists=waiting_lists,
+            available_quantity=self.get_available_quantity(product_model),
+        )
+
     def get_total_price(self, product_model, product_form, order_form, name=None):
         if product_form.add.data:
             discount_price = self.get_discount_price(product_model, product_form, order_form, name)
@@ -359,7 +379,7 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
         else:
             raise Exception(f'Unknown dance role for choice {product_form.add.data}')
 
-    def get_order_product_model(self, product_model, product_form, form):
+    def get_order_lines(self, product_model, product_form, form):
         price = self.get_total_price(product_model, product_form, form)
         ws = self.get_waiting_lists(product_model)
         dance_role = self._get_buyer_role(product_form, form)
@@ -369,12 +389,7 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
         else:
             status = ORDER_PRODUCT_STATUS_WAITING if ws[0][dance_role] else ORDER_PRODUCT_STATUS_ACCEPTED
 
-        order_product = OrderProduct(
-            product_model,
-            price,
-            dict(dance_role=dance_role),
-            status=status
-        )
+        order_lines = [OrderLine(price, status, dict(dance_role=dance_role))]
 
         # register partner
         if product_form.add.data == WORKSHOP_OPTIONS.COUPLE:
@@ -382,18 +397,15 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
             price2 = self.get_total_price(product_model, product_form, form, partner_name)
             dance_role2 = flip_role(dance_role)
             status2 = ORDER_PRODUCT_STATUS_WAITING if ws[1][dance_role2] else ORDER_PRODUCT_STATUS_ACCEPTED
-            order_product2 = OrderProduct(product_model, price2,
-                                         dict(dance_role=dance_role2), status=status2)
-
-            return [order_product, order_product2]
-        return order_product
+            order_lines.append(OrderLine(price2, status2, dict(dance_role=dance_role2)))
+        return order_lines
 
     def get_name(self, order_product_model=None):
         if not order_product_model:
             return self.name
         else:
             name = order_product_model.registration.name
-            role = order_product_model.details_as_dict['dance_role']
+            role = order_product_model.dance_role
             # name2 = order_product_model.registrations[1].name
             if name:
                 return '{} ({} / {})'.format(self.name, name, role)
@@ -403,69 +415,11 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
 
     @staticmethod
     def get_registration_stats(product_model):
-        query = product_model.product_orders.filter_by(status=ORDER_PRODUCT_STATUS_ACCEPTED). \
-            join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID)
-        leads_accepted = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_LEADER)
-                .all()
-        )
-        follows_accepted = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_FOLLOWER)
-                .all()
-        )
-
-        query = product_model.product_orders.filter_by(status=ORDER_PRODUCT_STATUS_WAITING). \
-            join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID)
-        leads_waiting = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_LEADER)
-                .all()
-        )
-        follows_waiting = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_FOLLOWER)
-                .all()
-        )
-        return {
-            DANCE_ROLE_LEADER: WorkshopRegStats(accepted=leads_accepted, waiting=leads_waiting),
-            DANCE_ROLE_FOLLOWER: WorkshopRegStats(accepted=follows_accepted, waiting=follows_waiting)
-        }
+        return EventRegistrationStats.for_event(product_model.event_id).product_role_stats(product_model.id)
 
     @staticmethod
     def get_partner_registration_stats(product_model):
-        query = product_model.product_orders.filter_by(status=ORDER_PRODUCT_STATUS_ACCEPTED). \
-            join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID). \
-            join(group_order_product_mapping).join(SignupGroup, aliased=True).filter_by(type=SIGNUP_GROUP_PARTNERS)
-        leads_accepted = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_LEADER)
-                .all()
-        )
-        follows_accepted = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_FOLLOWER)
-                .all()
-        )
-
-        query = product_model.product_orders.filter_by(status=ORDER_PRODUCT_STATUS_WAITING). \
-            join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID). \
-            join(group_order_product_mapping).join(SignupGroup, aliased=True).filter_by(type=SIGNUP_GROUP_PARTNERS)
-        leads_waiting = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_LEADER)
-                .all()
-        )
-        follows_waiting = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_FOLLOWER)
-                .all()
-        )
-        return {
-            DANCE_ROLE_LEADER: WorkshopRegStats(accepted=leads_accepted, waiting=leads_waiting),
-            DANCE_ROLE_FOLLOWER: WorkshopRegStats(accepted=follows_accepted, waiting=follows_waiting)
-        }
+        return EventRegistrationStats.for_event(product_model.event_id).product_partner_role_stats(product_model.id)
 
     @classmethod
     def get_waiting_lists(cls, product_model):
@@ -490,7 +444,7 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
         }
         total_accepted = reg_stats[DANCE_ROLE_LEADER].accepted + reg_stats[DANCE_ROLE_FOLLOWER].accepted
 
-        max_ratio = 10
+        max_ratio = PARTNER_MAX_RATIO
         partner_reg_stats = cls.get_partner_registration_stats(product_model)
 
         partner_leads_waiting = cls.get_waiting_list_for_role(
@@ -522,11 +476,19 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
 
     @classmethod
     def get_available_quantity(cls, product_model):
-        reg_stats = cls.get_registration_stats(product_model)
-        available_quantity = product_model.max_available \
-                             - reg_stats[DANCE_ROLE_LEADER].accepted \
-                             - reg_stats[DANCE_ROLE_FOLLOWER].accepted
-        return available_quantity
+        return get_available_quantity(product_model)
+
+    @classmethod
+    def get_role_capacity(cls, product_model, dance_role, with_partner=False):
+        """Max accepted and held places of the role, the ratio limit of get_waiting_list_for_role"""
+        accepted_other = get_product_inventory(product_model.id, flip_role(dance_role)).accepted
+        if with_partner:
+            ratio = PARTNER_MAX_RATIO
+            accepted_other += 1
+        else:
+            ratio = float(product_model.parameters_as_dict['ratio'])
+        allow_first = int(product_model.parameters_as_dict['allow_first'])
+        return max(allow_first - 1, int(accepted_other * ratio))
 
     @staticmethod
     def get_waiting_list_for_role(accepted, waiting, accepted_other, max_available, ratio, allow_first):
@@ -545,12 +507,15 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
     def can_balance_waiting_list_one(cls, product_model):
         reg_stats = cls.get_registration_stats(product_model)
         ratio = float(product_model.parameters_as_dict['ratio'])
-        max_ratio = 10
+        return cls._can_balance_one(reg_stats, product_model.max_available, ratio)
+
+    @staticmethod
+    def _can_balance_one(reg_stats, max_available, ratio):
         # both waiting lists empty => None
         if reg_stats[DANCE_ROLE_LEADER].waiting == 0 and reg_stats[DANCE_ROLE_FOLLOWER].waiting == 0:
             return False
         # no available places => None
-        elif reg_stats[DANCE_ROLE_LEADER].accepted + reg_stats[DANCE_ROLE_FOLLOWER].accepted >= product_model.max_available:
+        elif reg_stats[DANCE_ROLE_LEADER].accepted + reg_stats[DANCE_ROLE_FOLLOWER].accepted >= max_available:
             return False
         # both waiting lists not empty
         elif reg_stats[DANCE_ROLE_LEADER].waiting > 0 and reg_stats[DANCE_ROLE_FOLLOWER].waiting > 0:
@@ -580,37 +545,80 @@ class RegularPartnerWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, B
             return False
 
     @classmethod
-    def balance_waiting_list(cls, product_model):
-        can_balance = cls.can_balance_waiting_list_one(product_model)
-        results = []
+    def get_balanced_waiting_list(cls, product_model, reg_stats=None, waiting_queue=None, held=0):
+        """Simulates balance_waiting_list in memory, returns the waiting queue items to accept in order"""
+        if reg_stats is None:
+            reg_stats = cls.get_registration_stats(product_model)
+        if waiting_queue is None:
+            waiting_queue = get_waiting_queue(product_model.id)
+        ratio = float(product_model.parameters_as_dict['ratio'])
+        # places held for checkouts in progress can't be given to the waiting list
+        max_available = product_model.max_available - held
+        reg_stats = dict(reg_stats)
+        waiting_queue = list(waiting_queue)
+
+        accepted = []
+        can_balance = cls._can_balance_one(reg_stats, max_available, ratio)
         while can_balance:
-            # get top waiting with partners
-            query = product_model.product_orders.filter_by(status=ORDER_PRODUCT_STATUS_WAITING). \
-                join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID). \
-                join(group_order_product_mapping).join(SignupGroup, aliased=True).filter_by(type=SIGNUP_GROUP_PARTNERS)
-            if can_balance in (DANCE_ROLE_FOLLOWER, DANCE_ROLE_LEADER):
-                query = query.join(OrderProductDetail, aliased=True).filter_by(field_name='dance_role',
-                                                                               field_value=can_balance)
-            order_product = query.join(Order).order_by(asc(Order.order_datetime)).first()
-            if order_product:
-                cls.accept_from_waiting_list(order_product)
-                results.append(order_product)
-            else:
-                # get top waiting (without partners)
-                query = product_model.product_orders.filter_by(status=ORDER_PRODUCT_STATUS_WAITING). \
-                    join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID)
-                if can_balance in (DANCE_ROLE_FOLLOWER, DANCE_ROLE_LEADER):
-                    query = query.join(OrderProductDetail, aliased=True).filter_by(field_name='dance_role', field_value=can_balance)
-                order_product = query.join(Order).order_by(asc(Order.order_datetime)).first()
-                if order_product:
-                    cls.accept_from_waiting_list(order_product)
-                    results.append(order_product)
-            can_balance = cls.can_balance_waiting_list_one(product_model)
+            candidates = [item for item in waiting_queue
+                          if can_balance not in (DANCE_ROLE_FOLLOWER, DANCE_ROLE_LEADER) or item.dance_role == can_balance]
+            # registrations with partners go first
+            item = next((c for c in candidates if c.with_partner), None) or next(iter(candidates), None)
+            if item is None:
+                break
+            waiting_queue.remove(item)
+            accepted.append(item)
+            if item.dance_role in reg_stats:
+                role_stats = reg_stats[item.dance_role]
+                reg_stats[item.dance_role] = WorkshopRegStats(accepted=role_stats.accepted + 1,
+                                                              waiting=role_stats.waiting - 1)
+            can_balance = cls._can_balance_one(reg_stats, max_available, ratio)
+        return accepted
+
+    @classmethod
+    def balance_waiting_list(cls, product_model, commit=True, reg_stats=None, waiting_queue=None, held=None):
+        if held is None:
+            held = get_product_inventory(product_model.id).held
+        # the payment workers balance in parallel, the waiting rows stay locked until the transaction ends
+        waiting_ids = {op_id for op_id, in db_session.query(OrderProduct.id).
+                       filter(OrderProduct.product_id == product_model.id,
+                              OrderProduct.status == ORDER_PRODUCT_STATUS_WAITING).
+                       order_by(OrderProduct.id).with_for_update().all()}
+        accepted = cls.get_balanced_waiting_list(product_model, reg_stats, waiting_queue, held)
+        if any(item.order_product_id not in waiting_ids for item in accepted):
+            # balanced by another worker since the stats were read, simulated again from the locked rows
+            reg_stats = EventRegistrationStats.load(product_model.event_id).product_role_stats(product_model.id)
+            accepted = cls.get_balanced_waiting_list(product_model, reg_stats, get_waiting_queue(product_model.id),
+                                                     held)
+        if not accepted:
+            return []
+
+        # the simulation pairs the roles, so either all of them are accepted or none
+        order_product_ids = [item.order_product_id for item in accepted]
+        table = OrderProduct.__table__
+        result = db_session.execute(
+            table.update().
+            where(table.c.id.in_(order_product_ids)).
+            where(table.c.status == ORDER_PRODUCT_STATUS_WAITING).
+            values(status=ORDER_PRODUCT_STATUS_ACCEPTED)
+        )
+        if result.rowcount != len(order_product_ids):
+            # only without row locks, e.g. sqlite, the transaction is rolled back by the caller
+            raise WaitingListChanged(product_model.id)
+
+        for dance_role in {item.dance_role for item in accepted}:
+            count = len([item for item in accepted if item.dance_role == dance_role])
+            ProductInventory.adjust(db_session, product_model.id, dance_role, accepted=count, waiting=-count)
+
+        results = OrderProduct.query.populate_existing().filter(OrderProduct.id.in_(order_product_ids)).all()
+        results.sort(key=lambda op: order_product_ids.index(op.id))
+        if commit:
+            db_session.commit()
         return results
 
     @classmethod
     def accept_from_waiting_list(cls, order_product):
-        order_product.status = ORDER_PRODUCT_STATUS_ACCEPTED
+        order_product.accept()
         db_session.commit()
 
 
@@ -634,8 +642,6 @@ class CouplesOnlyWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, Base
             workshop_location = self.workshop_location
             workshop_level = self.workshop_level
             workshop_price = self.workshop_price
-            waiting_lists = self.get_waiting_lists(product_model)
-            available_quantity = self.get_available_quantity(product_model)
 
             def needs_partner(self):
                 if self.add_partner.data:
@@ -645,6 +651,12 @@ class CouplesOnlyWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, Base
 
         return CouplesContestForm
 
+    def get_form_live_data(self, product_model):
+        return dict(
+            waiting_lists=self.get_waiting_lists(product_model),
+            available_quantity=self.get_available_quantity(product_model),
+        )
+
     def get_total_price(self, product_model, product_form, order_form):
         if product_form.add.data:
             discount_price = self.get_discount_price(product_model, product_form, order_form)
@@ -655,7 +667,7 @@ class CouplesOnlyWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, Base
         else:
             return 0
 
-    def get_order_product_model(self, product_model, product_form, form):
+    def get_order_lines(self, product_model, product_form, form):
         price = self.get_total_price(product_model, product_form, form)
         ws = self.get_waiting_lists(product_model)
         dance_role = product_form.dance_role.data
@@ -665,71 +677,31 @@ class CouplesOnlyWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, Base
         else:
             status = ORDER_PRODUCT_STATUS_WAITING
 
-        order_product = OrderProduct(
-            product_model,
-            price,
-            dict(dance_role=dance_role),
-            status=status
-        )
+        order_lines = [OrderLine(price, status, dict(dance_role=dance_role))]
 
         # register partner
         if product_form.add_partner.data:
             dance_role = flip_role(dance_role)
             status = ORDER_PRODUCT_STATUS_WAITING if ws else ORDER_PRODUCT_STATUS_ACCEPTED
-            order_product2 = OrderProduct(product_model, price,
-                                         dict(dance_role=dance_role), status=status)
-
-            return [order_product, order_product2]
-        return order_product
+            order_lines.append(OrderLine(price, status, dict(dance_role=dance_role)))
+        return order_lines
 
     def get_name(self, order_product_model=None):
         if not order_product_model:
             return self.name
         else:
             name = order_product_model.registration.name
-            role = order_product_model.details_as_dict['dance_role']
+            role = order_product_model.dance_role
             # name2 = order_product_model.registrations[1].name
             return '{} ({} / {})'.format(self.name, name, role)
 
     @staticmethod
     def get_registration_stats(product_model):
-        query = product_model.product_orders.filter_by(status=ORDER_PRODUCT_STATUS_ACCEPTED). \
-            join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID)
-        leads_accepted = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_LEADER)
-                .all()
-        )
-        follows_accepted = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_FOLLOWER)
-                .all()
-        )
-
-        query = product_model.product_orders.filter_by(status=ORDER_PRODUCT_STATUS_WAITING). \
-            join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID)
-        leads_waiting = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_LEADER)
-                .all()
-        )
-        follows_waiting = len(
-            query.join(aliased(OrderProductDetail))
-                .filter_by(field_name='dance_role', field_value=DANCE_ROLE_FOLLOWER)
-                .all()
-        )
-        return {
-            DANCE_ROLE_LEADER: WorkshopRegStats(accepted=leads_accepted, waiting=leads_waiting),
-            DANCE_ROLE_FOLLOWER: WorkshopRegStats(accepted=follows_accepted, waiting=follows_waiting),
-        }
+        return EventRegistrationStats.for_event(product_model.event_id).product_role_stats(product_model.id)
 
     @classmethod
     def get_available_quantity(cls, product_model):
-        reg_stats = cls.get_registration_stats(product_model)
-        available_quantity = product_model.max_available \
-                             - reg_stats[DANCE_ROLE_LEADER].accepted \
-                             - reg_stats[DANCE_ROLE_FOLLOWER].accepted
-        return available_quantity
+        return get_available_quantity(product_model)
 
     @classmethod
     def get_waiting_lists(cls, product_model):
@@ -753,7 +725,7 @@ class CouplesOnlyWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, Base
             return False
 
     @classmethod
-    def balance_waiting_list(cls, product_model):
+    def balance_waiting_list(cls, product_model, commit=True, reg_stats=None, waiting_queue=None, held=None):
         can_balance = cls.can_balance_waiting_list_one_couple(product_model)
         results = []
         while can_balance:
@@ -762,22 +734,23 @@ class CouplesOnlyWorkshop(ProductDiscountPricesMixin, WorkshopProductMixin, Base
                 join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID). \
                 join(group_order_product_mapping).join(SignupGroup, aliased=True).filter_by(type=SIGNUP_GROUP_PARTNERS)
             if can_balance in (DANCE_ROLE_FOLLOWER, DANCE_ROLE_LEADER):
-                query = query.join(OrderProductDetail, aliased=True).filter_by(field_name='dance_role',
-                                                                               field_value=can_balance)
+                query = query.filter(OrderProduct.dance_role == can_balance)
             order_product = query.join(Order).order_by(asc(Order.order_datetime)).first()
             if order_product:
                 group = SignupGroup.join(group_order_product_mapping).\
                     join(OrderProduct, aliased=True).filter_by(type=SIGNUP_GROUP_PARTNERS, id=order_product.id).\
                     first()
                 for partners_order_product in group.order_products:
-                    cls.accept_from_waiting_list(partners_order_product)
+                    partners_order_product.accept()
                     results.append(partners_order_product)
             can_balance = cls.can_balance_waiting_list_one_couple(product_model)
+        if commit and results:
+            db_session.commit()
         return results
 
     @classmethod
     def accept_from_waiting_list(cls, order_product):
-        order_product.status = ORDER_PRODUCT_STATUS_ACCEPTED
+        order_product.accept()
         db_session.commit()
 
 
@@ -791,27 +764,29 @@ class MarketingProduct(BaseProduct):
             info = self.info
             img_src = self.img_src
             price = self.price
-            available_quantity = self.get_available_quantity(product_model)
             product_type = self.__class__.__name__
+            # choices depend on the available quantity, they are set per request in set_form_live_data
+            add = SelectField(label='Add', choices=[('0', '0')], validators=[Optional()])
 
             def needs_partner(self):
                 return False
 
-        if self.allow_select:
-            quantity = min(self.get_available_quantity(product_model), int(self.allow_select))
-        else:
-            quantity = self.get_available_quantity(product_model)
-
-        setattr(
-            MarketingProductForm,
-            'add',
-            SelectField(label='Add', choices=[(str(x), str(x)) for x in range(0, quantity+1)], validators=[Optional()])
-        )
         return MarketingProductForm
 
+    def get_form_live_data(self, product_model):
+        return dict(available_quantity=self.get_available_quantity(product_model))
+
+    def set_form_live_data(self, product_form, product_model):
+        super(MarketingProduct, self).set_form_live_data(product_form, product_model)
+        quantity = product_form.available_quantity
+        if self.allow_select:
+            quantity = min(quantity, int(self.allow_select))
+        product_form.add.choices = [(str(x), str(x)) for x in range(0, quantity+1)]
+
     def get_available_quantity(self, product_model):
         assert isinstance(product_model, Product)
-        ordered_quantity = OrderProduct.query.filter(OrderProduct.product == product_model).count()
+        inventory = get_product_inventory(product_model.id)
+        ordered_quantity = inventory.accepted + inventory.waiting + inventory.held
         return max(self.max_available - ordered_quantity, 0)
 
     def get_total_price(self, product_model, product_form, order_form=None):
@@ -883,18 +858,16 @@ class FestivalTicketProduct(BaseProduct):
     def is_selected(self, product_form):
         return product_form.add.data in (FESTIVAL_TICKET.SINGLE, FESTIVAL_TICKET.COUPLE)
 
-    def get_order_product_model(self, product_model, product_form, form):
+    def get_order_lines(self, product_model, product_form, form):
         price = self.get_total_price(product_model, product_form, form)
-        order_product = OrderProduct(product_model, price, status=ORDER_PRODUCT_STATUS_ACCEPTED)
+        order_lines = [OrderLine(price, ORDER_PRODUCT_STATUS_ACCEPTED, {})]
 
         # register partner
         if product_form.add.data == FESTIVAL_TICKET.COUPLE:
-            partner_name = form.partner_name.data
             price2 = self.get_total_price(product_model, product_form, form)
-            order_product2 = OrderProduct(product_model, price2, status=ORDER_PRODUCT_STATUS_ACCEPTED)
-            return [order_product, order_product2]
+            order_lines.append(OrderLine(price2, ORDER_PRODUCT_STATUS_ACCEPTED, {}))
 
-        return order_product
+        return order_lines
 
     def get_name(self, order_product_model=None):
         if not order_product_model:
@@ -909,11 +882,7 @@ class FestivalTicketProduct(BaseProduct):
 
     @staticmethod
     def get_registration_stats(product_model):
-        query = OrderProduct.query.filter_by(product_id=product_model.id). \
-            join(Order, aliased=True).filter_by(status=ORDER_STATUS_PAID)
-        accepted = query.filter(OrderProduct.status == ORDER_PRODUCT_STATUS_ACCEPTED).count()
-        waiting = query.filter(OrderProduct.status == ORDER_PRODUCT_STATUS_WAITING).count()
-        return WorkshopRegStats(accepted, waiting)
+        return EventRegistrationStats.for_event(product_model.event_id).product_stats(product_model.id)
 
 
 
@@ -937,15 +906,16 @@ class FestivalPartyProduct(FestivalTicketProduct):
         form = super(FestivalPartyProduct, self).get_form(product_model=product_model)
         form.party_date = self.party_date
         form.party_time = self.party_time
-        form.available_quantity = self.get_available_quantity(product_model)
         form.party_location = self.party_location
         form.party_performers = self.party_performers
         return form
 
+    def get_form_live_data(self, product_model):
+        return dict(available_quantity=self.get_available_quantity(product_model))
+
     @classmethod
     def get_available_quantity(cls, product_model):
-        reg_stats = cls.get_registration_stats(product_model)
-        return product_model.max_available - reg_stats.accepted
+        return get_available_quantity(product_model)
 
 
 class FestivalGroupDiscountProduct(BaseProduct):
@@ -990,17 +960,16 @@ class FestivalGroupDiscountProduct(BaseProduct):
                 except:
                     pass
 
-    def get_order_product_model(self, product_model, product_form, form):
+    def get_order_lines(self, product_model, product_form, form):
         price = self.get_total_price(product_model, product_form, form)
-        order_product = OrderProduct(product_model, price, status=ORDER_PRODUCT_STATUS_ACCEPTED)
+        order_lines = [OrderLine(price, ORDER_PRODUCT_STATUS_ACCEPTED, {})]
 
         # register partner
         ticket_form = self._get_selected_included_product_form(form)
         if ticket_form and ticket_form.add.data == FESTIVAL_TICKET.COUPLE:
-            order_product2 = OrderProduct(product_model, price, status=ORDER_PRODUCT_STATUS_ACCEPTED)
-            return [order_product, order_product2]
+            order_lines.append(OrderLine(price, ORDER_PRODUCT_STATUS_ACCEPTED, {}))
 
-        return order_product
+        return order_lines
 
     def get_name(self, order_product_model=None):
         if not order_product_model:
@@ -1071,23 +1040,22 @@ class PartnerTokenValid:
     def __call__(self, form, field):
         if field.data:
             try:
-                partner_product_order = order_product_deserialize(field.data)
+                partner_token_info = get_partner_token_info(field.data)
             except BadSignature:
                 raise ValidationError('Invalid token')
+            if partner_token_info is None:
+                raise ValidationError('Invalid token')
 
-            if form.product_id != partner_product_order.product.id:
+            if form.product_id != partner_token_info.product_id:
                 raise ValidationError('The token is for a different workshop')
 
-            if form.dance_role.data == partner_product_order.details_as_dict['dance_role']:
+            if form.dance_role.data == partner_token_info.dance_role:
                 raise ValidationError('Partner has the same role')
 
-            if partner_product_order.status != ORDER_PRODUCT_STATUS_WAITING and order_product_token_expired(field.data, 60*60*24):
+            if partner_token_info.status != ORDER_PRODUCT_STATUS_WAITING and partner_token_info.is_expired(60*60*24):
                 raise ValidationError('Token has expired')
 
-            has_partners = (len(SignupGroup.query.
-                                join(group_order_product_mapping).
-                                join(OrderProduct).filter_by(id=partner_product_order.id).all()) > 0)
-            if has_partners:
+            if partner_token_info.has_partners:
                 raise ValidationError('Your partner has already signed up with a partner')
 
 
@@ -0,0 +1,53 @@
+import base64
+import hashlib
+import io
+import os
+import tempfile
+from collections import namedtuple
+from functools import lru_cache
+
+import segno
+from salty_tickets import config
+
+QR_CODE_CACHE_DIR = getattr(config, 'QR_CODE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'salty_tickets_qr'))
+QR_CODE_CACHE_SIZE = 1024
+QR_CODE_SCALE = 5
+# the QR code of a token never changes
+QR_CODE_MAX_AGE = 365 * 24 * 3600
+QR_CODE_MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+QrCode = namedtuple('QrCode', ['content', 'mimetype', 'etag'])
+
+
+def render_qr_code(data, kind):
+    buffer = io.BytesIO()
+    segno.make(data, error='m').save(buffer, kind=kind, scale=QR_CODE_SCALE)
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=QR_CODE_CACHE_SIZE)
+def get_qr_code(data, kind='png'):
+    """QR code image from the memory cache, the disk cache or rendered"""
+    if kind not in QR_CODE_MIMETYPES:
+        raise ValueError('Unknown QR code format: {}'.format(kind))
+    key = hashlib.sha256('{}:{}:{}'.format(kind, QR_CODE_SCALE, data).encode('utf-8')).hexdigest()
+    path = os.path.join(QR_CODE_CACHE_DIR, key[:2], '{}.{}'.format(key, kind))
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        content = render_qr_code(data, kind)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return QrCode(content, QR_CODE_MIMETYPES[kind], key)
+
+
+def get_qr_code_data_uri(data, kind='png'):
+    qr_code = get_qr_code(data, kind)
+    return 'data:{};base64,{}'.format(qr_code.mimetype, base64.b64encode(qr_code.content).decode('ascii'))
@@ -0,0 +1,135 @@
+from collections import namedtuple
+
+from salty_tickets.database import db_session
+from salty_tickets.models import Product, Order, OrderProduct, SignupGroup, \
+    group_order_product_mapping, ORDER_STATUS_PAID, ORDER_PRODUCT_STATUS_ACCEPTED, ORDER_PRODUCT_STATUS_WAITING, \
+    SIGNUP_GROUP_PARTNERS, DANCE_ROLE_LEADER, DANCE_ROLE_FOLLOWER
+from sqlalchemy import and_, event, exists, func
+
+
+WorkshopRegStats = namedtuple('WorkshopRegStats', ['accepted', 'waiting'])
+
+RegistrationStatsKey = namedtuple('RegistrationStatsKey', ['product_id', 'status', 'dance_role', 'with_partner'])
+
+WaitingQueueItem = namedtuple('WaitingQueueItem', ['order_product_id', 'dance_role', 'with_partner'])
+
+_SESSION_INFO_KEY = 'event_registration_stats'
+
+
+class EventRegistrationStats:
+    """Counts of registrations in paid orders for all products of an event.
+
+    Loaded with a single grouped query and cached on the current db session, so that
+    all products rendered or priced within one request share the same snapshot.
+    """
+    def __init__(self, event_id, counts):
+        self.event_id = event_id
+        self._counts = counts
+
+    @classmethod
+    def load(cls, event_id):
+        with_partner = _with_partner_clause()
+        query = db_session.query(
+                OrderProduct.product_id,
+                OrderProduct.status,
+                OrderProduct.dance_role,
+                with_partner,
+                func.count(OrderProduct.id)
+            ). \
+            join(Product, OrderProduct.product_id == Product.id). \
+            join(Order, OrderProduct.order_id == Order.id). \
+            filter(Product.event_id == event_id, Order.status == ORDER_STATUS_PAID). \
+            group_by(OrderProduct.product_id, OrderProduct.status, OrderProduct.dance_role, with_partner)
+
+        counts = {}
+        for product_id, status, dance_role, has_partner, count in query.all():
+            key = RegistrationStatsKey(product_id, status, dance_role, bool(has_partner))
+            counts[key] = counts.get(key, 0) + count
+        return cls(event_id, counts)
+
+    @classmethod
+    def for_event(cls, event_id):
+        cache = db_session.info.setdefault(_SESSION_INFO_KEY, {})
+        if event_id not in cache:
+            cache[event_id] = cls.load(event_id)
+        return cache[event_id]
+
+    @staticmethod
+    def invalidate(session=None):
+        if session is None:
+            session = db_session
+        session.info.pop(_SESSION_INFO_KEY, None)
+
+    def count(self, product_id, status=None, dance_role=None, with_partner=None):
+        return sum(
+            count for key, count in self._counts.items()
+            if key.product_id == product_id
+            and (status is None or key.status == status)
+            and (dance_role is None or key.dance_role == dance_role)
+            and (with_partner is None or key.with_partner == with_partner)
+        )
+
+    def product_stats(self, product_id):
+        return WorkshopRegStats(
+            accepted=self.count(product_id, ORDER_PRODUCT_STATUS_ACCEPTED),
+            waiting=self.count(product_id, ORDER_PRODUCT_STATUS_WAITING),
+        )
+
+    def product_role_stats(self, product_id, with_partner=None):
+        return {
+            dance_role: WorkshopRegStats(
+                accepted=self.count(product_id, ORDER_PRODUCT_STATUS_ACCEPTED, dance_role, with_partner),
+                waiting=self.count(product_id, ORDER_PRODUCT_STATUS_WAITING, dance_role, with_partner),
+            )
+            for dance_role in (DANCE_ROLE_LEADER, DANCE_ROLE_FOLLOWER)
+        }
+
+    def product_partner_role_stats(self, product_id):
+        return self.product_role_stats(product_id, with_partner=True)
+
+    def total_paid(self, product_id):
+        return self.count(product_id)
+
+
+def get_waiting_queue(product_id):
+    """Waiting registrations of the product in paid orders, first come first served"""
+    query = _waiting_queue_query().filter(OrderProduct.product_id == product_id)
+    return [WaitingQueueItem(op_id, dance_role, bool(with_partner))
+            for _, op_id, dance_role, with_partner in query.all()]
+
+
+def get_event_waiting_queues(event_id):
+    """Same as get_waiting_queue for all products of the event, as a dict by product_id"""
+    query = _waiting_queue_query(). \
+        join(Product, OrderProduct.product_id == Product.id). \
+        filter(Product.event_id == event_id)
+    queues = {}
+    for product_id, op_id, dance_role, with_partner in query.all():
+        queues.setdefault(product_id, []).append(WaitingQueueItem(op_id, dance_role, bool(with_partner)))
+    return queues
+
+
+def _waiting_queue_query():
+    return db_session.query(OrderProduct.product_id, OrderProduct.id, OrderProduct.dance_role,
+                            _with_partner_clause()). \
+        join(Order, OrderProduct.order_id == Order.id). \
+        filter(OrderProduct.status == ORDER_PRODUCT_STATUS_WAITING, Order.status == ORDER_STATUS_PAID). \
+        order_by(Order.order_datetime, OrderProduct.id)
+
+
+def _with_partner_clause():
+    return exists().where(and_(
+        group_order_product_mapping.c.order_product_id == OrderProduct.id,
+        group_order_product_mapping.c.signup_group_id == SignupGroup.id,
+        SignupGroup.type == SIGNUP_GROUP_PARTNERS,
+    ))
+
+
+def _invalidate_session_stats(session, *args):
+    EventRegistrationStats.invalidate(session)
+
+
+# any write in the session makes the snapshot stale
+event.listen(db_session, 'after_flush', _invalidate_session_stats)
+event.listen(db_session, 'after_bulk_update', lambda update_context: _invalidate_session_stats(update_context.session))
+event.listen(db_session, 'after_rollback', _invalidate_session_stats)
@@ -0,0 +1,189 @@
+import datetime
+
+from salty_tickets.database import db_session
+from salty_tickets.models import CapacityHold, ProductInventory, INVENTORY_ALL_ROLES, INVENTORY_SESSION_INFO_KEY, \
+    ORDER_PRODUCT_STATUS_ACCEPTED, ORDER_PRODUCT_STATUS_WAITING
+from salty_tickets.products import get_product_by_model
+
+CAPACITY_HOLD_TTL = datetime.timedelta(minutes=15)
+
+
+def _hold_inventory_row(session, product_id, dance_role, quantity, limit=None):
+    table = ProductInventory.__table__
+    update = table.update(). \
+        where(table.c.product_id == product_id). \
+        where(table.c.dance_role == dance_role). \
+        values(held=table.c.held + quantity)
+    if limit is not None:
+        update = update.where(table.c.accepted + table.c.held + quantity <= limit)
+
+    result = session.execute(update)
+    if result.rowcount == 0 and session.query(table.c.product_id).filter(
+            table.c.product_id == product_id, table.c.dance_role == dance_role).first() is None:
+        # no registrations for the product yet, create the counters and try again
+        ProductInventory.adjust(session, product_id, dance_role)
+        result = session.execute(update)
+    return result.rowcount == 1
+
+
+def _release_inventory_row(session, product_id, dance_role, quantity):
+    table = ProductInventory.__table__
+    session.execute(
+        table.update().
+        where(table.c.product_id == product_id).
+        where(table.c.dance_role == dance_role).
+        values(held=table.c.held - quantity)
+    )
+
+
+def take_capacity_hold(session, product_model, quantity, now=None, dance_role=None, role_capacity=None,
+                       ttl=CAPACITY_HOLD_TTL):
+    """Reserves quantity places of the product, returns None if they are not available any more.
+
+    The places are held on the product inventory row and, with a dance_role, on the row of the role,
+    up to role_capacity accepted and held places. Each row is a conditional UPDATE, so parallel requests
+    can't reserve the same places; the product row is given back if the role row is full.
+    """
+    taken = _hold_inventory_row(session, product_model.id, INVENTORY_ALL_ROLES, quantity,
+                                product_model.max_available)
+    if taken and dance_role:
+        taken = _hold_inventory_row(session, product_model.id, dance_role, quantity, role_capacity)
+        if not taken:
+            _release_inventory_row(session, product_model.id, INVENTORY_ALL_ROLES, quantity)
+    session.info.pop(INVENTORY_SESSION_INFO_KEY, None)
+
+    if not taken:
+        return None
+
+    now = now or datetime.datetime.utcnow()
+    hold = CapacityHold(product_id=product_model.id, dance_role=dance_role or INVENTORY_ALL_ROLES,
+                        quantity=quantity, expires_at=now + ttl)
+    session.add(hold)
+    return hold
+
+
+def release_capacity_hold(session, hold):
+    # only the transaction which deletes the hold gives the places back
+    table = CapacityHold.__table__
+    result = session.execute(table.delete().where(table.c.id == hold.id))
+    if result.rowcount:
+        for dance_role in {INVENTORY_ALL_ROLES, hold.dance_role or INVENTORY_ALL_ROLES}:
+            _release_inventory_row(session, hold.product_id, dance_role, hold.quantity)
+        session.info.pop(INVENTORY_SESSION_INFO_KEY, None)
+    if hold in session:
+        session.expunge(hold)
+    return bool(result.rowcount)
+
+
+def _get_order_products_to_hold(user_order, catalog=None):
+    # products with limited places, in the same order in all transactions, so are the row locks
+    get_product = catalog.get_product if catalog is not None else get_product_by_model
+    order_products_by_product = {}
+    for order_product in user_order.order_products:
+        if order_product.status == ORDER_PRODUCT_STATUS_ACCEPTED:
+            order_products_by_product.setdefault(order_product.product, []).append(order_product)
+    to_hold = []
+    for product_model, order_products in sorted(order_products_by_product.items(), key=lambda item: item[0].id):
+        product = get_product(product_model)
+        if hasattr(product, 'get_available_quantity'):
+            to_hold.append((product_model, product, order_products))
+    return to_hold
+
+
+def _take_order_product_holds(session, product_model, product, order_products, now, ttl):
+    """Holds for each dance role of the order products, or None if one of them is not available"""
+    quantities = {}
+    for order_product in order_products:
+        dance_role = order_product.dance_role or INVENTORY_ALL_ROLES
+        quantities[dance_role] = quantities.get(dance_role, 0) + 1
+    # a couple is booked together, the ratio of the roles doesn't change
+    with_partner = len(quantities) > 1
+
+    holds = []
+    for dance_role, quantity in sorted(quantities.items()):
+        role_capacity = None
+        if dance_role and hasattr(product, 'get_role_capacity'):
+            role_capacity = product.get_role_capacity(product_model, dance_role, with_partner)
+        hold = take_capacity_hold(session, product_model, quantity, now, dance_role, role_capacity, ttl)
+        if hold is None:
+            # not flushed yet, the places are given back straight away
+            for taken_hold in holds:
+                for role in {INVENTORY_ALL_ROLES, taken_hold.dance_role}:
+                    _release_inventory_row(session, taken_hold.product_id, role, taken_hold.quantity)
+                session.expunge(taken_hold)
+            session.info.pop(INVENTORY_SESSION_INFO_KEY, None)
+            return None
+        holds.append(hold)
+    return holds
+
+
+def _hold_order_products(session, user_order, order_products_to_hold, now, ttl):
+    moved_to_waiting = []
+    for product_model, product, order_products in order_products_to_hold:
+        holds = _take_order_product_holds(session, product_model, product, order_products, now, ttl)
+        if holds is None:
+            for order_product in order_products:
+                order_product.status = ORDER_PRODUCT_STATUS_WAITING
+            moved_to_waiting += order_products
+        else:
+            for hold in holds:
+                user_order.capacity_holds.append(hold)
+    return moved_to_waiting
+
+
+def reserve_order_capacity(user_order, catalog=None, session=None, now=None, ttl=CAPACITY_HOLD_TTL):
+    """Takes capacity holds for the accepted order products before the payment.
+
+    Order products which don't fit any more go to the waiting list, all order products
+    of the same product together. Returns the order products moved to the waiting list.
+    """
+    if session is None:
+        session = db_session
+    expire_capacity_holds(session, now)
+    return _hold_order_products(session, user_order, _get_order_products_to_hold(user_order, catalog), now, ttl)
+
+
+def renew_order_capacity(user_order, ttl=CAPACITY_HOLD_TTL, session=None, now=None):
+    """Extends the capacity holds of the order, e.g. while its payment is charged.
+
+    The places of the holds which have expired are taken again, the order products which
+    don't fit any more go to the waiting list as in reserve_order_capacity.
+    """
+    if session is None:
+        session = db_session
+    now = now or datetime.datetime.utcnow()
+    table = CapacityHold.__table__
+    session.execute(
+        table.update().
+        where(table.c.order_id == user_order.id).
+        where(table.c.expires_at >= now).
+        values(expires_at=now + ttl)
+    )
+    held_product_ids = set()
+    for hold in user_order.capacity_holds.all():
+        if hold.expires_at >= now:
+            held_product_ids.add(hold.product_id)
+        else:
+            release_capacity_hold(session, hold)
+
+    order_products_to_hold = [item for item in _get_order_products_to_hold(user_order)
+                              if item[0].id not in held_product_ids]
+    return _hold_order_products(session, user_order, order_products_to_hold, now, ttl)
+
+
+def release_order_capacity(user_order, session=None):
+    """Gives back the places held for the order, called once the order is paid or the payment failed"""
+    if session is None:
+        session = db_session
+    for hold in user_order.capacity_holds.all():
+        release_capacity_hold(session, hold)
+
+
+def expire_capacity_holds(session=None, now=None):
+    if session is None:
+        session = db_session
+    now = now or datetime.datetime.utcnow()
+    expired_holds = session.query(CapacityHold).filter(CapacityHold.expires_at < now).all()
+    for hold in expired_holds:
+        release_capacity_hold(session, hold)
+    return len(expired_holds)
@@ -0,0 +1,16 @@
+import pytest
+from salty_tickets.database import Base, db_session
+from sqlalchemy import create_engine
+
+
+@pytest.fixture
+def sqlite_db(tmpdir):
+    # file database, so that every thread has its own connection and transaction
+    engine = create_engine('sqlite:///{}'.format(tmpdir.join('test.db')), connect_args={'timeout': 30})
+    Base.metadata.create_all(bind=engine)
+    db_session.remove()
+    old_bind = db_session.session_factory.kw['bind']
+    db_session.configure(bind=engine)
+    yield engine
+    db_session.remove()
+    db_session.configure(bind=old_bind)
@@ -0,0 +1,37 @@
+import itertools
+
+from salty_tickets.availability import max_bundles, full_weekend_available, fast_train_available
+
+
+def max_bundles_one_by_one(capacities, bundle_size):
+    # reference: taking one place in each of the largest slots is always optimal
+    capacities = [max(0, c) for c in capacities]
+    available = 0
+    while True:
+        capacities.sort(reverse=True)
+        if len(capacities) < bundle_size or capacities[bundle_size - 1] <= 0:
+            return available
+        for i in range(bundle_size):
+            capacities[i] -= 1
+        available += 1
+
+
+def test_max_bundles():
+    for n_slots in range(6):
+        for capacities in itertools.product(range(-1, 6), repeat=n_slots):
+            for bundle_size in (1, 2, 3):
+                assert max_bundles(capacities, bundle_size) == max_bundles_one_by_one(capacities, bundle_size)
+
+
+def test_full_weekend_available():
+    # the same slot in all passes is not allowed
+    assert full_weekend_available([10, 1, 1]) == 1
+    assert full_weekend_available([10, 10]) == 0
+    # every pass skips one of the slots
+    assert full_weekend_available([3, 3, 3, 3]) == 4
+
+
+def test_fast_train_available():
+    assert fast_train_available([5, 2, 7]) == 2
+    assert fast_train_available([5, -1, 7]) == 0
+    assert fast_train_available([]) == 0
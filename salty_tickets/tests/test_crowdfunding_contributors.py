@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from salty_tickets.crowdfunding_contributors import get_contributors_page
+from salty_tickets.database import db_session
+from salty_tickets.models import Event, Registration, Order, CrowdfundingRegistrationProperties
+
+
+def create_contributors(count):
+    event = Event(name='Test Campaign', start_date=datetime(2018, 4, 6), event_type='crowdfunding')
+    db_session.add(event)
+    registered_datetime = datetime(2018, 1, 1)
+    for n in range(count):
+        # every second pair of contributors registered at the same time
+        registered_datetime += timedelta(minutes=n % 2)
+        registration = Registration(name='Contributor {}'.format(n), email='c{}@test.com'.format(n),
+                                    registered_datetime=registered_datetime)
+        registration.crowdfunding_registration_properties = \
+            CrowdfundingRegistrationProperties(anonymous=(n % 3 == 0))
+        db_session.add(Order(event=event, registration=registration, total_price=n))
+    db_session.commit()
+    return event
+
+
+def test_get_contributors_page(sqlite_db):
+    event = create_contributors(7)
+    contributors = []
+    cursor = None
+    pages = 0
+    while True:
+        page = get_contributors_page(event.id, cursor, page_size=3)
+        contributors += page.contributors
+        pages += 1
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert [c.amount for c in contributors] == [6, 5, 4, 3, 2, 1, 0]
+    assert [c.name for c in contributors] == [None, 'Contributor 5', 'Contributor 4', None,
+                                              'Contributor 2', 'Contributor 1', None]
+    assert [c.anonymous for c in contributors] == [True, False, False, True, False, False, True]
+
+
+def test_get_contributors_page_invalid_cursor(sqlite_db):
+    event = create_contributors(1)
+    with pytest.raises(ValueError):
+        get_contributors_page(event.id, 'invalid')
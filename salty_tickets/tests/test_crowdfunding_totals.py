@@ -0,0 +1,72 @@
+from datetime import datetime
+
+import pytest
+
+from salty_tickets.crowdfunding_totals import get_crowdfunding_totals, verify_crowdfunding_totals, \
+    rebuild_crowdfunding_totals
+from salty_tickets.database import db_session
+from salty_tickets.models import Event, Product, Order, OrderProduct, Payment, CrowdfundingTotal, \
+    PAYMENT_STATUS_PAID, CROWDFUNDING_TOTAL_ALL_PRODUCTS
+from salty_tickets.payments import update_order
+from salty_tickets.pricing_rules import get_total_raised
+
+
+def create_crowdfunding_event():
+    event = Event(name='Test Campaign', start_date=datetime(2018, 4, 6), event_type='crowdfunding')
+    event.products.append(Product(name='Donate', product_type='DonateProduct', price=0))
+    event.products.append(Product(name='Reward', product_type='MarketingProduct', price=25))
+    db_session.add(event)
+    db_session.commit()
+    return event
+
+
+def pay_order(event, prices, paid=True):
+    order = Order(event=event, total_price=sum(prices.values()))
+    for product, price in prices.items():
+        order.order_products.append(OrderProduct(product, price))
+    payment = Payment(amount=order.total_price, status=PAYMENT_STATUS_PAID if paid else None)
+    order.payments.append(payment)
+    db_session.add(order)
+    db_session.commit()
+    update_order(order)
+    db_session.commit()
+    return order
+
+
+def test_crowdfunding_totals_updated_on_payment(sqlite_db):
+    event = create_crowdfunding_event()
+    donate, reward = event.products.order_by(Product.id).all()
+
+    pay_order(event, {donate: 10.5})
+    pay_order(event, {donate: 4.2, reward: 25})
+    order = pay_order(event, {reward: 25}, paid=False)
+
+    total_stats = get_total_raised(event)
+    assert total_stats['amount'] == pytest.approx(39.7)
+    assert total_stats['contributors'] == 2
+    assert total_stats['products'][donate.id] == (pytest.approx(14.7), 2)
+    assert total_stats['products'][reward.id] == (25, 1)
+    assert verify_crowdfunding_totals() == []
+
+    # paying the same order twice doesn't count it again
+    order.payments[0].status = PAYMENT_STATUS_PAID
+    update_order(order)
+    update_order(order)
+    db_session.commit()
+    assert get_crowdfunding_totals(event.id)[CROWDFUNDING_TOTAL_ALL_PRODUCTS] == (pytest.approx(64.7), 3)
+    assert verify_crowdfunding_totals() == []
+
+
+def test_rebuild_crowdfunding_totals(sqlite_db):
+    event = create_crowdfunding_event()
+    donate = event.products.first()
+    pay_order(event, {donate: 10})
+
+    CrowdfundingTotal.query.delete()
+    db_session.commit()
+    assert get_total_raised(event)['amount'] == 0
+    assert len(verify_crowdfunding_totals()) == 2
+
+    rebuild_crowdfunding_totals()
+    assert get_total_raised(event)['amount'] == 10
+    assert verify_crowdfunding_totals() == []
@@ -0,0 +1,92 @@
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from salty_tickets import emails
+from salty_tickets.database import db_session
+from salty_tickets.email_outbox import EmailOutboxSender, get_email_outbox_metrics
+from salty_tickets.emails import queue_email
+from salty_tickets.models import EmailOutbox, EMAIL_STATUS_SENT, EMAIL_STATUS_PENDING, EMAIL_STATUS_FAILED
+
+
+@pytest.fixture
+def mailgun_stub(monkeypatch):
+    # local stand-in for the Mailgun API, replies with the queued responses, then with 200
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with server.lock:
+                status, headers = server.responses.pop(0) if server.responses else (200, {})
+                server.requests_count += 1
+                server.bodies.append(body)
+                reply = '{{"id": "<{}@mailgun>"}}'.format(server.requests_count).encode()
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('localhost', 0), Handler)
+    server.lock = threading.Lock()
+    server.responses = []
+    server.requests_count = 0
+    server.bodies = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(emails, 'MAILGUN_MESSAGES_URL', 'http://localhost:{}/messages'.format(server.server_address[1]))
+    yield server
+    server.shutdown()
+
+
+def test_email_outbox_sender(sqlite_db, mailgun_stub):
+    for n in range(10):
+        queue_email('from@test.com', 'to{}@test.com'.format(n), 'Subject', 'Text', '<p>Html</p>')
+    mailgun_stub.responses = [(429, {'Retry-After': '60'}), (400, {})]
+
+    sender = EmailOutboxSender(workers=4, rate=100)
+    now = datetime.utcnow()
+    assert sender.send_pending(now=now) == 10
+    assert mailgun_stub.requests_count == 10
+
+    metrics = get_email_outbox_metrics()
+    assert metrics[EMAIL_STATUS_SENT] == 8
+    assert metrics[EMAIL_STATUS_FAILED] == 1
+    assert metrics['queue_depth'] == 1
+
+    # nothing is due until the retry time
+    assert sender.send_pending(now=now + timedelta(seconds=30)) == 0
+    assert sender.send_pending(now=now + timedelta(seconds=61)) == 1
+    assert EmailOutbox.query.filter_by(status=EMAIL_STATUS_PENDING).count() == 0
+    assert EmailOutbox.query.filter_by(status=EMAIL_STATUS_SENT).count() == 9
+    assert mailgun_stub.requests_count == 11
+
+
+def test_email_outbox_sender_retries(sqlite_db, mailgun_stub):
+    email_id = queue_email('from@test.com', 'to@test.com', 'Subject', 'Text', None).id
+    mailgun_stub.responses = [(500, {})] * 3
+
+    sender = EmailOutboxSender(workers=1, rate=100, max_attempts=3)
+    now = datetime.utcnow()
+    for n in range(3):
+        sender.send_pending(now=now + timedelta(hours=n))
+
+    email = EmailOutbox.query.get(email_id)
+    assert email.status == EMAIL_STATUS_FAILED
+    assert email.attempts == 3
+    assert email.last_error.startswith('500')
+
+
+def test_email_outbox_attachments(sqlite_db, mailgun_stub):
+    email_id = queue_email('from@test.com', 'to@test.com', 'Ticket', 'Text', None,
+                           files=[('attachment', ('ticket.pdf', b'%PDF-ticket'))]).id
+
+    EmailOutboxSender(workers=1, rate=100).send_pending()
+    email = EmailOutbox.query.get(email_id)
+    assert email.status == EMAIL_STATUS_SENT
+    assert email.provider_message_id == '<1@mailgun>'
+    assert b'filename="ticket.pdf"' in mailgun_stub.bodies[0]
+    assert b'%PDF-ticket' in mailgun_stub.bodies[0]
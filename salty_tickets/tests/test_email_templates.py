@@ -0,0 +1,59 @@
+import pytest
+from flask import Flask
+from jinja2 import DictLoader
+from salty_tickets.email_templates import compile_email_template, protect_jinja_tags, EmailTemplateError
+
+LAYOUT = '<html><head>{% block styles %}{% endblock %}</head><body>{% block content %}{% endblock %}</body></html>'
+
+EMAIL = '''{% import "macros.html" as macros %}
+{%- extends "layout.html" %}
+{% block styles %}<link href="static/email.css" rel="stylesheet"><style>.name {font-weight: bold}</style>{% endblock %}
+{% block content %}
+{# not rendered #}
+<p class="greeting">Dear, <span class="name">{{ name }}</span></p>
+{% for item in items %}
+<a class="item" href="{{ item.url }}">{{ macros.item_title(item) }}</a>
+{% endfor %}
+{% endblock %}'''
+
+
+@pytest.fixture
+def email_app(tmp_path):
+    app = Flask(__name__, root_path=str(tmp_path))
+    (tmp_path / 'static').mkdir()
+    (tmp_path / 'static' / 'email.css').write_text('.greeting {color: red} .item {color: blue}')
+    app.jinja_loader = DictLoader({
+        'layout.html': LAYOUT,
+        'email.html': EMAIL,
+        'macros.html': '{% macro item_title(item) %}[{{ item.title }}]{% endmacro %}',
+        'broken.html': '<p class="x{% if y %} y{% endif %}">text</p>',
+    })
+    return app
+
+
+def test_compile_email_template(email_app):
+    with email_app.app_context():
+        template = compile_email_template('email.html')
+    html = template.render(name='<Ann>', items=[dict(url='/a?b=1&c=2', title='A'), dict(url='/b', title='B')])
+    assert '<style' not in html
+    assert '<p class="greeting" style="color:red">' in html
+    assert '<span class="name" style="font-weight:bold">&lt;Ann&gt;</span>' in html
+    assert '<a class="item" href="/a?b=1&amp;c=2" style="color:blue">[A]</a>' in html
+    assert '<a class="item" href="/b" style="color:blue">[B]</a>' in html
+    assert 'not rendered' not in html
+
+
+def test_protect_jinja_tags():
+    source, tags, imports = protect_jinja_tags(EMAIL)
+    assert imports == ['{% import "macros.html" as macros %}']
+    assert '{%- extends "layout.html" %}' in source
+    assert '<span class="name">JINJA_0_</span>' in source
+    assert '<!--JINJA_1_-->' in source
+    assert '{{' not in source
+    assert tags[:2] == ['{{ name }}', '{% for item in items %}']
+
+
+def test_statement_inside_tag(email_app):
+    with email_app.app_context():
+        with pytest.raises(EmailTemplateError):
+            compile_email_template('broken.html')
@@ -0,0 +1,119 @@
+from datetime import datetime
+
+import pytest
+from salty_tickets.controllers import OrderSummaryController
+from salty_tickets.database import db_session
+from salty_tickets.models import Event, Product, Order, OrderProduct, Registration, RegistrationGroup, Payment, \
+    PaymentItem, SignupGroup, SIGNUP_GROUP_PARTNERS, ORDER_PRODUCT_STATUS_ACCEPTED, ORDER_PRODUCT_STATUS_WAITING, \
+    PAYMENT_STATUS_PAID
+from salty_tickets.order_summary import load_order_summary
+from sqlalchemy import event
+from sqlalchemy.orm.exc import NoResultFound
+
+
+def create_order(products_count):
+    test_event = Event(name='Test Event', start_date=datetime(2018, 4, 6))
+    group = RegistrationGroup(name='Test Group')
+    registration = Registration(name='Alex', email='alex@test.com', registration_group=group)
+    partner_registration = Registration(name='Sam', email='sam@test.com', registration_group=group)
+    user_order = Order(event=test_event, registration=registration, total_price=0)
+    payment = Payment(amount=0, transaction_fee=1, status=PAYMENT_STATUS_PAID)
+    user_order.payments.append(payment)
+
+    partner_order_product = None
+    for n in range(products_count):
+        if n % 2:
+            product = Product(name='Couples {}'.format(n), product_type='CouplesOnlyWorkshop', price=20,
+                              parameters_dict={'workshop_date': 'Saturday'})
+            order_product = OrderProduct(product, 20, {'partner_name': 'Kim'},
+                                         status=ORDER_PRODUCT_STATUS_WAITING)
+        else:
+            product = Product(name='Workshop {}'.format(n), product_type='RegularPartnerWorkshop', price=25,
+                              parameters_dict={'ratio': 1.5, 'allow_first': 0, 'workshop_date': 'Sunday'})
+            order_product = OrderProduct(product, 25, {'dance_role': 'leader'}, status=ORDER_PRODUCT_STATUS_ACCEPTED)
+            if partner_order_product is None:
+                partner_order_product = OrderProduct(product, 25, {'dance_role': 'follower'},
+                                                     status=ORDER_PRODUCT_STATUS_ACCEPTED,
+                                                     registration=partner_registration)
+                db_session.add(SignupGroup(type=SIGNUP_GROUP_PARTNERS,
+                                           order_products=[order_product, partner_order_product]))
+        test_event.products.append(product)
+        order_product.registration = registration
+        user_order.order_products.append(order_product)
+        user_order.total_price += order_product.price
+        payment.payment_items.append(PaymentItem(amount=order_product.price, order_product=order_product))
+    payment.payment_items.append(PaymentItem(amount=3, description='Donation'))
+    payment.amount = user_order.total_price + 3
+    db_session.add(user_order)
+    db_session.commit()
+    order_id = user_order.id
+    db_session.remove()
+    return order_id
+
+
+def count_queries(engine, func):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        func()
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return len(statements)
+
+
+def read_order_summary(order_summary):
+    return {
+        'registration': (order_summary.registration_name, order_summary.registration_email),
+        'totals': (order_summary.total_price, order_summary.total_paid, order_summary.total_transaction_fee,
+                   order_summary.total_remaining_amount, order_summary.has_waiting_list),
+        'group': (order_summary.group.has_group, order_summary.group.name, order_summary.group.member_names,
+                  order_summary.group.token),
+        'order_products': [(op.name, op.status, op.price, op.is_waiting, op.waiting_reason,
+                            op.product_parameters.get('workshop_date'), op.product_info, op.token, op.total_paid,
+                            op.total_remaining, [item.full_description for item in op.payment_items])
+                           for op in order_summary.order_products],
+        'payment_items': [(item.full_description, item.amount, item.has_order_product,
+                           item.has_order_product and item.order_product_status,
+                           item.has_order_product and item.order_product_price)
+                          for item in order_summary.all_payment_items],
+    }
+
+
+def test_load_order_summary_query_count(sqlite_db):
+    query_counts = []
+    for products_count in [2, 6]:
+        order_id = create_order(products_count)
+        query_counts.append(count_queries(sqlite_db, lambda: read_order_summary(load_order_summary(order_id))))
+        db_session.remove()
+    # order, order products, details, partners, payments, payment items and group members
+    assert query_counts == [7, 7]
+
+
+def test_load_order_summary_same_as_controller(sqlite_db):
+    order_id = create_order(4)
+    expected = read_order_summary(OrderSummaryController(Order.query.get(order_id)))
+    db_session.remove()
+
+    order_summary = load_order_summary(order_id)
+    assert read_order_summary(order_summary) == expected
+    assert order_summary.order_products[0].partner_name == 'Sam'
+    assert order_summary.order_products[1].waiting_reason == \
+        'You are put in the waiting list until your partner signs up'
+
+
+def test_load_order_summary_payment(sqlite_db):
+    order_id = create_order(1)
+    other_order_id = create_order(1)
+    user_order = Order.query.get(order_id)
+    user_order.payments.append(Payment(amount=5, transaction_fee=2))
+    db_session.commit()
+    payment_id = user_order.payments[0].id
+
+    assert load_order_summary(order_id).transaction_fee == 1
+    assert load_order_summary(order_id, payment_id).transaction_fee == 1
+    with pytest.raises(NoResultFound):
+        load_order_summary(other_order_id, payment_id)
@@ -0,0 +1,106 @@
+import threading
+from datetime import datetime, timedelta
+
+import mock
+import pytest
+from salty_tickets.database import db_session
+from salty_tickets.models import Event, Order, Payment, PAYMENT_STATUS_PAID, PAYMENT_STATUS_FAILED, \
+    ORDER_STATUS_PAID, Product, CapacityHold
+from salty_tickets.payment_queue import process_payment_by_id, claim_payment, expire_stale_payments, \
+    PAYMENT_CLAIM_TTL
+from salty_tickets.reservations import take_capacity_hold
+
+
+def create_payment(amount=10):
+    event = Event(name='Test Event', start_date=datetime(2018, 4, 6))
+    user_order = Order(total_price=amount)
+    user_order.payments.append(Payment(amount=amount, transaction_fee=0))
+    event.orders.append(user_order)
+    db_session.add(event)
+    db_session.commit()
+    return user_order.payments[0].id
+
+
+def test_process_payment_by_id_charges_once(sqlite_db):
+    payment_id = create_payment()
+    db_session.remove()
+
+    def charge(payment, stripe_token, stripe_sk=None):
+        payment.status = PAYMENT_STATUS_PAID
+        return True, 'charged'
+
+    results = []
+
+    def worker():
+        try:
+            results.append(process_payment_by_id(payment_id, 'tok_visa'))
+        finally:
+            db_session.remove()
+
+    with mock.patch('salty_tickets.payments.charge', side_effect=charge) as charge_mock:
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert charge_mock.call_count == 1
+    assert sorted(results, key=str) == [None, None, None, None, True]
+    payment = Payment.query.get(payment_id)
+    assert payment.status == PAYMENT_STATUS_PAID
+    assert payment.order.status == ORDER_STATUS_PAID
+
+
+def test_process_payment_by_id_failed(sqlite_db):
+    payment_id = create_payment()
+    on_success = mock.Mock()
+
+    with mock.patch('salty_tickets.payments.charge', return_value=(False, 'Your card was declined.')):
+        assert process_payment_by_id(payment_id, 'tok_chargeDeclined', on_success=on_success) is False
+
+    payment = Payment.query.get(payment_id)
+    assert payment.status == PAYMENT_STATUS_FAILED
+    assert payment.failure_message == 'Your card was declined.'
+    assert not on_success.called
+    assert not claim_payment(db_session, payment_id)
+
+
+def test_process_payment_by_id_exception(sqlite_db):
+    payment_id = create_payment()
+
+    with mock.patch('salty_tickets.payments.charge', side_effect=RuntimeError('Stripe is down')):
+        with pytest.raises(RuntimeError):
+            process_payment_by_id(payment_id, 'tok_visa')
+
+    payment = Payment.query.get(payment_id)
+    assert payment.status == PAYMENT_STATUS_FAILED
+    assert payment.failure_message
+
+
+def test_expire_stale_payments(sqlite_db):
+    queued_payment_id = create_payment()
+    claimed_payment_id = create_payment()
+    assert claim_payment(db_session, claimed_payment_id)
+
+    assert expire_stale_payments() == 0
+    assert expire_stale_payments(now=datetime.utcnow() + PAYMENT_CLAIM_TTL + timedelta(minutes=1)) == 2
+    db_session.expire_all()
+    assert Payment.query.get(queued_payment_id).status == PAYMENT_STATUS_FAILED
+    assert Payment.query.get(claimed_payment_id).status == PAYMENT_STATUS_FAILED
+    assert not claim_payment(db_session, queued_payment_id)
+
+
+def test_claim_payment_extends_capacity_holds(sqlite_db):
+    payment_id = create_payment()
+    payment = Payment.query.get(payment_id)
+    product = Product(name='Workshop', product_type='RegularPartnerWorkshop', max_available=10,
+                      parameters_dict={'ratio': 1.5, 'allow_first': 0}, event_id=payment.order.event_id)
+    db_session.add(product)
+    db_session.flush()
+    hold = take_capacity_hold(db_session, product, 1, now=datetime.utcnow() - timedelta(minutes=14))
+    payment.order.capacity_holds.append(hold)
+    db_session.commit()
+
+    assert claim_payment(db_session, payment_id)
+    # not released by the sweeper while the card is charged
+    assert CapacityHold.query.get(hold.id).expires_at > datetime.utcnow() + PAYMENT_CLAIM_TTL - timedelta(minutes=1)
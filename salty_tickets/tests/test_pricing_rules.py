@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import pytest
+from flask import Flask
+
+from salty_tickets.database import db_session
+from salty_tickets.forms import create_event_form
+from salty_tickets.models import Event, Product, Registration, ORDER_PRODUCT_STATUS_ACCEPTED, \
+    ORDER_PRODUCT_STATUS_WAITING
+from salty_tickets.payments import stripe_amount
+from salty_tickets.pricing_rules import get_order_draft, create_order_from_draft
+
+
+@pytest.fixture
+def form_app():
+    app = Flask(__name__)
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['SECRET_KEY'] = 'test'
+    return app
+
+
+def create_event():
+    event = Event(name='Test Event', start_date=datetime(2018, 4, 6), event_key='test_event')
+    event.products.append(Product(name='Workshop', product_type='RegularPartnerWorkshop', price=25, max_available=10,
+                                  parameters_dict={'ratio': 1.5, 'allow_first': 1}))
+    event.products.append(Product(name='Party', product_type='RegularPartnerWorkshop', price=10, max_available=10,
+                                  parameters_dict={'ratio': 1.5, 'allow_first': 1}))
+    db_session.add(event)
+    db_session.commit()
+    return event
+
+
+def test_order_draft(sqlite_db, form_app):
+    event = create_event()
+    data = {'name': 'Alex', 'email': 'alex@test.com', 'partner_name': 'Sam', 'partner_email': 'sam@test.com',
+            'workshop-add': 'couple', 'party-add': 'leader'}
+    with form_app.test_request_context('/', method='POST', data=data):
+        form = create_event_form(event)()
+        registration = Registration(name='Alex', email='alex@test.com')
+        partner_registration = Registration(name='Sam', email='sam@test.com')
+
+        order_draft = get_order_draft(event, form, registration, partner_registration)
+        assert not db_session.new
+        assert [(line_item.name, line_item.price, line_item.status) for line_item in order_draft.line_items] == [
+            ('Workshop (Alex / leader)', 25, ORDER_PRODUCT_STATUS_ACCEPTED),
+            ('Workshop (Sam / follower)', 25, ORDER_PRODUCT_STATUS_ACCEPTED),
+            ('Party (Alex / leader)', 10, ORDER_PRODUCT_STATUS_WAITING),
+        ]
+        assert [line_item.for_partner for line_item in order_draft.line_items] == [False, True, False]
+        assert order_draft.get_waiting_reason(order_draft.line_items[2]) == \
+            'You are put on the waiting list due to the current imbalance in leads and followers'
+
+        user_order = create_order_from_draft(order_draft)
+        assert [(op.product.name, op.price, op.status, op.registration.name)
+                for op in user_order.order_products] == [
+            ('Workshop', 25, ORDER_PRODUCT_STATUS_ACCEPTED, 'Alex'),
+            ('Workshop', 25, ORDER_PRODUCT_STATUS_ACCEPTED, 'Sam'),
+            ('Party', 10, ORDER_PRODUCT_STATUS_WAITING, 'Alex'),
+        ]
+        assert user_order.total_price == order_draft.products_price
+        assert stripe_amount(user_order.payments[0]) == order_draft.stripe_amount
+        db_session.rollback()
@@ -2,9 +2,13 @@ import datetime
 import mock
 
 import pytest
+from salty_tickets.database import db_session
 from salty_tickets.forms import create_event_form, SignupForm, FormWithProducts
+from salty_tickets.inventory import rebuild_product_inventory, verify_product_inventory, get_product_inventory
 from salty_tickets.products import CouplesOnlyWorkshop, RegularPartnerWorkshop, WorkshopRegStats
-from salty_tickets.models import Product, Event, DANCE_ROLE_LEADER, DANCE_ROLE_FOLLOWER
+from salty_tickets.registration_stats import WaitingQueueItem, get_waiting_queue
+from salty_tickets.models import Product, Event, Order, OrderProduct, DANCE_ROLE_LEADER, DANCE_ROLE_FOLLOWER, \
+    ORDER_STATUS_PAID, ORDER_PRODUCT_STATUS_WAITING
 from wtforms import Form
 
 
@@ -142,4 +146,64 @@ def test_RegularPartnerWorkshop_get_waiting_lists(get_registration_stats):
               res_leads=0, res_follows=6, res_leads_with_partn=0, res_follows_with_partn=1)
 
 
-
+def test_RegularPartnerWorkshop_get_balanced_waiting_list():
+    product_model = mock.Mock(spec=Product)
+    product_model.max_available = 10
+    product_model.parameters_as_dict = {'ratio': '1.5', 'allow_first': '2'}
+
+    reg_stats = {DANCE_ROLE_LEADER: WorkshopRegStats(4, 2), DANCE_ROLE_FOLLOWER: WorkshopRegStats(3, 2)}
+    waiting_queue = [
+        WaitingQueueItem(1, DANCE_ROLE_LEADER, False),
+        WaitingQueueItem(2, DANCE_ROLE_FOLLOWER, False),
+        WaitingQueueItem(3, DANCE_ROLE_LEADER, False),
+        WaitingQueueItem(4, DANCE_ROLE_FOLLOWER, True),
+    ]
+    accepted = RegularPartnerWorkshop.get_balanced_waiting_list(product_model, reg_stats, waiting_queue)
+    # partnered follower goes first, then first come first served while the class stays balanced
+    assert [item.order_product_id for item in accepted] == [4, 1, 2]
+
+    # places held for checkouts in progress are not given away
+    accepted = RegularPartnerWorkshop.get_balanced_waiting_list(product_model, reg_stats, waiting_queue, held=2)
+    assert [item.order_product_id for item in accepted] == [4]
+
+    # no places left
+    reg_stats = {DANCE_ROLE_LEADER: WorkshopRegStats(5, 2), DANCE_ROLE_FOLLOWER: WorkshopRegStats(5, 2)}
+    assert RegularPartnerWorkshop.get_balanced_waiting_list(product_model, reg_stats, waiting_queue) == []
+
+
+def test_RegularPartnerWorkshop_balance_waiting_list_accepted_by_other_worker(sqlite_db):
+    event = Event(name='Test Event', start_date=datetime.datetime(2018, 4, 6))
+    product_model = Product(name='Workshop', product_type='RegularPartnerWorkshop', max_available=10,
+                            parameters_dict={'ratio': 1.5, 'allow_first': 2})
+    event.products.append(product_model)
+    order = Order(event=event, total_price=0, status=ORDER_STATUS_PAID)
+    for dance_role in [DANCE_ROLE_LEADER, DANCE_ROLE_FOLLOWER]:
+        order.order_products.append(OrderProduct(product_model, 10, {'dance_role': dance_role},
+                                                 status=ORDER_PRODUCT_STATUS_WAITING))
+    db_session.add(order)
+    db_session.commit()
+    rebuild_product_inventory(event.id)
+
+    reg_stats = RegularPartnerWorkshop.get_registration_stats(product_model)
+    waiting_queue = get_waiting_queue(product_model.id)
+    # another payment worker accepts the leader after the waiting queue is read
+    leader = order.order_products.filter_by(dance_role=DANCE_ROLE_LEADER).one()
+    RegularPartnerWorkshop.accept_from_waiting_list(leader)
+
+    results = RegularPartnerWorkshop.balance_waiting_list(product_model, reg_stats=reg_stats,
+                                                          waiting_queue=waiting_queue, held=0)
+    assert [op.dance_role for op in results] == [DANCE_ROLE_FOLLOWER]
+    assert get_product_inventory(product_model.id).accepted == 2
+    assert verify_product_inventory(event.id) == []
+
+
+def test_Product_parameters_keep_json_values():
+    product_model = Product(name='Workshop', product_type='RegularPartnerWorkshop',
+                            parameters_dict={'ratio': 1.5, 'allow_first': 2, 'make_public': False, 'includes': None,
+                                             'workshop_date': datetime.date(2018, 4, 7)})
+    assert dict(product_model.parameters_as_dict) == {
+        'ratio': 1.5, 'allow_first': 2, 'make_public': False, 'includes': None, 'workshop_date': '2018-04-07'}
+
+    product_model.add_parameters({'allow_first': 4})
+    assert product_model.parameters_as_dict['allow_first'] == 4
+    assert product_model.parameters_as_dict['ratio'] == 1.5
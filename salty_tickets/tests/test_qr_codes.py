@@ -0,0 +1,35 @@
+import mock
+import pytest
+from salty_tickets import qr_codes
+from salty_tickets.qr_codes import get_qr_code, get_qr_code_data_uri
+
+
+@pytest.fixture
+def qr_code_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(qr_codes, 'QR_CODE_CACHE_DIR', str(tmpdir))
+    get_qr_code.cache_clear()
+    yield tmpdir
+    get_qr_code.cache_clear()
+
+
+def test_get_qr_code(qr_code_cache):
+    png = get_qr_code('/mts/abcdefgh', 'png')
+    assert png.content.startswith(b'\x89PNG')
+    assert png.mimetype == 'image/png'
+    svg = get_qr_code('/mts/abcdefgh', 'svg')
+    assert b'<svg' in svg.content
+    assert svg.etag != png.etag != get_qr_code('/mts/abcdefgi', 'png').etag
+    assert get_qr_code_data_uri('/mts/abcdefgh').startswith('data:image/png;base64,')
+
+    with pytest.raises(ValueError):
+        get_qr_code('/mts/abcdefgh', 'gif')
+
+
+def test_get_qr_code_cached(qr_code_cache):
+    with mock.patch.object(qr_codes, 'render_qr_code', wraps=qr_codes.render_qr_code) as render_mock:
+        qr_code = get_qr_code('/mts/abcdefgh')
+        assert get_qr_code('/mts/abcdefgh') is qr_code
+        # from the disk cache
+        get_qr_code.cache_clear()
+        assert get_qr_code('/mts/abcdefgh') == qr_code
+        assert render_mock.call_count == 1
@@ -0,0 +1,153 @@
+import threading
+from datetime import datetime, timedelta
+
+from salty_tickets.database import db_session
+from salty_tickets.inventory import get_product_inventory, verify_product_inventory
+from salty_tickets.models import Event, Product, CapacityHold, Order, OrderProduct, DANCE_ROLE_LEADER, \
+    DANCE_ROLE_FOLLOWER, ORDER_PRODUCT_STATUS_ACCEPTED, ORDER_PRODUCT_STATUS_WAITING
+from salty_tickets.reservations import take_capacity_hold, release_capacity_hold, expire_capacity_holds, \
+    reserve_order_capacity, renew_order_capacity, CAPACITY_HOLD_TTL
+
+
+def create_product(max_available, allow_first=0):
+    event = Event(name='Test Event', start_date=datetime(2018, 4, 6))
+    product = Product(name='Workshop', product_type='RegularPartnerWorkshop', max_available=max_available,
+                      parameters_dict={'ratio': 1.5, 'allow_first': allow_first})
+    event.products.append(product)
+    db_session.add(event)
+    db_session.commit()
+    return product.id
+
+
+def test_take_capacity_hold_concurrent(sqlite_db):
+    product_id = create_product(max_available=10)
+    results = []
+
+    def checkout():
+        try:
+            product_model = Product.query.get(product_id)
+            hold = take_capacity_hold(db_session, product_model, 1)
+            db_session.commit()
+            results.append(hold is not None)
+        finally:
+            db_session.remove()
+
+    threads = [threading.Thread(target=checkout) for _ in range(40)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 40
+    assert results.count(True) == 10
+    assert get_product_inventory(product_id).held == 10
+    assert CapacityHold.query.filter_by(product_id=product_id).count() == 10
+    assert verify_product_inventory() == []
+
+
+def test_take_capacity_hold_couple(sqlite_db):
+    product_id = create_product(max_available=3)
+    product_model = Product.query.get(product_id)
+
+    assert take_capacity_hold(db_session, product_model, 2) is not None
+    assert take_capacity_hold(db_session, product_model, 2) is None
+    assert take_capacity_hold(db_session, product_model, 1) is not None
+    db_session.commit()
+    assert get_product_inventory(product_id).held == 3
+
+
+def test_release_and_expire_capacity_holds(sqlite_db):
+    product_id = create_product(max_available=2)
+    product_model = Product.query.get(product_id)
+    now = datetime.utcnow()
+
+    hold = take_capacity_hold(db_session, product_model, 1, now=now)
+    take_capacity_hold(db_session, product_model, 1, now=now - CAPACITY_HOLD_TTL)
+    db_session.commit()
+    assert take_capacity_hold(db_session, product_model, 1) is None
+
+    # released twice, places given back once
+    assert release_capacity_hold(db_session, hold)
+    assert not release_capacity_hold(db_session, hold)
+    db_session.commit()
+    assert get_product_inventory(product_id).held == 1
+
+    assert expire_capacity_holds(now=now + timedelta(seconds=1)) == 1
+    db_session.commit()
+    assert get_product_inventory(product_id).held == 0
+    assert verify_product_inventory() == []
+
+
+def create_order(product_model, dance_roles):
+    user_order = Order(total_price=0)
+    for dance_role in dance_roles:
+        user_order.order_products.append(OrderProduct(product_model, 0, dict(dance_role=dance_role),
+                                                      status=ORDER_PRODUCT_STATUS_ACCEPTED))
+    user_order.event_id = product_model.event_id
+    db_session.add(user_order)
+    return user_order
+
+
+def test_take_capacity_hold_dance_role(sqlite_db):
+    product_id = create_product(max_available=10, allow_first=2)
+    product_model = Product.query.get(product_id)
+
+    assert take_capacity_hold(db_session, product_model, 1, dance_role=DANCE_ROLE_LEADER, role_capacity=1)
+    # the ratio limit of the role, the place on the product is given back
+    assert take_capacity_hold(db_session, product_model, 1, dance_role=DANCE_ROLE_LEADER, role_capacity=1) is None
+    assert take_capacity_hold(db_session, product_model, 1, dance_role=DANCE_ROLE_FOLLOWER, role_capacity=1)
+    db_session.commit()
+    assert get_product_inventory(product_id).held == 2
+    assert get_product_inventory(product_id, DANCE_ROLE_LEADER).held == 1
+    assert get_product_inventory(product_id, DANCE_ROLE_FOLLOWER).held == 1
+    assert verify_product_inventory() == []
+
+
+def test_reserve_order_capacity_ratio(sqlite_db):
+    product_id = create_product(max_available=10, allow_first=2)
+    product_model = Product.query.get(product_id)
+
+    solo_orders = [create_order(product_model, [DANCE_ROLE_LEADER]) for _ in range(2)]
+    couple_order = create_order(product_model, [DANCE_ROLE_LEADER, DANCE_ROLE_FOLLOWER])
+    assert reserve_order_capacity(solo_orders[0]) == []
+    # with one leader held and no followers accepted the next solo leader waits, a couple doesn't
+    assert reserve_order_capacity(solo_orders[1]) == solo_orders[1].order_products.all()
+    assert reserve_order_capacity(couple_order) == []
+    db_session.commit()
+
+    assert solo_orders[1].order_products[0].status == ORDER_PRODUCT_STATUS_WAITING
+    assert get_product_inventory(product_id).held == 3
+    assert get_product_inventory(product_id, DANCE_ROLE_LEADER).held == 2
+    assert verify_product_inventory() == []
+
+
+def test_renew_order_capacity(sqlite_db):
+    product_id = create_product(max_available=2)
+    product_model = Product.query.get(product_id)
+    now = datetime.utcnow()
+
+    user_order = create_order(product_model, [DANCE_ROLE_LEADER, DANCE_ROLE_FOLLOWER])
+    reserve_order_capacity(user_order, now=now)
+    db_session.commit()
+
+    # extended while the holds are still valid
+    assert renew_order_capacity(user_order, timedelta(hours=1), now=now) == []
+    db_session.commit()
+    assert expire_capacity_holds(now=now + CAPACITY_HOLD_TTL + timedelta(seconds=1)) == 0
+
+    # taken again once they have expired, if the places are still available
+    later = now + timedelta(hours=2)
+    assert renew_order_capacity(user_order, now=later) == []
+    db_session.commit()
+    assert CapacityHold.query.filter(CapacityHold.expires_at > later).count() == 2
+    assert get_product_inventory(product_id).held == 2
+
+    expire_capacity_holds(now=later + CAPACITY_HOLD_TTL + timedelta(seconds=1))
+    other_order = create_order(product_model, [DANCE_ROLE_FOLLOWER, DANCE_ROLE_LEADER])
+    reserve_order_capacity(other_order)
+    db_session.commit()
+    assert renew_order_capacity(user_order) == user_order.order_products.all()
+    db_session.commit()
+    assert get_product_inventory(product_id).held == 2
+    assert user_order.capacity_holds.count() == 0
+    assert verify_product_inventory() == []
@@ -0,0 +1,71 @@
+import os
+from datetime import datetime
+
+import mock
+from salty_tickets import ticket_pdfs
+from salty_tickets.database import db_session
+from salty_tickets.models import Event, Order, OrderProduct, Registration
+from salty_tickets.pricing_rules import add_payment_to_user_order
+from salty_tickets.products import RegularPartnerWorkshop
+from salty_tickets.ticket_pdfs import TicketPdfRenderer
+
+
+def fake_write_ticket_pdf(ticket_html, pdf_path, base_url):
+    os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+    with open(pdf_path, 'w') as f:
+        f.write(ticket_html)
+    return pdf_path
+
+
+def create_registrations():
+    event = Event(name='Mind the Shag', start_date=datetime(2018, 4, 6), event_key='mts')
+    workshop = RegularPartnerWorkshop(name='Workshop', price=30, max_available=10, ratio=1.5, allow_first=2,
+                                      info='', workshop_date='7-April-2018', workshop_time='10:00').model
+    event.products.append(workshop)
+    user_order = Order(total_price=60)
+    user_order.registration = Registration(name='Ann', email='ann@example.com')
+    partner = Registration(name='Bob', email='bob@example.com')
+    for registration, dance_role in [(user_order.registration, 'leader'), (partner, 'follower')]:
+        order_product = OrderProduct(workshop, 30, dict(dance_role=dance_role), status='accepted')
+        order_product.registration = registration
+        user_order.order_products.append(order_product)
+    event.orders.append(user_order)
+    db_session.add(event)
+    db_session.commit()
+    add_payment_to_user_order(user_order)
+    db_session.commit()
+    return [user_order.registration.id, partner.id]
+
+
+def test_ticket_pdfs_cached_by_content(sqlite_db, tmpdir):
+    registration_ids = create_registrations()
+    get_registrations = lambda: [Registration.query.get(registration_id) for registration_id in registration_ids]
+    renderer = TicketPdfRenderer(workers=2, cache_dir=str(tmpdir))
+    with mock.patch.object(ticket_pdfs, 'write_ticket_pdf', fake_write_ticket_pdf):
+        pdf_paths = renderer.render(get_registrations())
+        assert renderer.rendered_count == 2
+        assert 'Ann' in open(pdf_paths[0]).read()
+        assert 'Bob' in open(pdf_paths[1]).read()
+
+        assert renderer.render(get_registrations()) == pdf_paths
+        assert renderer.rendered_count == 2
+
+        get_registrations()[1].order_products[0].status = 'waiting'
+        db_session.commit()
+        new_pdf_paths = renderer.render(get_registrations())
+        assert new_pdf_paths[0] == pdf_paths[0]
+        assert new_pdf_paths[1] != pdf_paths[1]
+        assert renderer.rendered_count == 3
+
+
+def test_static_urls_fetched_from_disk():
+    base_url = 'https://tickets.example.com'
+    result = ticket_pdfs._cached_url_fetcher(base_url + '/static/bootstrap.min.css', base_url=base_url)
+    with open(os.path.join(ticket_pdfs.app.static_folder, 'bootstrap.min.css'), 'rb') as f:
+        assert result['string'] == f.read()
+    assert result['mime_type'] == 'text/css'
+
+    assert ticket_pdfs.get_static_file_path(base_url + '/static/bootstrap.min.css', base_url)
+    assert ticket_pdfs.get_static_file_path(base_url + '/static/../config.py', base_url) is None
+    assert ticket_pdfs.get_static_file_path(base_url + '/mts', base_url) is None
+    assert ticket_pdfs.get_static_file_path('https://cdn.example.com/static/bootstrap.min.css', base_url) is None
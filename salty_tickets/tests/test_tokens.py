@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+from itsdangerous import BadSignature
+from salty_tickets.database import db_session
+from salty_tickets.models import Order, Registration, Event, Product, OrderProduct, SignupGroup
+from salty_tickets.tokens import PartnerToken, RegistrationToken, get_hashids, order_serialize, order_deserialize, \
+    order_product_serialize, get_partner_tokens_info, get_partner_token_info, clear_identity_cache
+from sqlalchemy import event
+from sqlalchemy.orm.exc import NoResultFound
+
+
+@pytest.fixture
+def query_counter(sqlite_db):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(sqlite_db, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(sqlite_db, 'before_cursor_execute', before_cursor_execute)
+
+
+def create_registrations(count):
+    registrations = [Registration(name='Dancer {}'.format(n), email='dancer{}@example.com'.format(n))
+                     for n in range(count)]
+    db_session.add_all(registrations)
+    db_session.commit()
+    return [r.id for r in registrations]
+
+
+def test_codecs_created_once():
+    assert get_hashids('salt', 5) is get_hashids('salt', 5)
+    assert get_hashids('salt', 5) is not get_hashids('other salt', 5)
+
+
+def test_deserialize_many(query_counter):
+    registration_ids = create_registrations(5)
+    token = PartnerToken()
+    tokens = [token.serialize(Registration.query.get(id)) for id in registration_ids]
+    db_session.remove()
+
+    del query_counter[:]
+    registrations = token.deserialize_many(tokens + ['ptn_invalid', 'invalid', RegistrationToken().code_to_str('x')])
+    assert len(query_counter) == 1
+    assert [registrations[t].id for t in tokens] == registration_ids
+    assert len(registrations) == 5
+
+
+def test_identity_cache(query_counter):
+    registration_id, = create_registrations(1)
+    token = PartnerToken().serialize(Registration.query.get(registration_id))
+    db_session.remove()
+
+    with Flask(__name__).app_context():
+        del query_counter[:]
+        registration = PartnerToken().deserialize(token)
+        assert PartnerToken().deserialize(token) is registration
+        assert PartnerToken().deserialize_many([token]) == {token: registration}
+        assert len(query_counter) == 1
+
+        # a new database session, e.g. the next request
+        db_session.remove()
+        assert PartnerToken().deserialize(token).id == registration_id
+        assert len(query_counter) == 2
+
+        # a long app context of a worker, the objects are not kept after a commit
+        db_session.commit()
+        assert PartnerToken().deserialize(token).id == registration_id
+        assert len(query_counter) == 3
+
+        clear_identity_cache()
+        assert PartnerToken().deserialize(token).id == registration_id
+        assert len(query_counter) == 4
+
+    with pytest.raises(BadSignature):
+        PartnerToken().deserialize('ptn_invalid')
+    with pytest.raises(NoResultFound):
+        order_deserialize(order_serialize(Order(id=1000)))
+
+
+def test_get_partner_tokens_info(query_counter):
+    event = Event(name='Test Event', start_date=datetime(2018, 4, 6))
+    workshop = Product('Workshop', 'RegularPartnerWorkshop', price=30)
+    event.products.append(workshop)
+    order_products = []
+    for n, order_datetime in enumerate([datetime.now(), datetime.now() - timedelta(days=2), datetime.now()]):
+        user_order = Order(total_price=30, order_datetime=order_datetime)
+        user_order.registration = Registration(name='Dancer {}'.format(n), email='dancer{}@example.com'.format(n))
+        order_product = OrderProduct(workshop, 30, dict(dance_role='leader'), status='accepted')
+        order_product.registration = user_order.registration
+        user_order.order_products.append(order_product)
+        event.orders.append(user_order)
+        order_products.append(order_product)
+    db_session.add(event)
+    db_session.add(SignupGroup(type='partners', order_products=[order_products[2]]))
+    db_session.commit()
+    tokens = [order_product_serialize(op) for op in order_products]
+    workshop_id = workshop.id
+    db_session.remove()
+
+    with Flask(__name__).app_context():
+        del query_counter[:]
+        tokens_info = get_partner_tokens_info(tokens + ['invalid'])
+        assert len(query_counter) == 1
+        assert [tokens_info[t].registration_name for t in tokens] == ['Dancer 0', 'Dancer 1', 'Dancer 2']
+        assert [tokens_info[t].has_partners for t in tokens] == [False, False, True]
+        assert [tokens_info[t].is_expired(60*60*24) for t in tokens] == [False, True, False]
+        assert tokens_info[tokens[0]].dance_role == 'leader'
+        assert tokens_info[tokens[0]].product_id == workshop_id
+
+        assert get_partner_token_info(tokens[1]) is tokens_info[tokens[1]]
+        assert len(query_counter) == 1
+    with pytest.raises(BadSignature):
+        get_partner_token_info('invalid')
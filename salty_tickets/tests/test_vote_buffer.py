@@ -0,0 +1,86 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+from salty_tickets import vote_buffer as vote_buffer_module
+from salty_tickets.database import db_session
+from salty_tickets.models import Vote
+from salty_tickets.vote_buffer import VoteBuffer, VoteJournal, recover_vote_journals
+
+
+def test_vote_buffer(sqlite_db, tmpdir):
+    flushes = []
+    journal_dir = tmpdir.mkdir('journal')
+    vote_buffer = VoteBuffer(flush_interval=0.05, flush_size=20, journal_dir=str(journal_dir),
+                             on_flush=lambda: flushes.append(1))
+
+    def voter(n):
+        for vote in ['left', 'right', 'left']:
+            vote_buffer.submit('voter{}'.format(n), vote)
+
+    threads = [threading.Thread(target=voter, args=(n,)) for n in range(30)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert vote_buffer.flush(timeout=10)
+
+    db_session.remove()
+    assert Vote.query.count() == 90
+    assert Vote.query.filter_by(voter_id='voter7').count() == 3
+    assert vote_buffer.flushed_count == 90
+    assert 0 < len(flushes) < 90
+    # only the journal of the next votes is left
+    assert len(journal_dir.listdir()) == 1
+
+    vote_buffer.submit('voter0', 'right')
+    vote_buffer.close()
+    db_session.remove()
+    assert Vote.query.count() == 91
+    assert journal_dir.listdir() == []
+
+
+def test_vote_buffer_flush_long_interval(sqlite_db):
+    # flushed straight away, even if the writer isn't waiting for the votes yet
+    vote_buffer = VoteBuffer(flush_interval=60, journal_dir=None)
+    vote_buffer.submit('voter1', 'left')
+    assert vote_buffer.flush(timeout=5)
+    vote_buffer.close()
+    db_session.remove()
+    assert Vote.query.count() == 1
+
+
+def test_vote_buffer_without_fcntl(sqlite_db, tmpdir, monkeypatch):
+    # e.g. on Windows, the votes are only kept in memory
+    monkeypatch.setattr(vote_buffer_module, 'fcntl', None)
+    journal_dir = tmpdir.mkdir('journal')
+    vote_buffer = VoteBuffer(flush_interval=0.05, journal_dir=str(journal_dir))
+    vote_buffer.submit('voter1', 'left')
+    assert vote_buffer.flush(timeout=5)
+    vote_buffer.close()
+    db_session.remove()
+    assert Vote.query.count() == 1
+    assert journal_dir.listdir() == []
+
+
+def test_recover_vote_journals(sqlite_db, tmpdir):
+    journal_dir = str(tmpdir.mkdir('journal'))
+    now = datetime.utcnow()
+    rows = [dict(voter_id='voter{}'.format(n), vote='left', vote_timestamp=now + timedelta(seconds=n))
+            for n in range(10)]
+    # a crashed process: the journal is left behind with the first votes already written
+    journal = VoteJournal(journal_dir)
+    for row in rows:
+        journal.append(row)
+    db_session.execute(Vote.__table__.insert(), rows[:4])
+    db_session.commit()
+
+    # still locked by the process
+    assert recover_vote_journals(journal_dir) == 0
+    journal._file.close()
+    with open(journal.path, 'a') as f:
+        f.write('{"voter_id": "voter')
+
+    assert recover_vote_journals(journal_dir) == 6
+    assert Vote.query.count() == 10
+    assert not os.path.exists(journal.path)
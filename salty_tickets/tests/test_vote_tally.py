@@ -0,0 +1,80 @@
+import json
+import random
+from datetime import datetime, timedelta
+
+from salty_tickets.database import db_session
+from salty_tickets.models import Vote, VotingSession
+from salty_tickets.vote_tally import VoteTallyEngine, load_vote_tally
+
+
+def get_expected_results(votes, start_timestamp, end_timestamp=None):
+    # last vote of every voter, like vote_admin used to count them
+    last_votes = {}
+    for vote in sorted(votes, key=lambda v: (v.vote_timestamp, v.id)):
+        if vote.vote_timestamp > start_timestamp and (not end_timestamp or vote.vote_timestamp < end_timestamp):
+            last_votes[vote.voter_id] = vote.vote
+    return {option: len([v for v in last_votes.values() if v == option]) for option in ['left', 'right']}
+
+
+def create_votes(count, start_timestamp, seed=0):
+    rnd = random.Random(seed)
+    votes = [Vote(voter_id='voter{}'.format(rnd.randint(1, 30)), vote=rnd.choice(['left', 'right']),
+                  vote_timestamp=start_timestamp + timedelta(seconds=rnd.randint(-60, 600)))
+             for _ in range(count)]
+    db_session.add_all(votes)
+    db_session.commit()
+    return votes
+
+
+def test_load_vote_tally(sqlite_db):
+    start_timestamp = datetime(2018, 4, 7, 21, 0)
+    voting_session = VotingSession(name='Final', start_timestamp=start_timestamp,
+                                   end_timestamp=start_timestamp + timedelta(seconds=300))
+    db_session.add(voting_session)
+    votes = create_votes(300, start_timestamp)
+
+    tally = load_vote_tally(voting_session)
+    assert tally.results_data == get_expected_results(votes, start_timestamp, voting_session.end_timestamp)
+    assert tally.last_vote_id == max(v.id for v in votes)
+
+
+def test_vote_tally_engine(sqlite_db):
+    start_timestamp = datetime.utcnow() - timedelta(seconds=120)
+    voting_session = VotingSession(name='Final', start_timestamp=start_timestamp)
+    db_session.add(voting_session)
+    votes = create_votes(100, start_timestamp)
+
+    engine = VoteTallyEngine()
+    tally = engine.get_tally()
+    assert tally.results_data == get_expected_results(votes, start_timestamp)
+
+    # written by the vote buffers
+    votes += create_votes(20, start_timestamp + timedelta(seconds=400), seed=1)
+    assert engine.catch_up().results_data == get_expected_results(votes, start_timestamp)
+    assert engine.get_tally() is tally
+
+    event = next(engine.stream())
+    assert json.loads(event[len('data: '):])['results'] == get_expected_results(votes, start_timestamp)
+
+    voting_session.stop()
+    db_session.commit()
+    assert engine.get_tally() is not tally
+
+
+def test_vote_tally_engine_votes_committed_out_of_order(sqlite_db):
+    start_timestamp = datetime.utcnow() - timedelta(seconds=120)
+    voting_session = VotingSession(name='Final', start_timestamp=start_timestamp)
+    db_session.add(voting_session)
+    votes = create_votes(20, start_timestamp)
+    # written by another worker with a lower id, but committed after the tally has been loaded
+    late_vote_id = votes.pop(10).id
+    Vote.query.filter_by(id=late_vote_id).delete()
+    db_session.commit()
+
+    engine = VoteTallyEngine()
+    engine.get_tally()
+    late_vote = Vote(id=late_vote_id, voter_id='late_voter', vote='left', vote_timestamp=datetime.utcnow())
+    db_session.add(late_vote)
+    db_session.commit()
+    votes.append(late_vote)
+    assert engine.catch_up().results_data == get_expected_results(votes, start_timestamp)
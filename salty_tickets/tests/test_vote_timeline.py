@@ -0,0 +1,56 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+from salty_tickets.vote_timeline import get_vote_timeline, iter_csv_chunks
+
+
+def test_get_vote_timeline():
+    ts = lambda s: pd.Timestamp('2018-04-07 21:00:00') + pd.Timedelta(seconds=s)
+    voting_sessions_df = pd.DataFrame({
+        'id': [1, 2],
+        'name': ['Semi', 'Final'],
+        'start_timestamp': [ts(0), ts(100)],
+        'end_timestamp': [ts(60), ts(160)],
+    })
+    votes = [
+        # id, voter, vote, seconds
+        (1, 'a', 'left', 10),
+        (2, 'b', 'left', 20),
+        (3, 'a', 'right', 30),
+        (4, 'a', 'right', 40),
+        (5, 'c', 'right', 50),
+        (6, 'b', 'right', 50),
+        (7, 'b', 'left', 80),  # between the sessions
+        (8, 'a', 'left', 110),
+        (9, None, 'left', 120),
+        (10, 'b', 'right', 130),
+    ]
+    votes_df = pd.DataFrame(votes, columns=['id', 'voter_id', 'vote', 'vote_timestamp'])
+    votes_df['vote_timestamp'] = votes_df.vote_timestamp.map(ts)
+
+    timeline_df = get_vote_timeline(votes_df, voting_sessions_df)
+    assert list(timeline_df.id) == [1, 2, 3, 4, 5, 6, 8, 9, 10]
+    assert list(timeline_df.session_id) == [1, 1, 1, 1, 1, 1, 2, 2, 2]
+    assert list(timeline_df.name) == ['Semi'] * 6 + ['Final'] * 3
+    assert list(timeline_df.left) == [1, 2, 1, 1, 0, 0, 1, 1, 1]
+    assert list(timeline_df.right) == [0, 0, 1, 1, 3, 3, 0, 0, 1]
+
+    csv = ''.join(iter_csv_chunks(timeline_df, chunk_size=4))
+    assert csv == timeline_df.to_csv(index=False)
+
+
+def test_get_vote_timeline_no_votes():
+    # a voting session which has just started, read_sql_query returns object columns without rows
+    voting_sessions_df = pd.DataFrame({
+        'id': [1],
+        'name': ['Final'],
+        'start_timestamp': [pd.Timestamp('2018-04-07 21:00:00')],
+        'end_timestamp': [None],
+    })
+    votes_df = pd.DataFrame({column: pd.Series([], dtype=object)
+                             for column in ['id', 'voter_id', 'vote', 'vote_timestamp']})
+
+    timeline_df = get_vote_timeline(votes_df, voting_sessions_df)
+    assert len(timeline_df) == 0
+    assert ''.join(iter_csv_chunks(timeline_df)) == 'id,voter_id,vote,vote_timestamp,session_id,name,start_timestamp,' \
+                                                    'end_timestamp\n'
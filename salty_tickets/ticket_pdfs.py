@@ -0,0 +1,135 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from urllib.parse import urlsplit
+
+from flask import render_template
+from salty_tickets import app, config
+from salty_tickets.mts_controllers import MtsTicketController
+from werkzeug.exceptions import HTTPException
+
+TICKET_TEMPLATE = 'events/mind_the_shag_2018/ticket.html'
+TICKET_BASE_URL = getattr(config, 'TICKET_BASE_URL', 'https://www.saltyjitterbugs.co.uk')
+TICKET_PDF_CACHE_DIR = getattr(config, 'TICKET_PDF_CACHE_DIR',
+                               os.path.join(tempfile.gettempdir(), 'salty_tickets_pdf'))
+TICKET_PDF_WORKERS = 4
+
+
+def render_ticket_html(registration):
+    """The same html as the /mts/<ticket_token> page, rendered without a request to the site.
+
+    Must be called in a request context with the site url, see render_tickets_html.
+    """
+    ticket_controller = MtsTicketController(registration, embed_qr_code=True)
+    return render_template(TICKET_TEMPLATE, ticket_controller=ticket_controller, config=config)
+
+
+def render_tickets_html(registrations):
+    # the database session is removed at the end of the context, like after a request
+    with app.test_request_context(base_url=TICKET_BASE_URL):
+        return [render_ticket_html(registration) for registration in registrations]
+
+
+def get_ticket_pdf_path(ticket_html, cache_dir=TICKET_PDF_CACHE_DIR):
+    content_hash = hashlib.sha256(ticket_html.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, content_hash[:2], content_hash + '.pdf')
+
+
+def get_static_file_path(url, base_url=TICKET_BASE_URL):
+    """Local file of a static url of the site, None for the other urls"""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or parts.netloc != urlsplit(base_url).netloc:
+        return None
+    try:
+        endpoint, values = app.url_map.bind(parts.netloc).match(parts.path)
+    except HTTPException:
+        return None
+    if endpoint == 'static':
+        static_folder = app.static_folder
+    elif endpoint.endswith('.static'):
+        static_folder = app.blueprints[endpoint[:-len('.static')]].static_folder
+    else:
+        return None
+    static_folder = os.path.realpath(static_folder)
+    path = os.path.realpath(os.path.join(static_folder, values['filename']))
+    if not path.startswith(static_folder + os.sep) or not os.path.isfile(path):
+        return None
+    return path
+
+
+@lru_cache(maxsize=64)
+def _fetch_url(url, base_url=TICKET_BASE_URL):
+    # stylesheets and images are the same for all the tickets, every worker fetches them once
+    static_file_path = get_static_file_path(url, base_url)
+    if static_file_path is not None:
+        # the static files of the site are read from disk, so the tickets don't depend on the site being up
+        with open(static_file_path, 'rb') as f:
+            return dict(string=f.read(), mime_type=mimetypes.guess_type(static_file_path)[0], redirected_url=url)
+
+    import weasyprint
+    result = weasyprint.default_url_fetcher(url)
+    file_obj = result.pop('file_obj', None)
+    if file_obj is not None:
+        result['string'] = file_obj.read()
+        file_obj.close()
+    return result
+
+
+def _cached_url_fetcher(url, *args, base_url=TICKET_BASE_URL, **kwargs):
+    return dict(_fetch_url(url, base_url))
+
+
+def write_ticket_pdf(ticket_html, pdf_path, base_url=TICKET_BASE_URL):
+    import weasyprint
+    os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+    url_fetcher = partial(_cached_url_fetcher, base_url=base_url)
+    pdf = weasyprint.HTML(string=ticket_html, base_url=base_url, url_fetcher=url_fetcher).write_pdf()
+    # written under a temporary name, so a cached file is always complete
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(pdf_path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(pdf)
+    os.replace(tmp_path, pdf_path)
+    return pdf_path
+
+
+class TicketPdfRenderer:
+    """Renders the ticket PDFs of the registrations in a pool of processes.
+
+    The PDFs are cached on disk by the hash of the ticket html, so a ticket which has not changed
+    since it was rendered last time is not rendered again.
+    """
+    def __init__(self, workers=TICKET_PDF_WORKERS, cache_dir=TICKET_PDF_CACHE_DIR, base_url=TICKET_BASE_URL):
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.base_url = base_url
+        self.rendered_count = 0
+
+    def render(self, registrations):
+        """Returns the paths of the PDFs in the order of the registrations.
+
+        The registrations are detached from the database session afterwards.
+        """
+        pdf_paths = []
+        pending = {}
+        for ticket_html in render_tickets_html(registrations):
+            pdf_path = get_ticket_pdf_path(ticket_html, self.cache_dir)
+            pdf_paths.append(pdf_path)
+            if not os.path.exists(pdf_path):
+                pending[pdf_path] = ticket_html
+
+        if pending:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(write_ticket_pdf, ticket_html, pdf_path, self.base_url)
+                           for pdf_path, ticket_html in pending.items()]
+                for future in futures:
+                    future.result()
+            self.rendered_count += len(pending)
+        return pdf_paths
+
+
+def ticket_pdf_attachment(pdf_path, filename):
+    with open(pdf_path, 'rb') as f:
+        return ("attachment", (filename, f.read()))
@@ -1,76 +1,173 @@
+from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache
 
+from flask import g, has_app_context
 from itsdangerous import URLSafeSerializer, BadSignature
 from salty_tickets.config import SECRET_KEY, SALT_EMAIL, SALT_ORDER_PRODUCT, SALT_ORDER, SALT_GROUP_TOKEN, \
     SALT_PARTNER_TOKEN, SALT_REGISTRATION_TOKEN
-from salty_tickets.models import OrderProduct, Order, RegistrationGroup, Registration
+from salty_tickets.database import db_session
+from salty_tickets.models import OrderProduct, Order, RegistrationGroup, Registration, SignupGroup, \
+    group_order_product_mapping
 from hashids import Hashids
+from sqlalchemy import exists
+from sqlalchemy.orm.exc import NoResultFound
+
+TOKEN_DECODE_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=None)
+def get_hashids(salt, min_length=0):
+    return Hashids(salt=salt, min_length=min_length)
+
+
+@lru_cache(maxsize=None)
+def get_url_safe_serializer(salt):
+    return URLSafeSerializer(SECRET_KEY, salt=salt)
+
+
+@lru_cache(maxsize=TOKEN_DECODE_CACHE_SIZE)
+def decode_hashid(salt, min_length, token):
+    return get_hashids(salt, min_length).decode(token)
+
+
+@lru_cache(maxsize=TOKEN_DECODE_CACHE_SIZE)
+def url_safe_loads(salt, token):
+    # invalid tokens raise BadSignature and are not cached
+    return get_url_safe_serializer(salt).loads(token)
+
+
+def _get_identity_cache():
+    # objects found by the tokens are kept for the current database transaction,
+    # so workers and scripts with a long app context don't get them after a commit
+    if not has_app_context():
+        return {}
+    transaction = db_session().transaction
+    cache = g.get('_token_identity_cache')
+    if cache is None or cache[0] is not transaction:
+        cache = g._token_identity_cache = (transaction, {})
+    return cache[1]
+
+
+def clear_identity_cache():
+    if has_app_context():
+        g.pop('_token_identity_cache', None)
+
+
+def get_objects_by_ids(model, ids):
+    """Returns {id: object}, the objects not found before in this request are queried with one IN query"""
+    cache = _get_identity_cache()
+    objects = {}
+    missing_ids = set()
+    for id in ids:
+        if (model, id) in cache:
+            objects[id] = cache[(model, id)]
+        else:
+            missing_ids.add(id)
+    if missing_ids:
+        for obj in db_session.query(model).filter(model.id.in_(missing_ids)):
+            cache[(model, obj.id)] = obj
+            objects[obj.id] = obj
+    return objects
+
+
+def get_object_by_id(model, id):
+    obj = get_objects_by_ids(model, [id]).get(id)
+    if obj is None:
+        raise NoResultFound('No row was found for one()')
+    return obj
 
 
 def email_serialize(email):
-    serializer =  URLSafeSerializer(SECRET_KEY, salt=SALT_EMAIL)
-    token = serializer.dumps(email)
-    return token
+    return get_url_safe_serializer(SALT_EMAIL).dumps(email)
 
 
 def email_deserialize(email_token):
-    serializer = URLSafeSerializer(SECRET_KEY, salt=SALT_EMAIL)
-    email = serializer.loads(email_token)
-    return email
+    return url_safe_loads(SALT_EMAIL, email_token)
 
 
 def order_product_serialize(order_product):
-    serializer =  Hashids(min_length=5, salt=SALT_ORDER_PRODUCT)
-    token = serializer.encode(order_product.id)
-    return token
+    return get_hashids(SALT_ORDER_PRODUCT, 5).encode(order_product.id)
 
 
-def order_product_deserialize(order_product_token):
+def _order_product_token_to_id(order_product_token):
     # backward compatibility
     if len(order_product_token)>10:
-        return order_product_deserialize_old(order_product_token)
+        return url_safe_loads(SALT_ORDER_PRODUCT, order_product_token)
 
-    serializer =  Hashids(min_length=5, salt=SALT_ORDER_PRODUCT)
-    decode_res = serializer.decode(order_product_token)
+    decode_res = decode_hashid(SALT_ORDER_PRODUCT, 5, order_product_token)
     if decode_res:
-        order_product_id = decode_res[0]
-        order_product = OrderProduct.query.filter_by(id=order_product_id).one()
-        return order_product
+        return decode_res[0]
     else:
         raise BadSignature('Invalid token')
 
 
-def order_product_token_expired(order_product_token, expire_period_seconds):
-    order_product = order_product_deserialize(order_product_token)
-    registration_datetime_diff = datetime.now() - order_product.order.order_datetime
-    return registration_datetime_diff.total_seconds() > expire_period_seconds
+def order_product_deserialize(order_product_token):
+    return get_object_by_id(OrderProduct, _order_product_token_to_id(order_product_token))
+
+
+class PartnerTokenInfo(namedtuple('PartnerTokenInfo', ['order_product_id', 'product_id', 'dance_role', 'status',
+                                                       'order_datetime', 'registration_name', 'has_partners'])):
+    __slots__ = ()
+
+    def is_expired(self, expire_period_seconds):
+        registration_datetime_diff = datetime.now() - self.order_datetime
+        return registration_datetime_diff.total_seconds() > expire_period_seconds
+
+
+def get_partner_tokens_info(order_product_tokens):
+    """Returns {token: PartnerTokenInfo} for the valid tokens.
+
+    Everything needed to validate the partner tokens is loaded with one query, and kept for the request.
+    """
+    token_ids = {}
+    for order_product_token in order_product_tokens:
+        try:
+            token_ids[order_product_token] = _order_product_token_to_id(order_product_token)
+        except BadSignature:
+            pass
+
+    cache = _get_identity_cache()
+    missing_ids = {id for id in token_ids.values() if (PartnerTokenInfo, id) not in cache}
+    if missing_ids:
+        has_partners = exists().\
+            where(group_order_product_mapping.c.order_product_id == OrderProduct.id).\
+            where(group_order_product_mapping.c.signup_group_id == SignupGroup.id)
+        query = db_session.query(OrderProduct.id, OrderProduct.product_id, OrderProduct.dance_role,
+                                 OrderProduct.status, Order.order_datetime, Registration.name,
+                                 has_partners.label('has_partners')).\
+            join(Order, OrderProduct.order_id == Order.id).\
+            outerjoin(Registration, OrderProduct.registration_id == Registration.id).\
+            filter(OrderProduct.id.in_(missing_ids))
+        for row in query:
+            cache[(PartnerTokenInfo, row.id)] = PartnerTokenInfo(*row)
+    return {token: cache[(PartnerTokenInfo, id)] for token, id in token_ids.items() if (PartnerTokenInfo, id) in cache}
+
+
+def get_partner_token_info(order_product_token):
+    """Raises BadSignature if the token is invalid, returns None if there is no such order product"""
+    _order_product_token_to_id(order_product_token)
+    return get_partner_tokens_info([order_product_token]).get(order_product_token)
 
 
 def order_product_deserialize_old(order_product_token):
-    serializer =  URLSafeSerializer(SECRET_KEY, salt=SALT_ORDER_PRODUCT)
-    order_product_id = serializer.loads(order_product_token)
-    order_product = OrderProduct.query.filter_by(id=order_product_id).one()
-    return order_product
+    order_product_id = url_safe_loads(SALT_ORDER_PRODUCT, order_product_token)
+    return get_object_by_id(OrderProduct, order_product_id)
 
 
 def order_serialize(user_order):
-    serializer =  URLSafeSerializer(SECRET_KEY, salt=SALT_ORDER)
-    token = serializer.dumps(user_order.id)
-    return token
+    return get_url_safe_serializer(SALT_ORDER).dumps(user_order.id)
 
 
 def order_deserialize(order_token):
-    serializer =  URLSafeSerializer(SECRET_KEY, salt=SALT_ORDER)
-    order_id = serializer.loads(order_token)
-    user_order = Order.query.filter_by(id=order_id).one()
-    return user_order
-
+    return get_object_by_id(Order, url_safe_loads(SALT_ORDER, order_token))
 
 
 class Token:
     prefix = 'tok'
     min_length = 5
     salt = 'default'
+    model = None
     def __init__(self):
         pass
 
@@ -96,8 +193,28 @@ class Token:
         else:
             raise BadSignature('Invalid token')
 
+    def deserialize_many(self, token_strs):
+        """Returns {token: object} for the valid tokens, with one query"""
+        token_ids = {}
+        for token_str in token_strs:
+            try:
+                id = self._decode(self.code_from_str(token_str))
+            except BadSignature:
+                continue
+            if id:
+                token_ids[token_str] = id
+        objects = get_objects_by_ids(self.model, token_ids.values())
+        return {token_str: objects[id] for token_str, id in token_ids.items() if id in objects}
+
+    def is_valid(self, token_str):
+        # checks the token without retrieving the object
+        try:
+            return bool(self._decode(self.code_from_str(token_str)))
+        except BadSignature:
+            return False
+
     def _retrieve_object(self, id):
-        raise NotImplementedError()
+        return get_object_by_id(self.model, id)
 
     def code_to_str(self, code):
         return f'{self.prefix}_{code}'
@@ -114,13 +231,13 @@ class ItsdangerousMixin:
 
     @property
     def _serializer(self):
-        return URLSafeSerializer(SECRET_KEY, salt=self.salt)
+        return get_url_safe_serializer(self.salt)
 
     def _encode(self, obj):
        return self._serializer.dumps(obj)
 
     def _decode(self, encoded_data):
-        return self._serializer.loads(encoded_data)
+        return url_safe_loads(self.salt, encoded_data)
 
 
 class HashidsMixin:
@@ -129,13 +246,13 @@ class HashidsMixin:
 
     @property
     def _serializer(self):
-        return Hashids(self.salt, self.min_length)
+        return get_hashids(self.salt, self.min_length)
 
     def _encode(self, obj):
         return self._serializer.encode(obj)
 
     def _decode(self, encoded_data):
-        res = self._serializer.decode(encoded_data)
+        res = decode_hashid(self.salt, self.min_length, encoded_data)
         if res:
             return res[0]
 
@@ -143,30 +260,26 @@ class HashidsMixin:
 class GroupToken(HashidsMixin, Token):
     prefix = 'grp'
     salt = SALT_GROUP_TOKEN
-    def _retrieve_object(self, id):
-        return RegistrationGroup.query.filter_by(id=id).one()
+    model = RegistrationGroup
 
 
 class PartnerToken(HashidsMixin, Token):
     prefix = 'ptn'
     salt = SALT_PARTNER_TOKEN
-    def _retrieve_object(self, id):
-        return Registration.query.filter_by(id=id).one()
+    model = Registration
 
 
 class RegistrationToken(ItsdangerousMixin, Token):
     prefix = 'reg'
     salt = SALT_REGISTRATION_TOKEN
-    def _retrieve_object(self, id):
-        return Registration.query.filter_by(id=id).one()
+    model = Registration
 
 
 class MtsTicketToken(HashidsMixin, Token):
     prefix = ''
     salt = SALT_REGISTRATION_TOKEN
     min_length = 8
-    def _retrieve_object(self, id):
-        return Registration.query.filter_by(id=id).one()
+    model = Registration
 
     def code_to_str(self, code):
         return str(code)
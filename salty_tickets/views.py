@@ -1,9 +1,11 @@
-from flask import render_template, request, Response
+from flask import render_template, request, Response, abort, stream_with_context
 from flask import url_for, jsonify
 from itsdangerous import BadSignature
 from salty_tickets import app
 from salty_tickets import config
 from salty_tickets.controllers import OrderSummaryController, OrderProductController, FormErrorController
+from salty_tickets.crowdfunding_contributors import get_contributors_page, contributor_as_dict, \
+    CROWDFUNDING_CONTRIBUTORS_PAGE_SIZE, CROWDFUNDING_CONTRIBUTORS_MAX_PAGE_SIZE
 from salty_tickets.database import db_session
 from salty_tickets.emails import send_registration_confirmation, send_cancellation_request_confirmation, \
     send_remaining_payment_confirmation
@@ -13,14 +15,18 @@ from salty_tickets.forms import create_event_form, create_crowdfunding_form, get
 from salty_tickets.models import Event, CrowdfundingRegistrationProperties, Registration, RefundRequest, Order, Vote, \
     VotingSession
 from salty_tickets.mts_controllers import MtsSignupFormController, MtsTicketController
+from salty_tickets.order_summary import load_order_summary
+from salty_tickets.payment_queue import submit_payment
 from salty_tickets.payments import process_payment
 from salty_tickets.pricing_rules import get_order_for_event, get_total_raised, \
     get_order_for_crowdfunding_event, get_stripe_properties, balance_event_waiting_lists, process_partner_registrations, \
-    mts_get_order_for_event, process_mts_group_registrations
+    mts_get_order_for_event, process_mts_group_registrations, get_order_draft, mts_get_order_draft, \
+    get_crowdfunding_order_draft
 from salty_tickets.products import flip_role
+from salty_tickets.qr_codes import get_qr_code, QR_CODE_MAX_AGE
 from salty_tickets.tokens import email_deserialize, order_product_deserialize, order_deserialize, order_serialize, \
-    RegistrationToken
-from sqlalchemy import desc
+    RegistrationToken, MtsTicketToken, get_partner_tokens_info, clear_identity_cache
+from salty_tickets.vote_tally import vote_tally_engine
 from werkzeug.utils import redirect
 from htmlmin import minify
 
@@ -72,28 +78,18 @@ def register_form(event_key):
         partner_registration = get_partner_registration_from_form(form)
         partner_registration.event_id = event.id
         if event_key == 'mind_the_shag_2018':
-            user_order = mts_get_order_for_event(event, form, registration, partner_registration)
+            user_order = mts_get_order_for_event(event, form, registration, partner_registration, reserve=True)
             if form.comment.data and form.comment.data.lower().strip() in ['sunny side of the street']:
                 user_order.payments[0].amount = 0
         else:
-            user_order = get_order_for_event(event, form, registration, partner_registration)
+            user_order = get_order_for_event(event, form, registration, partner_registration, reserve=True)
         user_order.registration = registration
         event.orders.append(user_order)
         db_session.commit()
-        success, response = process_payment(user_order.payments[0], form.stripe_token.data)
-        if success:
-            process_partner_registrations(user_order, form)
-            if event_key == 'mind_the_shag_2018':
-                process_mts_group_registrations(user_order, form)
-            balance_results = balance_event_waiting_lists(event)
-            email_result = send_registration_confirmation(user_order)
-            # order_summary_controller = OrderSummaryController(user_order)
-            # return render_template('signup_thankyou.html', order_summary_controller=order_summary_controller,
-            #                        event_key=event.event_key)
-            return redirect(url_for('signup_thankyou', order_token=order_serialize(user_order)))
-        else:
-            # print(response)
-            return render_template('event_purchase_error.html', error_message=response)
+        payment = user_order.payments[0]
+        submit_payment(payment, form.stripe_token.data, on_success=complete_event_registration)
+        return redirect(url_for('payment_processing', order_token=order_serialize(user_order),
+                                payment_id=payment.id, thankyou='signup_thankyou'))
 
     # tokens = request.args.get('tokens')
     # if tokens:
@@ -134,22 +130,21 @@ def register_checkout(event_key, validate='novalidate'):
         partner_registration = get_partner_registration_from_form(form)
         partner_registration.event_id = event.id
         if event_key == 'mind_the_shag_2018':
-            user_order = mts_get_order_for_event(event, form, registration, partner_registration)
+            order_draft = mts_get_order_draft(event, form, registration, partner_registration)
         else:
-            user_order = get_order_for_event(event, form, registration, partner_registration)
-        return_dict['stripe'] = get_stripe_properties(event, user_order, form)
+            order_draft = get_order_draft(event, form, registration, partner_registration)
+        return_dict['stripe'] = get_stripe_properties(event, order_draft, form)
         if form.comment.data and form.comment.data.lower().strip() in ['sunny side of the street']:
             return_dict['stripe'] = 0
-        order_summary_controller = OrderSummaryController(user_order)
         return_dict['order_summary_html'] = minify(render_template('order_summary.html',
-                                                            order_summary_controller=order_summary_controller), remove_comments=True, remove_empty_space=True)
+                                                            order_draft=order_draft), remove_comments=True, remove_empty_space=True)
         return_dict['validated_partner_tokens'] = get_validated_partner_tokens(form)
-        return_dict['disable_checkout'] = user_order.order_products.count() == 0
-        return_dict['order_summary_total'] = price_filter(order_summary_controller.total_to_pay)
+        return_dict['disable_checkout'] = not order_draft.line_items
+        return_dict['order_summary_total'] = price_filter(order_draft.total_to_pay)
         print(
             form.name.data,
             request.remote_addr,
-            [(payment_item.product.name, price_filter(payment_item.amount), payment_item.product.status) for payment_item in order_summary_controller.payment_items]
+            [(line_item.name, price_filter(line_item.amount), line_item.status.title()) for line_item in order_draft.line_items]
 
         )
     else:
@@ -174,6 +169,10 @@ def register_checkout_vue(event_key, validate='novalidate'):
     else:
         form_check = form.is_submitted
 
+    if form_check() and validate != 'validate' and event_key == 'mind_the_shag_2018':
+        # preview after every change of the selection, the order summary is rendered on the page
+        return jsonify(get_mts_checkout_preview_dict(event, form))
+
     if form_check():
         reg_dict = {
             'token_valid': None,
@@ -215,18 +214,17 @@ def register_checkout_vue(event_key, validate='novalidate'):
             partner_registration.event_id = event.id
 
         if event_key == 'mind_the_shag_2018':
-            user_order = mts_get_order_for_event(event, form, registration, partner_registration)
+            order_draft = mts_get_order_draft(event, form, registration, partner_registration)
 
         return_dict['existing_registration'] = reg_dict
         # else:
-        #     user_order = get_order_for_event(event, form, registration, partner_registration)
-        return_dict['stripe'] = get_stripe_properties(event, user_order, form)
-        order_summary_controller = OrderSummaryController(user_order)
+        #     order_draft = get_order_draft(event, form, registration, partner_registration)
+        return_dict['stripe'] = get_stripe_properties(event, order_draft, form)
         return_dict['order_summary_html'] = minify(render_template('order_summary.html',
-                                                            order_summary_controller=order_summary_controller), remove_comments=True, remove_empty_space=True)
+                                                            order_draft=order_draft), remove_comments=True, remove_empty_space=True)
         return_dict['validated_partner_tokens'] = get_validated_partner_tokens(form)
-        return_dict['disable_checkout'] = user_order.order_products.count() == 0
-        return_dict['order_summary_total'] = price_filter(order_summary_controller.total_to_pay)
+        return_dict['disable_checkout'] = not order_draft.line_items
+        return_dict['order_summary_total'] = price_filter(order_draft.total_to_pay)
 
         # adding validate form errors to the response to get the CSRF error early
         if not form.validate():
@@ -234,24 +232,14 @@ def register_checkout_vue(event_key, validate='novalidate'):
             return_dict['errors'] = {v: k for v, k in form_errors_controller.errors}
 
         if event_key == 'mind_the_shag_2018':
-            form_controller = MtsSignupFormController(form)
-            return_dict['state_data'] = form_controller.get_state_dict(event)
-
-            if return_dict['state_data']['group'].get('group_token_error'):
-                return_dict['errors']['Group token'] = return_dict['state_data']['group'].get('group_token_error')
-
-            if return_dict['state_data']['group'].get('group_new_error'):
-                return_dict['errors']['New group'] = return_dict['state_data']['group'].get('group_new_error')
-
-            if form_controller.not_enough_stations_selected:
-                return_dict['errors']['Full weekend pass'] = 'Not enough stations selected: %s of 3' % form_controller.selected_stations_count
+            add_mts_state_data(return_dict, event, form)
 
         if validate == 'validate' and not return_dict['errors']:
             return_dict['checkout_success'] = True
         print(
             form.name.data,
             request.remote_addr,
-            [(payment_item.product.name, price_filter(payment_item.amount), payment_item.product.status) for payment_item in order_summary_controller.payment_items]
+            [(line_item.name, price_filter(line_item.amount), line_item.status.title()) for line_item in order_draft.line_items]
 
         )
     else:
@@ -263,14 +251,83 @@ def register_checkout_vue(event_key, validate='novalidate'):
     return jsonify(return_dict)
 
 
+def add_mts_state_data(return_dict, event, form):
+    form_controller = MtsSignupFormController(form)
+    return_dict['state_data'] = form_controller.get_state_dict(event)
+
+    if return_dict['state_data']['group'].get('group_token_error'):
+        return_dict['errors']['Group token'] = return_dict['state_data']['group'].get('group_token_error')
+
+    if return_dict['state_data']['group'].get('group_new_error'):
+        return_dict['errors']['New group'] = return_dict['state_data']['group'].get('group_new_error')
+
+    if form_controller.not_enough_stations_selected:
+        return_dict['errors']['Full weekend pass'] = 'Not enough stations selected: %s of 3' % form_controller.selected_stations_count
+
+
+def get_mts_checkout_preview_dict(event, form):
+    order_draft = mts_get_order_draft(event, form)
+
+    items = []
+    for line_item in order_draft.line_items:
+        items.append(dict(
+            name=line_item.product_name,
+            price=price_filter(line_item.price),
+            amount=price_filter(line_item.amount),
+            status=line_item.status,
+            dance_role=line_item.dance_role,
+            for_partner=line_item.for_partner,
+            waiting_reason=order_draft.get_waiting_reason(line_item),
+        ))
+
+    return_dict = dict(
+        errors={},
+        order_summary=dict(
+            items=items,
+            transaction_fee=price_filter(order_draft.transaction_fee),
+            total=price_filter(order_draft.total_to_pay),
+        ),
+        stripe=dict(email=form.email.data, amount=order_draft.stripe_amount),
+        validated_partner_tokens=get_validated_partner_tokens(form),
+        disable_checkout=not items,
+        order_summary_total=price_filter(order_draft.total_to_pay),
+    )
+
+    # adding validate form errors to the response to get the CSRF error early
+    if not form.validate():
+        form_errors_controller = FormErrorController(form)
+        return_dict['errors'] = {v: k for v, k in form_errors_controller.errors}
+
+    add_mts_state_data(return_dict, event, form)
+    return return_dict
+
+
+def complete_event_registration(payment):
+    # runs in the payment worker, in a copy of the registration request
+    user_order = payment.order
+    event = user_order.event
+    form = create_event_form(event)()
+    process_partner_registrations(user_order, form)
+    if event.event_key == 'mind_the_shag_2018':
+        process_mts_group_registrations(user_order, form)
+    balance_event_waiting_lists(event)
+    send_registration_confirmation(user_order)
+
+
 def get_validated_partner_tokens(form):
-    tokens_data = {}
+    partner_token_fields = []
     for product_key in form.product_keys:
         product_form = form.get_product_by_key(product_key)
         if hasattr(product_form, 'partner_token'):
             if product_form.partner_token.data:
-                order_product = order_product_deserialize(product_form.partner_token.data)
-                tokens_data[product_form.partner_token.id] = 'Your partner: {}'.format(order_product.registration.name)
+                partner_token_fields.append(product_form.partner_token)
+    partner_tokens_info = get_partner_tokens_info([field.data for field in partner_token_fields])
+
+    tokens_data = {}
+    for field in partner_token_fields:
+        if field.data in partner_tokens_info:
+            partner_name = partner_tokens_info[field.data].registration_name
+            tokens_data[field.id] = 'Your partner: {}'.format(partner_name)
     return tokens_data
 
 
@@ -289,6 +346,18 @@ def mts_registration_info(ticket_token):
     )
 
 
+@app.route('/mts/<ticket_token>/qr.<any(png, svg):kind>')
+def mts_ticket_qr_code(ticket_token, kind):
+    if not MtsTicketToken().is_valid(ticket_token):
+        abort(404)
+    qr_code = get_qr_code(url_for('mts_registration_info', ticket_token=ticket_token), kind)
+    response = Response(qr_code.content, mimetype=qr_code.mimetype)
+    response.set_etag(qr_code.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = QR_CODE_MAX_AGE
+    return response.make_conditional(request)
+
+
 
 @app.route('/c')
 @app.route('/crowdfunding')
@@ -334,15 +403,15 @@ def crowdfunding_form(event_key):
             # print(response)
             return render_template('event_purchase_error.html', error_message=response)
 
-    contributors = Registration.query.\
-        join(Order, aliased=True).join(Event, aliased=True).filter_by(event_key=event_key).\
-        order_by(desc(Registration.registered_datetime)).all()
+    # the next pages are loaded from crowdfunding_contributors
+    contributors_page = get_contributors_page(event.id)
     return render_template(
         'events/{}/crowdfunding.html'.format(event_key),
         event=event,
         form=form,
         total_stats=total_stats,
-        contributors=contributors,
+        contributors=contributors_page.contributors,
+        contributors_next_url=get_contributors_next_url(event, contributors_page),
         config=config
     )
 
@@ -356,12 +425,10 @@ def crowdfunding_checkout(event_key):
 
     if form.validate_on_submit():
         registration = get_crowdfunding_registration_from_form(form)
-        user_order = get_order_for_crowdfunding_event(event, form, registration, None)
-        return_dict['stripe'] = get_stripe_properties(event, user_order, form)
-        order_summary_controller = OrderSummaryController(user_order)
-        return_dict['order_summary_html'] = render_template('order_summary.html',
-                                                            order_summary_controller=order_summary_controller)
-        return_dict['disable_checkout'] = user_order.order_products.count() == 0
+        order_draft = get_crowdfunding_order_draft(event, form, registration)
+        return_dict['stripe'] = get_stripe_properties(event, order_draft, form)
+        return_dict['order_summary_html'] = render_template('order_summary.html', order_draft=order_draft)
+        return_dict['disable_checkout'] = not order_draft.line_items
     else:
         form_errors_controller = FormErrorController(form)
         return_dict['order_summary_html'] = render_template('form_errors.html',
@@ -376,13 +443,34 @@ def crowdfunding_thankyou(event_key):
     return render_template('crowdfunding_thankyou.html', event_key=event_key)
 
 
+def get_contributors_next_url(event, contributors_page):
+    if contributors_page.next_cursor:
+        return url_for('crowdfunding_contributors', event_key=event.event_key, after=contributors_page.next_cursor)
+
+
 @app.route('/crowdfunding/contributors/<string:event_key>', methods=['GET'])
 def crowdfunding_contributors(event_key):
-    pass
+    event = Event.query.filter_by(event_key=event_key).first()
+    if not event:
+        abort(404)
+    page_size = min(request.args.get('limit', CROWDFUNDING_CONTRIBUTORS_PAGE_SIZE, type=int),
+                    CROWDFUNDING_CONTRIBUTORS_MAX_PAGE_SIZE)
+    if page_size < 1:
+        abort(400)
+    try:
+        contributors_page = get_contributors_page(event.id, request.args.get('after'), page_size)
+    except ValueError:
+        abort(400)
+    return jsonify(
+        contributors=[contributor_as_dict(c) for c in contributors_page.contributors],
+        next=get_contributors_next_url(event, contributors_page),
+        html=render_template('crowdfunding_contributors.html', contributors=contributors_page.contributors),
+    )
 
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
+    clear_identity_cache()
     db_session.remove()
 
 
@@ -437,14 +525,40 @@ def event_order_remaining_payment_checkout(order_token):
         user_order.payments.append(remaining_payment)
         db_session.commit()
         stripe_token = form.stripe_token.data
-        success, response = process_payment(remaining_payment, stripe_token, config.STRIPE_SK)
-        if success:
-            db_session.commit()
-            email_result = send_remaining_payment_confirmation(remaining_payment)
-            return redirect(url_for('payment_thankyou', order_token=order_serialize(user_order)))
-        else:
-            # print(response)
-            return render_template('event_purchase_error.html', error_message=response)
+        submit_payment(remaining_payment, stripe_token, config.STRIPE_SK, on_success=send_remaining_payment_confirmation)
+        return redirect(url_for('payment_processing', order_token=order_token,
+                                payment_id=remaining_payment.id, thankyou='payment_thankyou'))
+
+
+PAYMENT_THANKYOU_ENDPOINTS = ['signup_thankyou', 'payment_thankyou']
+
+
+@app.route('/register/order/<string:order_token>/payment/<int:payment_id>/<string:thankyou>')
+def payment_processing(order_token, payment_id, thankyou):
+    if thankyou not in PAYMENT_THANKYOU_ENDPOINTS:
+        thankyou = 'signup_thankyou'
+    try:
+        user_order = order_deserialize(order_token)
+    except BadSignature:
+        return 'Incorrect order token'
+    return render_template(
+        'payment_processing.html',
+        status_url=url_for('payment_status', order_token=order_token, payment_id=payment_id),
+        thankyou_url=url_for(thankyou, order_token=order_token),
+        event_key=user_order.event.event_key,
+    )
+
+
+@app.route('/register/order/<string:order_token>/payment/<int:payment_id>/status')
+def payment_status(order_token, payment_id):
+    try:
+        user_order = order_deserialize(order_token)
+    except BadSignature:
+        return jsonify(status=None, error_message='Incorrect order token')
+    payment = user_order.payments.filter_by(id=payment_id).first()
+    if payment is None:
+        return jsonify(status=None, error_message='Incorrect payment')
+    return jsonify(status=payment.status, error_message=payment.failure_message)
 
 
 
@@ -454,8 +568,8 @@ def render_event_order_summary(order_token, title=None):
     except BadSignature:
         return 'Incorrect order token'
 
-    order_summary_controller = OrderSummaryController(user_order)
-    return render_template('signup_thankyou.html', order_summary_controller=order_summary_controller, title=title, config=config)
+    order_summary = load_order_summary(user_order.id)
+    return render_template('signup_thankyou.html', order_summary_controller=order_summary, title=title, config=config)
 
 
 VOTER_UUID_COOKIE_NAME = 'voter'
@@ -471,10 +585,10 @@ def vote():
 def vote_submit():
     form = VoteForm()
     if form.validate_on_submit():
+        # the writer and its journal are only started by the workers which receive the votes
+        from salty_tickets.vote_buffer import vote_buffer
         voter_uuid = form.client_fingerprint.data
-        vote = Vote(voter_id=voter_uuid, vote=form.options.data)
-        db_session.add(vote)
-        db_session.commit()
+        vote_buffer.submit(voter_uuid, form.options.data)
         return 'Success'
     else:
         return jsonify(form.errors)
@@ -495,70 +609,45 @@ def vote_admin():
             voting_session.stop()
             db_session.commit()
 
+    results_data = None
+    progress_data = None
     if voting_session:
         form.name.data = voting_session.name
 
         if voting_session.end_timestamp:
             form.stop_voting.data = True
 
-        votes_query = Vote.query.filter(Vote.vote_timestamp > voting_session.start_timestamp)
-        if voting_session.end_timestamp:
-            votes_query = votes_query.filter(Vote.vote_timestamp < voting_session.end_timestamp)
-        all_votes = votes_query.all()
-        all_votes_dict = {v.voter_id:v.vote for v in all_votes}
-
-        res_left = len([k for k,v in all_votes_dict.items() if v=='left'])
-        res_right = len([k for k,v in all_votes_dict.items() if v=='right'])
-        results_data = {
-            'left': res_left,
-            'right': res_right
-        }
-        progess_max = max(20, max(res_left,res_right))
-        progress_data = {
-            'total_max': progess_max,
-            'left_pcnt': int(res_left*100/progess_max),
-            'right_pcnt': int(res_right*100/progess_max),
-        }
-    else:
-        results_data = None
-    return render_template('voting/admin.html', form=form, results_data=results_data, progress_data=progress_data)
+        vote_tally = vote_tally_engine.catch_up(voting_session)
+        results_data = vote_tally.results_data
+        progress_data = vote_tally.progress_data
+    return render_template('voting/admin.html', form=form, results_data=results_data, progress_data=progress_data,
+                           voting_session_id=voting_session.id if voting_session else None)
+
+
+@app.route('/vote/admin/stream')
+def vote_admin_stream():
+    response = Response(stream_with_context(vote_tally_engine.stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route('/vote/admin/data.csv')
 def vote_data():
     import pandas as pd
     from salty_tickets.database import engine
+    from salty_tickets.vote_timeline import get_vote_timeline, iter_csv_chunks
     voting_sessions_df = pd.read_sql_query(VotingSession.query.statement, engine)
-    votes_df = pd.read_sql_query(Vote.query.statement, engine)
 
-    start_date = pd.datetime.today().date() - pd.DateOffset(days=2)
+    start_date = pd.Timestamp.today().normalize() - pd.DateOffset(days=2)
     voting_sessions_df = voting_sessions_df[voting_sessions_df.end_timestamp > start_date]
-    votes_start = voting_sessions_df.start_timestamp.iloc[0]
-    votes_df = votes_df[votes_df.vote_timestamp >= votes_start]
-
-    votes_df['session_id'] = None
-    for ix, voting_session in voting_sessions_df.iterrows():
-        votes_mask = votes_df.vote_timestamp.between(voting_session.start_timestamp, voting_session.end_timestamp)
-        votes_df.session_id[votes_mask] = voting_session.id
-
-    voting_sessions_df.index = voting_sessions_df.id
-    voting_sessions_df.drop('id', axis=1, inplace=True)
-    votes_df = votes_df.join(voting_sessions_df, on='session_id', how='inner')
-
-    vote_options = votes_df.vote.unique()
-    for vote_option in vote_options:
-        votes_df[vote_option] = None
-
-    for ix, vote in votes_df.iterrows():
-        query_votes = votes_df[votes_df.vote_timestamp.between(vote.start_timestamp, vote.vote_timestamp)]
-        grouped = query_votes.groupby('voter_id').last()
-
-        for vote_option in vote_options:
-            votes_df.loc[ix, vote_option] = grouped.vote[grouped.vote == vote_option].count()
+    votes_start = voting_sessions_df.start_timestamp.min() if len(voting_sessions_df) else pd.Timestamp.max
+    votes_df = pd.read_sql_query(Vote.query.filter(Vote.vote_timestamp >= votes_start.to_pydatetime()).statement,
+                                 engine)
 
-    data_csv = votes_df.to_csv(index=False)
+    votes_df = get_vote_timeline(votes_df, voting_sessions_df)
     return Response(
-        data_csv,
+        iter_csv_chunks(votes_df),
         mimetype="text/csv",
         headers={"Content-disposition":
                  "attachment; filename=data.csv"})
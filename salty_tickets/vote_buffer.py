@@ -0,0 +1,249 @@
+import atexit
+import datetime
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # no journal locking on Windows, the votes are only kept in memory there
+    fcntl = None
+
+from salty_tickets import config
+from salty_tickets.database import db_session
+from salty_tickets.models import Vote
+from salty_tickets.vote_tally import vote_tally_engine
+
+VOTE_FLUSH_INTERVAL = 0.2
+VOTE_FLUSH_SIZE = 500
+# how long a process which exits waits for its buffered votes to be written
+VOTE_EXIT_FLUSH_TIMEOUT = 10
+# buffered votes are also appended to a journal here, set to None to keep them only in memory
+VOTE_JOURNAL_DIR = getattr(config, 'VOTE_JOURNAL_DIR',
+                           os.path.join(tempfile.gettempdir(), 'salty_tickets_votes') if fcntl else None)
+VOTE_JOURNAL_FSYNC = getattr(config, 'VOTE_JOURNAL_FSYNC', False)
+VOTE_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class VoteJournal:
+    """Append-only file with the buffered votes, locked while the process uses it.
+
+    A journal which isn't locked belongs to a crashed process and its votes are inserted again.
+    """
+    def __init__(self, journal_dir, fsync=False):
+        self.fsync = fsync
+        os.makedirs(journal_dir, exist_ok=True)
+        tmp_path = os.path.join(journal_dir, 'votes-{}-{}.tmp'.format(os.getpid(), uuid.uuid4().hex))
+        self._file = open(tmp_path, 'a', encoding='utf-8')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        # renamed only once locked, so it isn't recovered by another process in the meantime
+        self.path = tmp_path[:-len('.tmp')] + '.journal'
+        os.rename(tmp_path, self.path)
+
+    def append(self, row):
+        self._file.write(json.dumps(dict(row, vote_timestamp=row['vote_timestamp'].strftime(VOTE_TIMESTAMP_FORMAT))))
+        self._file.write('\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def remove(self):
+        os.unlink(self.path)
+        self._file.close()
+
+
+def read_journal(journal_file):
+    rows = []
+    for line in journal_file:
+        try:
+            row = json.loads(line)
+        except ValueError:
+            # the last line is incomplete if the process crashed while writing it
+            continue
+        row['vote_timestamp'] = datetime.datetime.strptime(row['vote_timestamp'], VOTE_TIMESTAMP_FORMAT)
+        rows.append(row)
+    return rows
+
+
+def insert_votes(rows, skip_existing=False):
+    if skip_existing and rows:
+        # the votes of a recovered journal may have been inserted before the crash
+        timestamps = [row['vote_timestamp'] for row in rows]
+        existing = set(db_session.query(Vote.voter_id, Vote.vote_timestamp).
+                       filter(Vote.vote_timestamp.between(min(timestamps), max(timestamps))))
+        rows = [row for row in rows if (row['voter_id'], row['vote_timestamp']) not in existing]
+    if rows:
+        db_session.execute(Vote.__table__.insert(), rows)
+    db_session.commit()
+    return len(rows)
+
+
+def recover_vote_journals(journal_dir):
+    """Inserts the votes of the journals left by crashed processes, returns the number of votes inserted"""
+    if fcntl is None:
+        # the journals of the running processes can't be told apart
+        raise RuntimeError('Vote journals need fcntl')
+    recovered = 0
+    for path in sorted(glob.glob(os.path.join(journal_dir, 'votes-*.journal'))):
+        try:
+            journal_file = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        with journal_file:
+            try:
+                fcntl.flock(journal_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # used by a running process
+                continue
+            if not os.path.exists(path):
+                continue
+            recovered += insert_votes(read_journal(journal_file), skip_existing=True)
+            os.unlink(path)
+    return recovered
+
+
+def recover_lost_votes(journal_dir=VOTE_JOURNAL_DIR):
+    """Same as recover_vote_journals, the errors are logged"""
+    if not journal_dir:
+        return 0
+    try:
+        recovered = recover_vote_journals(journal_dir)
+        if recovered:
+            logging.warning('Recovered %s votes from the vote journals', recovered)
+        return recovered
+    except Exception:
+        logging.exception('Failed to recover the vote journals')
+        return 0
+    finally:
+        db_session.remove()
+
+
+class VoteBuffer:
+    """Acknowledges the votes straight away and inserts them in bulk from a writer thread.
+
+    The buffer is written every flush_interval seconds or when it has flush_size votes.
+    With a journal_dir the votes are appended to a journal first, so they are not lost if
+    the process crashes before they are written.
+    """
+    def __init__(self, flush_interval=VOTE_FLUSH_INTERVAL, flush_size=VOTE_FLUSH_SIZE,
+                 journal_dir=VOTE_JOURNAL_DIR, journal_fsync=VOTE_JOURNAL_FSYNC, on_flush=None):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        if journal_dir and fcntl is None:
+            logging.warning('Vote journals need fcntl, the buffered votes are only kept in memory')
+            journal_dir = None
+        self.journal_dir = journal_dir
+        self.journal_fsync = journal_fsync
+        self.on_flush = on_flush
+        self.submitted_count = 0
+        self.flushed_count = 0
+        self._votes = []
+        self._journal = None
+        self._flush_requested = False
+        self._condition = threading.Condition()
+        self._writer = None
+        self._pid = None
+
+    def submit(self, voter_id, vote, vote_timestamp=None):
+        row = {
+            'voter_id': voter_id,
+            'vote': vote,
+            'vote_timestamp': vote_timestamp or datetime.datetime.utcnow(),
+        }
+        with self._condition:
+            self._start()
+            if self._journal is not None:
+                self._journal.append(row)
+            self._votes.append(row)
+            self.submitted_count += 1
+            if len(self._votes) >= self.flush_size:
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Waits until the votes submitted so far are written"""
+        deadline = time.time() + timeout if timeout else None
+        with self._condition:
+            # including the batch which is being written
+            target = self.submitted_count
+            # also seen by the writer if it isn't waiting yet
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self.flushed_count < target:
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=VOTE_EXIT_FLUSH_TIMEOUT):
+        """Writes the buffered votes before the process exits"""
+        if self._writer is None or self._pid != os.getpid():
+            return
+        if self.flush(timeout):
+            with self._condition:
+                if not self._votes and self._journal is not None:
+                    self._journal.remove()
+                    self._journal = None
+
+    def _start(self):
+        # the writer is started in the process which receives the votes, e.g. after a fork
+        if self._writer is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.submitted_count = self.flushed_count = 0
+        self._votes = []
+        self._flush_requested = False
+        self._journal = None
+        if self.journal_dir:
+            self._journal = VoteJournal(self.journal_dir, self.journal_fsync)
+        self._writer = threading.Thread(target=self._run, name='vote-writer', daemon=True)
+        self._writer.start()
+        # the writer is a daemon thread, it doesn't keep the process running until the votes are written
+        atexit.register(self.close)
+
+    def _run(self):
+        recover_lost_votes(self.journal_dir)
+
+        batch, journal = [], None
+        while True:
+            if not batch:
+                with self._condition:
+                    if len(self._votes) < self.flush_size and not self._flush_requested:
+                        self._condition.wait(self.flush_interval)
+                    self._flush_requested = False
+                    if not self._votes:
+                        continue
+                    batch, self._votes = self._votes, []
+                    # the next votes go to a new journal, the old one is removed once the batch is written
+                    journal = self._journal
+                    if journal is not None:
+                        self._journal = VoteJournal(self.journal_dir, self.journal_fsync)
+
+            try:
+                insert_votes(batch)
+            except Exception:
+                # the batch is kept and written again
+                logging.exception('Failed to write %s votes', len(batch))
+                db_session.rollback()
+                time.sleep(self.flush_interval)
+                continue
+            finally:
+                db_session.remove()
+
+            if journal is not None:
+                journal.remove()
+            with self._condition:
+                self.flushed_count += len(batch)
+                self._condition.notify_all()
+            batch, journal = [], None
+            if self.on_flush is not None:
+                self.on_flush()
+
+
+vote_buffer = VoteBuffer(on_flush=vote_tally_engine.notify)
@@ -0,0 +1,161 @@
+import datetime
+import json
+import threading
+
+from salty_tickets.database import db_session
+from salty_tickets.models import Vote, VotingSession
+from sqlalchemy import func, or_
+
+VOTE_OPTIONS = ['left', 'right']
+# how often the tally picks up votes submitted to the other web workers
+VOTE_TALLY_CATCH_UP_INTERVAL = 1
+# the workers commit their votes in batches, not in id order, so the recent votes are read again
+VOTE_TALLY_CATCH_UP_OVERLAP = datetime.timedelta(seconds=30)
+VOTE_TALLY_KEEP_ALIVE_INTERVAL = 15
+
+
+class VoteTally:
+    """The last vote of every voter of a voting session and the number of voters per option"""
+    def __init__(self, session_id, name, start_timestamp, end_timestamp=None):
+        self.session_id = session_id
+        self.name = name
+        self.start_timestamp = start_timestamp
+        self.end_timestamp = end_timestamp
+        self.last_votes = {}
+        self.counts = {option: 0 for option in VOTE_OPTIONS}
+        self.last_vote_id = 0
+        self.version = 0
+
+    def add_vote(self, vote_id, voter_id, vote, vote_timestamp):
+        """Returns True if the results have changed"""
+        self.last_vote_id = max(self.last_vote_id, vote_id)
+        if vote_timestamp <= self.start_timestamp:
+            return False
+        if self.end_timestamp and vote_timestamp >= self.end_timestamp:
+            return False
+
+        last_vote = self.last_votes.get(voter_id)
+        if last_vote is not None:
+            last_vote_timestamp, last_vote_id, last_vote_option = last_vote
+            if (last_vote_timestamp, last_vote_id) >= (vote_timestamp, vote_id):
+                return False
+            self.counts[last_vote_option] -= 1
+        self.last_votes[voter_id] = (vote_timestamp, vote_id, vote)
+        self.counts[vote] = self.counts.get(vote, 0) + 1
+        self.version += 1
+        return True
+
+    @property
+    def results_data(self):
+        return {option: self.counts.get(option, 0) for option in VOTE_OPTIONS}
+
+    @property
+    def progress_data(self):
+        results = self.results_data
+        progress_max = max(20, max(results.values()))
+        progress_data = {'total_max': progress_max}
+        for option, count in results.items():
+            progress_data['{}_pcnt'.format(option)] = int(count * 100 / progress_max)
+        return progress_data
+
+    def as_dict(self):
+        return {
+            'session_id': self.session_id,
+            'name': self.name,
+            'active': self.end_timestamp is None,
+            'version': self.version,
+            'results': self.results_data,
+            'progress': self.progress_data,
+        }
+
+
+def get_votes_window_query(voting_session):
+    query = db_session.query(Vote.id, Vote.voter_id, Vote.vote, Vote.vote_timestamp).\
+        filter(Vote.vote_timestamp > voting_session.start_timestamp)
+    if voting_session.end_timestamp:
+        query = query.filter(Vote.vote_timestamp < voting_session.end_timestamp)
+    return query
+
+
+def load_vote_tally(voting_session):
+    """Tally seeded with the last vote of every voter, from one windowed query"""
+    tally = VoteTally(voting_session.id, voting_session.name,
+                      voting_session.start_timestamp, voting_session.end_timestamp)
+    # later votes are picked up by catch_up
+    last_vote_id = db_session.query(func.max(Vote.id)).scalar() or 0
+    row_number = func.row_number().over(partition_by=Vote.voter_id,
+                                        order_by=(Vote.vote_timestamp.desc(), Vote.id.desc()))
+    votes = get_votes_window_query(voting_session).filter(Vote.id <= last_vote_id).\
+        add_columns(row_number.label('row_number')).subquery()
+    for vote_id, voter_id, vote, vote_timestamp, _ in db_session.query(votes).filter(votes.c.row_number == 1):
+        tally.add_vote(vote_id, voter_id, vote, vote_timestamp)
+    tally.last_vote_id = last_vote_id
+    return tally
+
+
+class VoteTallyEngine:
+    """Keeps the tally of the current voting session in memory.
+
+    The votes written by the vote buffers of all the web workers are picked up by id and by
+    the overlap window, so the votes table is never scanned again.
+    """
+    def __init__(self):
+        self._tally = None
+        self._changed = threading.Condition()
+
+    def get_tally(self, voting_session=None):
+        if voting_session is None:
+            voting_session = VotingSession.query.order_by(VotingSession.id.desc()).first()
+        if voting_session is None:
+            return None
+        with self._changed:
+            tally = self._tally
+            if tally is None or tally.session_id != voting_session.id or \
+                    tally.end_timestamp != voting_session.end_timestamp:
+                tally = self._tally = load_vote_tally(voting_session)
+                self._changed.notify_all()
+            return tally
+
+    def notify(self):
+        # new votes have been written, the streams catch up straight away
+        with self._changed:
+            self._changed.notify_all()
+
+    def catch_up(self, voting_session=None):
+        tally = self.get_tally(voting_session)
+        if tally is None:
+            return None
+        overlap_timestamp = datetime.datetime.utcnow() - VOTE_TALLY_CATCH_UP_OVERLAP
+        new_votes = db_session.query(Vote.id, Vote.voter_id, Vote.vote, Vote.vote_timestamp).\
+            filter(or_(Vote.id > tally.last_vote_id, Vote.vote_timestamp > overlap_timestamp)).\
+            order_by(Vote.id).all()
+        with self._changed:
+            if any([tally.add_vote(*vote) for vote in new_votes]):
+                self._changed.notify_all()
+        return tally
+
+    def wait(self, timeout):
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def stream(self):
+        """Server-Sent Events with the results, sent whenever they change"""
+        sent = None
+        idle = 0
+        while True:
+            tally = self.catch_up()
+            state = (tally.session_id, tally.version, tally.end_timestamp) if tally else None
+            if state != sent:
+                sent = state
+                idle = 0
+                yield 'data: {}\n\n'.format(json.dumps(tally.as_dict() if tally else None))
+            elif idle >= VOTE_TALLY_KEEP_ALIVE_INTERVAL:
+                idle = 0
+                yield ': keep-alive\n\n'
+            # the session is not kept open while waiting
+            db_session.remove()
+            self.wait(VOTE_TALLY_CATCH_UP_INTERVAL)
+            idle += VOTE_TALLY_CATCH_UP_INTERVAL
+
+
+vote_tally_engine = VoteTallyEngine()
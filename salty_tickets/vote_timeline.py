@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+VOTE_TIMELINE_CSV_CHUNK_SIZE = 10000
+
+
+def to_timestamps(series):
+    return pd.to_datetime(series).astype('datetime64[ns]')
+
+
+def assign_voting_sessions(votes_df, voting_sessions_df):
+    """Votes joined with the voting session they were submitted in, the other votes are dropped"""
+    sessions = voting_sessions_df.sort_values('start_timestamp').rename(columns={'id': 'session_id'})
+    votes = votes_df.sort_values('vote_timestamp', kind='mergesort')
+    # empty query results have object columns, which merge_asof doesn't accept
+    votes = votes.assign(vote_timestamp=to_timestamps(votes.vote_timestamp))
+    sessions = sessions.assign(start_timestamp=to_timestamps(sessions.start_timestamp),
+                               end_timestamp=to_timestamps(sessions.end_timestamp))
+    votes = pd.merge_asof(votes, sessions, left_on='vote_timestamp', right_on='start_timestamp', direction='backward')
+    votes = votes[votes.vote_timestamp <= votes.end_timestamp]
+    columns = list(votes_df.columns) + ['session_id'] + [c for c in sessions.columns if c != 'session_id']
+    return votes[columns]
+
+
+def get_vote_timeline(votes_df, voting_sessions_df):
+    """Votes with the number of voters per option after every vote, counting the last vote of each voter.
+
+    Every vote adds 1 to its option and takes 1 from the previous vote of the voter in the session,
+    the counts are the cumulative sums of these changes.
+    """
+    votes = assign_voting_sessions(votes_df, voting_sessions_df)
+    votes = votes.sort_values(['session_id', 'vote_timestamp', 'id'], kind='mergesort').reset_index(drop=True)
+    vote_options = votes_df.vote.unique()
+
+    previous_vote = votes.groupby(['session_id', 'voter_id'], sort=False).vote.shift()
+    # votes without a voter are not counted
+    has_voter = votes.voter_id.notna()
+    for vote_option in vote_options:
+        deltas = ((votes.vote == vote_option) & has_voter).astype(np.int64) - \
+                 ((previous_vote == vote_option) & has_voter).astype(np.int64)
+        counts = deltas.groupby(votes.session_id, sort=False).cumsum()
+        # votes at the same time all see the counts after the last of them
+        votes[vote_option] = counts.groupby([votes.session_id, votes.vote_timestamp], sort=False).transform('last')
+    return votes
+
+
+def iter_csv_chunks(df, chunk_size=VOTE_TIMELINE_CSV_CHUNK_SIZE):
+    yield df.iloc[:0].to_csv(index=False)
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size].to_csv(index=False, header=False)
@@ -1,6 +1,7 @@
 from salty_tickets import models
 from salty_tickets.controllers import OrderSummaryController
 from salty_tickets.database import db_session
+from salty_tickets.inventory import rebuild_product_inventory
 from salty_tickets.models import Registration, Order, ORDER_PRODUCT_STATUS_ACCEPTED, OrderProduct, DANCE_ROLE_LEADER, DANCE_ROLE_FOLLOWER, \
     ORDER_STATUS_PAID, PAYMENT_STATUS_PAID
 from salty_tickets.pricing_rules import add_payment_to_user_order, balance_event_waiting_lists
@@ -46,6 +47,7 @@ user_order.status = ORDER_STATUS_PAID
 event.orders.append(user_order)
 
 db_session.commit()
+rebuild_product_inventory(event.id)
 
 balance_results = balance_event_waiting_lists(event)
 
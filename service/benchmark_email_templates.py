@@ -0,0 +1,87 @@
+import argparse
+import datetime
+import logging
+import os
+import re
+import tempfile
+import time
+
+from flask import render_template
+from premailer import Premailer
+from salty_tickets import app
+from salty_tickets.controllers import OrderSummaryController, OrderProductController
+from salty_tickets.database import db_session, Base
+from salty_tickets.email_templates import render_email_html, compile_email_template
+from salty_tickets.models import Event, Order, OrderProduct, Registration
+from salty_tickets.pricing_rules import add_payment_to_user_order
+from salty_tickets.products import RegularPartnerWorkshop
+from sqlalchemy import create_engine
+
+# usage: python benchmark_email_templates.py [--emails 50]
+# per email html render time with Premailer on every email and with the precompiled templates,
+# in a temporary sqlite database, the real database is not used
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--emails', type=int, default=50)
+args = parser.parse_args()
+
+db_path = os.path.join(tempfile.mkdtemp(), 'benchmark_email_templates.db')
+engine = create_engine('sqlite:///' + db_path)
+Base.metadata.create_all(bind=engine)
+db_session.configure(bind=engine)
+
+
+def create_order():
+    event = Event(name='Benchmark', start_date=datetime.datetime.utcnow(), event_key='benchmark')
+    for n in range(4):
+        workshop = RegularPartnerWorkshop(name='Workshop {}'.format(n), price=30, max_available=20, ratio=1.5,
+                                          allow_first=5, info='').model
+        event.products.append(workshop)
+    user_order = Order(total_price=120)
+    user_order.registration = Registration(name='Benchmark', email='benchmark@example.com')
+    for product in event.products:
+        order_product = OrderProduct(product, 30, dict(dance_role='leader'), status='accepted')
+        order_product.registration = user_order.registration
+        user_order.order_products.append(order_product)
+    event.orders.append(user_order)
+    db_session.add(event)
+    db_session.commit()
+    add_payment_to_user_order(user_order)
+    db_session.commit()
+    return user_order
+
+
+def prepare_email_html(html):
+    # how the emails used to be rendered, Premailer on every email
+    html_for_email = Premailer(html, cssutils_logging_level=logging.CRITICAL).transform()
+    return re.sub(r'<style.*</style>', '', html_for_email, flags=re.DOTALL)
+
+
+def measure(render):
+    render()
+    started = time.perf_counter()
+    for n in range(args.emails):
+        render()
+    return (time.perf_counter() - started) / args.emails * 1000
+
+
+# the templates are precompiled when the app is imported, this is what the startup costs
+email_template_names = [template_name for template_name in app.jinja_loader.list_templates()
+                        if template_name.startswith('email/') and template_name.endswith('.html')]
+started = time.perf_counter()
+with app.app_context():
+    for template_name in email_template_names:
+        compile_email_template(template_name)
+print('precompile all email templates: {:.0f} ms'.format((time.perf_counter() - started) * 1000))
+
+with app.test_request_context():
+    user_order = create_order()
+    emails = [
+        ('email/registration_confirmation.html', dict(order_summary_controller=OrderSummaryController(user_order))),
+        ('email/acceptance_from_waiting_list.html',
+         dict(order_product_controller=OrderProductController(user_order.order_products[0]))),
+    ]
+    for template_name, context in emails:
+        before = measure(lambda: prepare_email_html(render_template(template_name, **context)))
+        after = measure(lambda: render_email_html(template_name, **context))
+        print('{}: premailer {:.1f} ms/email, precompiled {:.2f} ms/email'.format(template_name, before, after))
@@ -0,0 +1,34 @@
+import random
+import timeit
+
+from salty_tickets.availability import full_weekend_available, _max_bundles
+
+# usage: python benchmark_full_weekend_availability.py
+# compares the closed form with the greedy loop MtsSignupFormController used before
+
+
+def greedy_full_weekend_available(slots):
+    available_slots = sorted(slots)
+    available = 0
+    while len(available_slots) >= 3:
+        available += available_slots[-3]
+        available_slots[-1] -= available_slots[-3]
+        available_slots[-2] -= available_slots[-3]
+        available_slots[-3] -= available_slots[-3]
+        available_slots = [x for x in available_slots if x]
+    return available
+
+
+random.seed(1)
+samples = [[random.randint(0, 200) for _ in range(random.randint(3, 12))] for _ in range(1000)]
+
+underestimated = sum(1 for slots in samples if greedy_full_weekend_available(slots) < full_weekend_available(slots))
+print('greedy loop underestimated {} of {} samples'.format(underestimated, len(samples)))
+
+greedy_time = timeit.timeit(lambda: [greedy_full_weekend_available(s) for s in samples], number=20)
+_max_bundles.cache_clear()
+closed_form_time = timeit.timeit(lambda: [full_weekend_available(s) for s in samples], number=1)
+cached_time = timeit.timeit(lambda: [full_weekend_available(s) for s in samples], number=20)
+print('greedy loop:     {:.2f} us per call'.format(greedy_time / 20 / len(samples) * 1e6))
+print('closed form:     {:.2f} us per call'.format(closed_form_time / len(samples) * 1e6))
+print('closed, cached:  {:.2f} us per call'.format(cached_time / 20 / len(samples) * 1e6))
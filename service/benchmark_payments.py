@@ -0,0 +1,68 @@
+import argparse
+import datetime
+import os
+import tempfile
+import threading
+import time
+
+from fake_stripe import create_fake_stripe_server
+from salty_tickets import app, config
+from salty_tickets.database import db_session, Base
+from salty_tickets.models import Event, Order, Payment, PAYMENT_STATUS_PAID
+from salty_tickets.payment_queue import submit_payment
+from salty_tickets.payments import process_payment
+from sqlalchemy import create_engine
+
+# usage: python benchmark_payments.py [--payments 200] [--latency 0.3]
+# charges payments against service/fake_stripe.py one by one and with the payment workers,
+# in a temporary sqlite database, the real database is not used
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--payments', type=int, default=200)
+parser.add_argument('--latency', type=float, default=0.3)
+args = parser.parse_args()
+
+server = create_fake_stripe_server(port=0, latency=args.latency)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+config.STRIPE_API_BASE = 'http://localhost:{}'.format(server.server_address[1])
+
+db_path = os.path.join(tempfile.mkdtemp(), 'benchmark_payments.db')
+engine = create_engine('sqlite:///' + db_path, connect_args={'timeout': 30})
+Base.metadata.create_all(bind=engine)
+db_session.configure(bind=engine)
+
+
+def create_payments(count):
+    event = Event(name='Benchmark', start_date=datetime.datetime.utcnow())
+    for n in range(count):
+        user_order = Order(total_price=10)
+        user_order.payments.append(Payment(amount=10, transaction_fee=0.35))
+        event.orders.append(user_order)
+    db_session.add(event)
+    db_session.commit()
+    return [p.id for p in Payment.query.filter(Payment.order_id.in_([o.id for o in event.orders])).all()]
+
+
+with app.app_context():
+    payment_ids = create_payments(args.payments)
+    started = time.time()
+    for payment_id in payment_ids:
+        process_payment(Payment.query.get(payment_id), 'tok_visa')
+    sequential_time = time.time() - started
+
+    payment_ids = create_payments(args.payments)
+    charges_before = server.charges_count
+    started = time.time()
+    # every payment is submitted twice, it must be charged once
+    futures = [submit_payment(Payment.query.get(payment_id), 'tok_visa') for payment_id in payment_ids]
+    futures += [submit_payment(Payment.query.get(payment_id), 'tok_visa') for payment_id in payment_ids]
+    for future in futures:
+        future.result()
+    workers_time = time.time() - started
+    db_session.remove()
+
+    paid = Payment.query.filter(Payment.id.in_(payment_ids), Payment.status == PAYMENT_STATUS_PAID).count()
+
+print('one by one:   {:.1f} payments/s'.format(args.payments / sequential_time))
+print('workers:      {:.1f} payments/s'.format(args.payments / workers_time))
+print('paid: {} of {}, charges: {}'.format(paid, args.payments, server.charges_count - charges_before))
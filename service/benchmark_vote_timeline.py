@@ -0,0 +1,80 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from salty_tickets.vote_timeline import get_vote_timeline, iter_csv_chunks
+
+# usage: python benchmark_vote_timeline.py [--votes 100000] [--voters 500] [--sample 2000]
+# the vote timeline of /vote/admin/data.csv on synthetic votes, compared with the previous
+# row by row calculation on the first --sample votes
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--votes', type=int, default=100000)
+parser.add_argument('--voters', type=int, default=500)
+parser.add_argument('--sample', type=int, default=2000)
+args = parser.parse_args()
+
+
+def create_votes(count, voters, sessions=5, seed=0):
+    rnd = np.random.RandomState(seed)
+    start = pd.Timestamp('2018-04-07 20:00')
+    voting_sessions_df = pd.DataFrame({
+        'id': np.arange(1, sessions + 1),
+        'name': ['Round {}'.format(n) for n in range(1, sessions + 1)],
+        'start_timestamp': [start + pd.Timedelta(minutes=10 * n) for n in range(sessions)],
+        'end_timestamp': [start + pd.Timedelta(minutes=10 * n + 5) for n in range(sessions)],
+    })
+    votes_df = pd.DataFrame({
+        'id': np.arange(1, count + 1),
+        'voter_id': ['voter{}'.format(v) for v in rnd.randint(0, voters, count)],
+        'vote': rnd.choice(['left', 'right'], count),
+        'vote_timestamp': start + pd.to_timedelta(np.sort(rnd.randint(0, 50 * 60 * 1000, count)), unit='ms'),
+    })
+    return votes_df, voting_sessions_df
+
+
+def get_vote_timeline_iterrows(votes_df, voting_sessions_df):
+    # the previous calculation of vote_data, for comparison
+    votes_df = votes_df.copy()
+    voting_sessions_df = voting_sessions_df.copy()
+    votes_df['session_id'] = None
+    for ix, voting_session in voting_sessions_df.iterrows():
+        votes_mask = votes_df.vote_timestamp.between(voting_session.start_timestamp, voting_session.end_timestamp)
+        votes_df.loc[votes_mask, 'session_id'] = voting_session.id
+
+    voting_sessions_df.index = voting_sessions_df.id
+    voting_sessions_df.drop('id', axis=1, inplace=True)
+    votes_df = votes_df.join(voting_sessions_df, on='session_id', how='inner')
+
+    vote_options = votes_df.vote.unique()
+    for vote_option in vote_options:
+        votes_df[vote_option] = None
+
+    for ix, vote in votes_df.iterrows():
+        query_votes = votes_df[votes_df.vote_timestamp.between(vote.start_timestamp, vote.vote_timestamp)]
+        grouped = query_votes.groupby('voter_id').last()
+
+        for vote_option in vote_options:
+            votes_df.loc[ix, vote_option] = grouped.vote[grouped.vote == vote_option].count()
+    return votes_df
+
+
+sample_votes_df, sample_sessions_df = create_votes(args.sample, args.voters // 10)
+started = time.perf_counter()
+expected = get_vote_timeline_iterrows(sample_votes_df, sample_sessions_df)
+iterrows_time = time.perf_counter() - started
+result = get_vote_timeline(sample_votes_df, sample_sessions_df)
+expected = expected.sort_values('id').reset_index(drop=True)
+result = result.sort_values('id').reset_index(drop=True)
+same = all((expected[option].astype(int) == result[option]).all() for option in ['left', 'right'])
+print('row by row, {} votes: {:.2f} s, same counts: {}'.format(args.sample, iterrows_time, same))
+
+votes_df, voting_sessions_df = create_votes(args.votes, args.voters)
+started = time.perf_counter()
+timeline_df = get_vote_timeline(votes_df, voting_sessions_df)
+timeline_time = time.perf_counter() - started
+csv_size = sum(len(chunk) for chunk in iter_csv_chunks(timeline_df))
+csv_time = time.perf_counter() - started - timeline_time
+print('vectorized, {} votes: {:.2f} s, csv {:.2f} s ({:.1f} MB)'.format(
+    args.votes, timeline_time, csv_time, csv_size / 1e6))
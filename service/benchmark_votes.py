@@ -0,0 +1,63 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from salty_tickets.database import db_session, Base
+from salty_tickets.models import Vote
+from salty_tickets.vote_buffer import VoteBuffer
+from sqlalchemy import create_engine
+
+# usage: python benchmark_votes.py [--votes 5000] [--voters 200] [--fsync]
+# votes per second submitted by concurrent voters, with a commit per vote as before and with the
+# vote buffer, in a temporary sqlite database, the real database is not used
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--votes', type=int, default=5000)
+parser.add_argument('--voters', type=int, default=200)
+parser.add_argument('--fsync', action='store_true', help='fsync the journal after every vote')
+args = parser.parse_args()
+
+tmp_dir = tempfile.mkdtemp()
+engine = create_engine('sqlite:///' + os.path.join(tmp_dir, 'benchmark_votes.db'), connect_args={'timeout': 60})
+Base.metadata.create_all(bind=engine)
+db_session.configure(bind=engine)
+
+
+def commit_vote(voter_id, vote):
+    # what vote_submit used to do
+    try:
+        db_session.add(Vote(voter_id=voter_id, vote=vote))
+        db_session.commit()
+    finally:
+        db_session.remove()
+
+
+def run_voters(submit):
+    def voter(n):
+        for i in range(args.votes // args.voters):
+            submit('voter{}'.format(n), 'left' if i % 2 else 'right')
+
+    threads = [threading.Thread(target=voter, args=(n,)) for n in range(args.voters)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+votes_count = args.votes // args.voters * args.voters
+
+commit_time = run_voters(commit_vote)
+print('commit per vote: {:.0f} votes/s'.format(votes_count / commit_time))
+
+vote_buffer = VoteBuffer(journal_dir=os.path.join(tmp_dir, 'journal'), journal_fsync=args.fsync)
+started = time.perf_counter()
+buffer_time = run_voters(vote_buffer.submit)
+vote_buffer.flush()
+written_time = time.perf_counter() - started
+print('vote buffer:     {:.0f} votes/s acknowledged, {:.0f} votes/s written'.format(
+    votes_count / buffer_time, votes_count / written_time))
+print('votes in the database: {} of {}'.format(Vote.query.count(), 2 * votes_count))
@@ -0,0 +1,7 @@
+from salty_tickets.database import db_session
+from salty_tickets.reservations import expire_capacity_holds
+
+# releases the places of checkouts which never finished, can run from cron
+expired = expire_capacity_holds()
+db_session.commit()
+print('{} expired capacity holds released'.format(expired))
@@ -0,0 +1,15 @@
+import sys
+
+from salty_tickets.crowdfunding_totals import rebuild_crowdfunding_totals, verify_crowdfunding_totals
+
+# usage: python crowdfunding_totals.py verify|rebuild [event_id]
+command = sys.argv[1] if len(sys.argv) > 1 else 'verify'
+event_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+if command == 'rebuild':
+    rebuild_crowdfunding_totals(event_id)
+
+mismatches = verify_crowdfunding_totals(event_id)
+for mismatch_event_id, product_id, stored, actual in mismatches:
+    print(mismatch_event_id, product_id or '-', 'stored:', stored, 'actual:', actual)
+print('{} crowdfunding totals out of sync'.format(len(mismatches)))
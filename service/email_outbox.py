@@ -0,0 +1,19 @@
+import argparse
+import logging
+
+from salty_tickets.email_outbox import EmailOutboxSender, get_email_outbox_metrics
+
+# usage: python email_outbox.py send [--workers 4] [--rate 5] | metrics
+# send keeps sending the queued emails, rate is the provider quota in emails per second
+parser = argparse.ArgumentParser()
+parser.add_argument('command', choices=['send', 'metrics'])
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--rate', type=float, default=5)
+args = parser.parse_args()
+
+if args.command == 'send':
+    logging.basicConfig(level=logging.INFO)
+    EmailOutboxSender(workers=args.workers, rate=args.rate).run()
+else:
+    for name, value in sorted(get_email_outbox_metrics().items()):
+        print(name, value)
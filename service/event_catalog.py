@@ -0,0 +1,12 @@
+import sys
+
+from salty_tickets.catalog import invalidate_event_catalog
+from salty_tickets.database import db_session
+from salty_tickets.models import Event
+
+# usage: python event_catalog.py event_key
+# run after changing the event products, so that the running app reloads them
+event = Event.query.filter_by(event_key=sys.argv[1]).one()
+invalidate_event_catalog(event)
+db_session.commit()
+print(event.name, 'catalog version', event.catalog_version)
@@ -0,0 +1,87 @@
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# usage: python fake_stripe.py [--port 12111] [--latency 0.3]
+# local stand-in for the Stripe charges API, set config.STRIPE_API_BASE = 'http://localhost:12111'
+# the token tok_chargeDeclined is declined, like in the Stripe test mode
+
+DECLINED_TOKENS = ['tok_chargeDeclined']
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        if self.path != '/v1/charges':
+            return self._send(404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown path'}})
+
+        idempotency_key = self.headers.get('Idempotency-Key')
+        with self.server.lock:
+            if idempotency_key in self.server.responses:
+                return self._send(*self.server.responses[idempotency_key])
+
+        time.sleep(self.server.latency)
+        params = {k: v[0] for k, v in parse_qs(body).items()}
+        if params.get('source') in DECLINED_TOKENS:
+            response = (402, {'error': {'type': 'card_error', 'code': 'card_declined',
+                                        'message': 'Your card was declined.'}})
+        else:
+            response = (200, {
+                'id': 'ch_' + uuid.uuid4().hex[:24],
+                'object': 'charge',
+                'amount': int(params.get('amount', 0)),
+                'currency': params.get('currency'),
+                'description': params.get('description'),
+                'paid': True,
+                'status': 'succeeded',
+            })
+
+        with self.server.lock:
+            # a retried request gets the first response, as with the real API
+            if idempotency_key in self.server.responses:
+                response = self.server.responses[idempotency_key]
+            else:
+                if idempotency_key:
+                    self.server.responses[idempotency_key] = response
+                if response[0] == 200:
+                    self.server.charges_count += 1
+        self._send(*response)
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if 'Idempotency-Key' in self.headers:
+            self.send_header('Idempotency-Key', self.headers['Idempotency-Key'])
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_fake_stripe_server(host='localhost', port=12111, latency=0.0):
+    server = ThreadingHTTPServer((host, port), FakeStripeHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.responses = {}
+    server.charges_count = 0
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds per charge')
+    args = parser.parse_args()
+    server = create_fake_stripe_server(port=args.port, latency=args.latency)
+    print('Fake Stripe API on http://localhost:{}'.format(args.port))
+    server.serve_forever()
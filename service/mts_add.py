@@ -1,5 +1,6 @@
 from salty_tickets.database import db_session
-from salty_tickets.models import Event, Registration, Order, Product, OrderProduct, Payment, OrderProductDetail
+from salty_tickets.inventory import rebuild_product_inventory
+from salty_tickets.models import Event, Registration, Order, Product, OrderProduct, Payment
 from salty_tickets.tokens import order_serialize
 
 event = Event.query.filter_by(id=6).one()
@@ -24,7 +25,7 @@ def get_order_product(product_name, price):
 
 def get_station_order_product(product_name, price, dance_role):
     order_product = get_order_product(product_name, price)
-    order_product.details.append(OrderProductDetail(field_name='dance_role', field_value=dance_role))
+    order_product.dance_role = dance_role
     return order_product
 
 user_order = Order()
@@ -50,6 +51,7 @@ user_order.status='paid'
 user_order.registration = registration
 event.orders.append(user_order)
 db_session.commit()
+rebuild_product_inventory(event.id)
 
 token = order_serialize(user_order)
 print(token)
@@ -1,8 +1,8 @@
 import unidecode
 from salty_tickets import config
-from salty_tickets.emails import send_email, pdf_attachment_from_url
+from salty_tickets.emails import queue_email
 from salty_tickets.models import Order, Registration, OrderProduct
-from salty_tickets.mts_controllers import MtsTicketController
+from salty_tickets.ticket_pdfs import TicketPdfRenderer, ticket_pdf_attachment
 
 config.MODE_TESTING = True
 
@@ -16,23 +16,33 @@ If you notice anything that looks incorrect in your tickets, please do contact u
 See you soon!
 Mind the Shag Team"""
 
-#for user_order in Order.query.filter_by(event_id=6, status='paid').all():
-for user_order in Order.query.filter_by(event_id=6, status='paid').filter(Order.id==220).all():
-    email_to = user_order.registration.email
+#user_orders = Order.query.filter_by(event_id=6, status='paid').all()
+user_orders = Order.query.filter_by(event_id=6, status='paid').filter(Order.id==220).all()
+all_registrations = []
+mailouts = []
+for user_order in user_orders:
+    registrations = Registration.query.join(OrderProduct, aliased=True).filter_by(order_id=user_order.id).distinct().all()
+    all_registrations += registrations
+    mailouts.append((user_order.id, user_order.registration.name, user_order.registration.email,
+                     [(r.id, r.name) for r in registrations]))
+
+# all the tickets are rendered in parallel before sending, unchanged tickets are taken from the cache
+pdf_renderer = TicketPdfRenderer()
+pdf_paths = dict(zip([r.id for r in all_registrations], pdf_renderer.render(all_registrations)))
+print(f'rendered {pdf_renderer.rendered_count} ticket PDFs')
+
+for order_id, order_name, email_to, registrations in mailouts:
     #email_to_salty = 'salty.jitterbugs@gmail.com'
     #email_to = 'alexander.a.vinokurov@gmail.com'
 
-    #if 'hotmail' not in user_order.registration.email:
+    #if 'hotmail' not in email_to:
     #    continue
 
     attachments = []
-    for registration in Registration.query.join(OrderProduct, aliased=True).filter_by(order_id=user_order.id).distinct():
-        ticket_controller = MtsTicketController(registration)
-        url = f'https://www.saltyjitterbugs.co.uk/mts/{ticket_controller.token}'
-        reg_name = unidecode.unidecode(registration.name)
-        attachments.append(pdf_attachment_from_url(url, f'Mind the Shag Ticket - {reg_name}.pdf'))
-
-    res = send_email(config.EMAIL_FROM, email_to, email_subject, email_text, None, attachments)
-    #res=''
-    print(user_order.id, user_order.registration.name, email_to, len(attachments), res)
+    for registration_id, registration_name in registrations:
+        reg_name = unidecode.unidecode(registration_name)
+        attachments.append(ticket_pdf_attachment(pdf_paths[registration_id], f'Mind the Shag Ticket - {reg_name}.pdf'))
 
+    # sent by the outbox sender (service/email_outbox.py) within the Mailgun rate limit
+    email = queue_email(config.EMAIL_FROM, email_to, email_subject, email_text, None, files=attachments)
+    print(order_id, order_name, email_to, len(attachments), email.id)
@@ -0,0 +1,5 @@
+from salty_tickets.payment_queue import expire_stale_payments
+
+# fails the payments which were never charged because their worker was restarted, can run from cron
+expired = expire_stale_payments()
+print('{} stale payments failed'.format(expired))
@@ -0,0 +1,15 @@
+import sys
+
+from salty_tickets.inventory import rebuild_product_inventory, verify_product_inventory
+
+# usage: python product_inventory.py verify|rebuild [event_id]
+command = sys.argv[1] if len(sys.argv) > 1 else 'verify'
+event_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+if command == 'rebuild':
+    rebuild_product_inventory(event_id)
+
+mismatches = verify_product_inventory(event_id)
+for product_id, dance_role, stored, actual in mismatches:
+    print(product_id, dance_role or '-', 'stored:', stored, 'actual:', actual)
+print('{} product inventory counters out of sync'.format(len(mismatches)))
@@ -0,0 +1,5 @@
+from salty_tickets.vote_buffer import recover_lost_votes, VOTE_JOURNAL_DIR
+
+# inserts the votes left in the journals by the stopped web workers, run it after the workers are (re)started
+recovered = recover_lost_votes()
+print('{} votes recovered from {}'.format(recovered, VOTE_JOURNAL_DIR))